@@ -6,6 +6,7 @@ import copy
 import logging
 
 import mini_buildd.misc
+import mini_buildd.gnupg
 
 LOG = logging.getLogger(__name__)
 
@@ -32,6 +33,14 @@ multiple version of the same package in one distribution (in
 different components), or just as safeguard
 """})
 
+    COMMON_ARG_PACKAGES = (["--packages", "-P"], {"action": "store", "metavar": "PACKAGES",
+                                                  "default": "",
+                                                  "help": "comma-separated list of source package names"})
+
+    COMMON_ARG_PATTERN = (["--pattern", "-p"], {"action": "store", "metavar": "PATTERN",
+                                                "default": "",
+                                                "help": "glob pattern of source package names (like 'lib*')"})
+
     @classmethod
     def _filter_api_args(cls, args, args_help, set_if_missing=False):
         def _get(key):
@@ -98,6 +107,10 @@ different components), or just as safeguard
         value = self.args.get(key)
         return value if value else None
 
+    def arg_list(self, key):
+        "Get comma-separated argument as list."
+        return [v for v in self.args.get(key, "").split(",") if v]
+
 
 class Status(Command):
     """Show the status of the mini-buildd instance."""
@@ -117,6 +130,13 @@ class Status(Command):
         self.remotes = {}
         self.packaging = []
         self.building = []
+        self.packager_queue = 0
+        self.packager_workers = []
+        self.incoming = []
+        self.builder = {}
+        self.gnupg = {}
+        self.tar_codecs = []
+        self.tars = {}
 
     def run(self, daemon):
         # version string
@@ -134,6 +154,9 @@ class Status(Command):
         # float value: 0 =< load <= 1+
         self.load = daemon.build_queue.load
 
+        # builder slot usage: {"builds": (active, max), "cpus": (used, total), "pending": n, "memory": MiB, "disk": MiB}
+        self.builder = daemon.build_queue.get_usage()
+
         # chroots: {"squeeze": ["i386", "amd64"], "wheezy": ["amd64"]}
         for c in daemon.get_active_chroots():
             self.chroots.setdefault(c.source.codename, [])
@@ -150,6 +173,25 @@ class Status(Command):
         self.packaging = ["{0}".format(p) for p in daemon.packages.values()]
         self.building = ["{0}".format(b) for b in daemon.builds.values()]
 
+        # packager pool: number of queued events, and source package per worker (None if idle)
+        if daemon.packager_pool:
+            self.packager_queue = daemon.packager_pool.queued
+            self.packager_workers = daemon.packager_pool.busy
+
+        # incoming scheduler: (class, number of queued events, histogram of waits until processing starts as (bound, count) list, mean wait) per class
+        if daemon.incoming_queue:
+            queued = dict(daemon.incoming_queue.get_queued())
+            self.incoming = [(c, queued[c], w.get(), w.mean) for c, w in daemon.incoming_queue.get_waits()]
+
+        # gnupg usage counters: {"forks": n, "verify_cache_hits": n, "packages": n}
+        self.gnupg = mini_buildd.gnupg.STATS.get()
+
+        # tar codecs we can (de)compress: ["gz", "none", "xz"]
+        self.tar_codecs = daemon.get_tar_codecs()
+
+        # tar statistics per codec: {"gz": {"tars": n, "size": bytes, "tar_size": bytes}}
+        self.tars = daemon.get_tar_stats()
+
         self._plain_result = """\
 http://{h} ({v}):
 
@@ -159,9 +201,13 @@ Repositories: {r}
 Chroots     : {c}
 Remotes     : {rm}
 
-Packager: {p_len} packaging
+Incoming: {i}
+GnuPG   : {g}
+Tars    : {t}
+
+Packager: {p_len} packaging ({pw_busy}/{pw_len} workers busy, {pq} queued)
 {p}
-Builder: {b_len} building
+Builder: {b_len} building ({b_slots})
 {b}""".format(h=self.http,
               v=self.version,
               ds="UP" if self.running else "DOWN",
@@ -170,11 +216,53 @@ Builder: {b_len} building
               r=self.repositories_str(),
               c=self.chroots_str(),
               rm=", ".join(self.remotes),
+              i=", ".join(["{c} {q} queued (mean wait {m}s)".format(c=c, q=q, m=m) for c, q, _w, m in self.incoming]),
+              g=self.gnupg_str(),
+              t=self.tars_str(),
               p_len=len(self.packaging),
+              pw_busy=len([w for w in self.packager_workers if w is not None]),
+              pw_len=len(self.packager_workers),
+              pq=self.packager_queue,
               p="\n".join(self.packaging) + "\n" if self.packaging else "",
               b_len=len(self.building),
+              b_slots=self.builder_str(),
               b="\n".join(self.building) + "\n" if self.building else "")
 
+    def builder_str(self):
+        if not self.builder:
+            return "n/a"
+        return "{b}/{mb} builds, {c}/{mc} cpus, {p} pending, {m} MiB memory available, {d} MiB disk free".format(
+            b=self.builder["builds"][0], mb=self.builder["builds"][1],
+            c=self.builder["cpus"][0], mc=self.builder["cpus"][1],
+            p=self.builder["pending"],
+            m=self.builder["memory"],
+            d=self.builder["disk"])
+
+    def gnupg_str(self):
+        """
+        >>> s = Status({})
+        >>> s.gnupg = {"forks": 30, "verify_cache_hits": 2, "packages": 4}
+        >>> s.gnupg_str()
+        u'30 forks (7.5 per package), 2 verify cache hits'
+        """
+        forks, packages = self.gnupg.get("forks", 0), self.gnupg.get("packages", 0)
+        return "{f} forks ({p} per package), {h} verify cache hits".format(
+            f=forks,
+            p=round(float(forks) / packages, 1) if packages else "n/a",
+            h=self.gnupg.get("verify_cache_hits", 0))
+
+    def tars_str(self):
+        """
+        >>> s = Status({})
+        >>> s.tar_codecs = ["gz", "none"]
+        >>> s.tars = {"gz": {"tars": 2, "size": 4000, "tar_size": 1000}, "none": {"tars": 1, "size": 10, "tar_size": 10}}
+        >>> s.tars_str()
+        u'codecs gz none; gz: 2 tars (ratio 4.0), none: 1 tars (ratio 1.0)'
+        """
+        return "codecs {c}; {t}".format(
+            c=" ".join(self.tar_codecs),
+            t=", ".join(["{c}: {n} tars (ratio {r})".format(c=c, n=t["tars"], r=round(float(t["size"]) / max(1, t["tar_size"]), 1)) for c, t in sorted(self.tars.items())]) or "none made")
+
     def repositories_str(self):
         return ", ".join(["{i}: {c}".format(i=identity, c=" ".join(codenames)) for identity, codenames in self.repositories.items()])
 
@@ -184,6 +272,30 @@ Builder: {b_len} building
     def has_chroot(self, codename, arch):
         return codename in self.chroots and arch in self.chroots[codename]
 
+    def get_score(self, reserved=0):
+        """
+        Get load score for placing one more build here (lower is better).
+
+        This is the number of builds (active, pending, reserved
+        and the new one) per build slot. For statuses from older
+        remotes without slot information, the plain load is used.
+
+        >>> s = Status({})
+        >>> s.builder = {"builds": (1, 4), "pending": 1}
+        >>> s.get_score(), s.get_score(reserved=2)
+        (0.75, 1.25)
+        >>> s = Status({})
+        >>> del s.builder
+        >>> s.load = 0.5
+        >>> s.get_score(reserved=1)
+        1.5
+        """
+        builder = getattr(self, "builder", None)
+        if builder:
+            active, slots = builder["builds"]
+            return float(active + builder["pending"] + reserved + 1) / max(1, slots)
+        return self.load + reserved
+
     def __test_msglog(self):
         self.msglog.debug("DEBUG USER MESSAGE")
         self.msglog.info("INFO USER MESSAGE")
@@ -315,6 +427,26 @@ class LogCat(Command):
         self._plain_result = daemon.logcat(lines=int(self.args["lines"]))
 
 
+class BuildLog(Command):
+    """Show the build log of a running build (at most 1 MiB per call; continue with '--offset')."""
+
+    COMMAND = "buildlog"
+    ARGUMENTS = [
+        (["key"], {"help": "build key, i.e. 'SOURCE_VERSION:ARCH' (see status)"}),
+        (["--offset", "-o"], {"action": "store", "metavar": "BYTES", "type": int,
+                              "default": 0,
+                              "help": "start at this byte offset"}),
+        (["--follow", "-f"], {"action": "store_true",
+                              "default": False,
+                              "help": "follow the log live until the build is finished (mini-buildd-tool only; polls '/mini_buildd/builds/KEY/log')"})]
+
+    def run(self, daemon):
+        build = daemon.builds.get(self.args["key"])
+        if build is None:
+            raise Exception("No such running build: {k}".format(k=self.args["key"]))
+        self._plain_result = build.read_log(int(self.args["offset"])).decode(mini_buildd.setup.CHAR_ENCODING, "replace")
+
+
 def _get_table_format(dct, cols):
     tlen = {}
     for _r, values in dict(dct).items():
@@ -501,6 +633,56 @@ class Remove(Command):
                                                            msglog=self.msglog)
 
 
+class MigrateBulk(Command):
+    """Migrate many source packages at once.
+
+    All packages (given by name and/or pattern) are checked before
+    anything is done; the repository is exported and notified only
+    once.
+    """
+    COMMAND = "migratebulk"
+    AUTH = Command.STAFF
+    CONFIRM = True
+    ARGUMENTS = [
+        (["distribution"], {"help": "distribution to migrate from (if this is a '-rollbackN' distribution, this will perform a rollback restore)"}),
+        Command.COMMON_ARG_PACKAGES,
+        Command.COMMON_ARG_PATTERN]
+
+    def run(self, daemon):
+        repository, distribution, suite, rollback = daemon.parse_distribution(self.args["distribution"])
+        packages = repository.mbd_package_resolve(self.args["distribution"], self.arg_list("packages"), self.args["pattern"])
+        self._plain_result = repository.mbd_package_migrate_bulk(packages,
+                                                                 distribution,
+                                                                 suite,
+                                                                 rollback=rollback,
+                                                                 msglog=self.msglog)
+
+
+class RemoveBulk(Command):
+    """Remove many source packages at once.
+
+    All packages (given by name and/or pattern) are checked before
+    anything is done; the repository is exported and notified only
+    once.
+    """
+    COMMAND = "removebulk"
+    AUTH = Command.ADMIN
+    CONFIRM = True
+    ARGUMENTS = [
+        (["distribution"], {"help": "distribution to remove from"}),
+        Command.COMMON_ARG_PACKAGES,
+        Command.COMMON_ARG_PATTERN]
+
+    def run(self, daemon):
+        repository, distribution, suite, rollback = daemon.parse_distribution(self.args["distribution"])
+        packages = repository.mbd_package_resolve(self.args["distribution"], self.arg_list("packages"), self.args["pattern"])
+        self._plain_result = repository.mbd_package_remove_bulk(packages,
+                                                                distribution,
+                                                                suite,
+                                                                rollback=rollback,
+                                                                msglog=self.msglog)
+
+
 class Port(Command):
     """Port an internal package.
 
@@ -531,6 +713,30 @@ class Port(Command):
             self._plain_result += to_distribution + " "
 
 
+class PortBulk(Command):
+    """Port many internal packages at once.
+
+    All ports (packages given by name and/or pattern) are checked
+    before any port is started.
+    """
+    COMMAND = "portbulk"
+    AUTH = Command.STAFF
+    NEEDS_RUNNING_DAEMON = True
+    CONFIRM = True
+    ARGUMENTS = [
+        (["from_distribution"], {"help": "distribution to port from"}),
+        (["to_distributions"], {"help": "comma-separated list of distributions to port to (when this equals the from-distribution, a rebuild will be done)"}),
+        Command.COMMON_ARG_PACKAGES,
+        Command.COMMON_ARG_PATTERN]
+
+    def run(self, daemon):
+        repository, _distribution, _suite, _rollback = daemon.parse_distribution(self.args["from_distribution"])
+        packages = repository.mbd_package_resolve(self.args["from_distribution"], self.arg_list("packages"), self.args["pattern"])
+        for package, to_distribution, _url, version in daemon.port_bulk(packages, self.args["from_distribution"], self.args["to_distributions"].split(",")):
+            self.msglog.info("Requested: Port {p}/{d} -> {to_d} ({v})".format(p=package, d=self.args["from_distribution"], to_d=to_distribution, v=version))
+            self._plain_result += "{p}:{d} ".format(p=package, d=to_distribution)
+
+
 class PortExt(Command):
     """Port an external package.
 
@@ -665,12 +871,16 @@ COMMANDS = [(COMMAND_GROUP, "Daemon commands"),
             (GetDputConf.COMMAND, GetDputConf),
             (GetSourcesList.COMMAND, GetSourcesList),
             (LogCat.COMMAND, LogCat),
+            (BuildLog.COMMAND, BuildLog),
             (COMMAND_GROUP, "Package management commands"),
             (List.COMMAND, List),
             (Show.COMMAND, Show),
             (Migrate.COMMAND, Migrate),
             (Remove.COMMAND, Remove),
             (Port.COMMAND, Port),
+            (MigrateBulk.COMMAND, MigrateBulk),
+            (RemoveBulk.COMMAND, RemoveBulk),
+            (PortBulk.COMMAND, PortBulk),
             (PortExt.COMMAND, PortExt),
             (Retry.COMMAND, Retry),
             (COMMAND_GROUP, "User management commands"),
@@ -2,19 +2,321 @@
 from __future__ import unicode_literals
 
 import os
+import stat
 import datetime
+import time
+import glob
+import hashlib
 import shutil
 import re
 import subprocess
+import threading
+import collections
+import urllib2
 import logging
 
 import mini_buildd.setup
 import mini_buildd.misc
 import mini_buildd.changes
 
+import mini_buildd.models.chroot
+
 LOG = logging.getLogger(__name__)
 
 
+class Scheduler(object):
+    """
+    Resource-aware build scheduler.
+
+    Build requests are admitted in FIFO order when there is a
+    free build slot, a free CPU core, and enough available memory
+    and free disk in the spool dir for one more build (the latter
+    three are not checked when no build is running, so builds
+    never get stuck on small machines).
+
+    The degree of parallelism for an admitted build is its fair
+    share of all CPU cores among running and waiting builds,
+    plus one more build that may arrive any time (unless all
+    build slots would be taken), and never more than the
+    currently free cores. It is at least min_jobs (and 1), and
+    at most max_jobs unless 0. So a lone build does not block
+    the builds arriving next:
+
+    >>> s = Scheduler(max_builds=4, cpus=16)
+    >>> s.put("big")
+    >>> s.get()
+    (u'big', 8)
+    >>> s.put("tiny1")
+    >>> s.put("tiny2")
+    >>> s.__unicode__()
+    u'1/4 builds, 8/16 cpus, 2 pending'
+    >>> s.get(), s.get()
+    ((u'tiny1', 4), (u'tiny2', 4))
+    >>> s.load
+    0.75
+    >>> s.task_done(8)
+    >>> for e in ["a", "b", "c", "d"]:
+    ...     s.put(e)
+    >>> s.get(), s.get()
+    ((u'a', 4), (u'b', 4))
+    >>> s.put("SHUTDOWN")
+    >>> s.get()
+    (u'SHUTDOWN', None)
+
+    Memory and disk minimums are per build: A build that was
+    admitted less than RAMP_UP seconds ago has likely not yet
+    allocated its resources, so its minimum is still reserved:
+
+    >>> get_mem_available = mini_buildd.misc.get_mem_available
+    >>> mini_buildd.misc.get_mem_available = lambda: 1500
+    >>> s = Scheduler(max_builds=4, cpus=16, min_memory=1024)
+    >>> s.put("first")
+    >>> s.put("second")
+    >>> s.get()
+    (u'first', 5)
+    >>> s._fits()
+    False
+    >>> s.RAMP_UP = 0
+    >>> s._fits()
+    True
+    >>> mini_buildd.misc.get_mem_available = get_mem_available
+    """
+    RECHECK_INTERVAL = 10.0
+    RAMP_UP = 120.0
+
+    def __init__(self, max_builds, max_jobs=0, min_jobs=1, cpus=None, min_memory=0, min_disk=0, spool_dir=None):
+        self.max_builds = max_builds
+        self.max_jobs = max_jobs
+        self.min_jobs = min_jobs
+        self.cpus = cpus if cpus else mini_buildd.misc.get_cpus()
+        self.min_memory = min_memory
+        self.min_disk = min_disk
+        self._spool_dir = spool_dir
+
+        self._cond = threading.Condition()
+        self._pending = collections.deque()
+        # Jobs of admitted builds
+        self._active = []
+        # Admission times of builds that may still be ramping up
+        self._admitted = collections.deque()
+        self._shutdown = False
+
+    def __unicode__(self):
+        with self._cond:
+            return "{b}/{m} builds, {j}/{c} cpus, {p} pending".format(b=len(self._active), m=self.max_builds, j=sum(self._active), c=self.cpus, p=len(self._pending))
+
+    @property
+    def load(self):
+        with self._cond:
+            return round(float(len(self._active) + len(self._pending)) / self.max_builds, 2)
+
+    def get_usage(self):
+        "Get slot usage dict (builds, cpus, pending, available memory and free disk in MiB)."
+        with self._cond:
+            return {"builds": (len(self._active), self.max_builds),
+                    "cpus": (sum(self._active), self.cpus),
+                    "pending": len(self._pending),
+                    "memory": mini_buildd.misc.get_mem_available(),
+                    "disk": mini_buildd.misc.get_disk_free(self._spool_dir) if self._spool_dir else None}
+
+    def _fits(self):
+        if len(self._active) >= self.max_builds:
+            return False
+        if not self._active:
+            return True
+        if sum(self._active) >= self.cpus:
+            return False
+
+        # Reserve the minimums for the new build and all builds still ramping up
+        while self._admitted and time.time() - self._admitted[0] >= self.RAMP_UP:
+            self._admitted.popleft()
+        builds = 1 + len(self._admitted)
+
+        if self.min_memory:
+            memory = mini_buildd.misc.get_mem_available()
+            if memory is not None and memory < self.min_memory * builds:
+                LOG.info("Scheduler: Not enough memory for another build: {m}/{mm} MiB".format(m=memory, mm=self.min_memory * builds))
+                return False
+        if self.min_disk and self._spool_dir:
+            disk = mini_buildd.misc.get_disk_free(self._spool_dir)
+            if disk is not None and disk < self.min_disk * builds:
+                LOG.info("Scheduler: Not enough free disk for another build: {d}/{md} MiB".format(d=disk, md=self.min_disk * builds))
+                return False
+        return True
+
+    def put(self, event):
+        with self._cond:
+            if event == "SHUTDOWN":
+                self._shutdown = True
+            else:
+                self._pending.append(event)
+            self._cond.notify_all()
+
+    def get(self):
+        """
+        Block until the next build request is admitted, or on shutdown.
+
+        Returns tuple (event, jobs); the caller must call task_done(jobs) when the build is done.
+        """
+        with self._cond:
+            while not self._shutdown and not (self._pending and self._fits()):
+                # Resources may be freed without notice (memory, disk), so recheck regularly
+                self._cond.wait(self.RECHECK_INTERVAL if self._pending else None)
+
+            if self._shutdown:
+                return "SHUTDOWN", None
+
+            # Fair share, reserving a share for one more build unless all slots would be taken
+            share = self.cpus // min(self.max_builds, len(self._active) + len(self._pending) + 1)
+            jobs = max(1, self.min_jobs, min(share, self.cpus - sum(self._active)))
+            if self.max_jobs:
+                jobs = min(jobs, self.max_jobs)
+            self._active.append(jobs)
+            self._admitted.append(time.time())
+            return self._pending.popleft(), jobs
+
+    def task_done(self, jobs):
+        with self._cond:
+            self._active.remove(jobs)
+            if len(self._admitted) > len(self._active):
+                self._admitted.popleft()
+            self._cond.notify_all()
+
+
+class SetupCache(object):
+    """
+    Content-addressed cache of prepared chroot states.
+
+    The key is a hash over the chroot's state stamp, the state
+    of the apt sources (their Release files), and all setup
+    inputs of a build request (apt_sources.list,
+    apt_preferences, apt_keys and chroot_setup_script). The
+    cached value is a tar of all files the setup commands
+    changed in the chroot (apt lists and archives, packages
+    installed, ...).
+
+    A build with a known key extracts this tar into the new
+    chroot session, and skips the setup commands ('apt-get
+    update', https transport, chroot_setup_script): The apt
+    lists are still valid, as no apt source changed.
+
+    Entries expire after max_age hours; the key also changes
+    when the chroot (or its source) is checked or updated.
+
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> for f in SetupCache.INPUTS:
+    ...     mini_buildd.misc.open_utf8(os.path.join(d, f), "w").write(f)
+    >>> c = SetupCache(os.path.join(d, "cache"), max_age=1)
+    >>> k = c.key(d, "stamp0")
+    >>> k == c.key(d, "stamp0"), k == c.key(d, "stamp1")
+    (True, False)
+    >>> c.get(k) is None
+    True
+    >>> mini_buildd.misc.open_utf8(os.path.join(d, "setup_state.tar"), "w").write("tar")
+    >>> c.put(k, os.path.join(d, "setup_state.tar"))
+    >>> c.get(k) == os.path.join(d, "cache", k + ".tar")
+    True
+    >>> c.max_age = 0
+    >>> c.get(k) is None
+    True
+    >>> SetupCache.get_release_urls("deb http://host:8066/repositories/test/ wheezy-test-unstable main contrib\\n# comment\\ndeb-src [arch=i386] http://host/debian/ wheezy main\\n")
+    [u'http://host:8066/repositories/test/dists/wheezy-test-unstable/Release', u'http://host/debian/dists/wheezy/Release']
+    """
+    INPUTS = ["apt_sources.list", "apt_preferences", "apt_keys", "chroot_setup_script"]
+
+    def __init__(self, path, max_age=24):
+        self.path = path
+        self.max_age = max_age
+
+    @classmethod
+    def key(cls, build_dir, chroot_stamp):
+        h = hashlib.sha1(chroot_stamp.encode(mini_buildd.setup.CHAR_ENCODING))
+        for f in cls.INPUTS:
+            h.update(mini_buildd.misc.sha1_of_file(os.path.join(build_dir, f)))
+        return h.hexdigest()
+
+    @classmethod
+    def get_release_urls(cls, sources_list):
+        "Get URLs of the Release files of all apt sources in sources_list (text)."
+        result = []
+        for line in sources_list.splitlines():
+            fields = re.sub(r"\[[^]]*\]", "", line).split()
+            if len(fields) >= 3 and fields[0] in ["deb", "deb-src"]:
+                url = "{u}/dists/{d}/Release".format(u=fields[1].rstrip("/"), d=fields[2])
+                if url not in result:
+                    result.append(url)
+        return result
+
+    @classmethod
+    def get_sources_stamp(cls, build_dir, timeout=30):
+        "Stamp of the apt sources' state: Hash over all their Release files."
+        h = hashlib.sha1()
+        for url in cls.get_release_urls(mini_buildd.misc.open_utf8(os.path.join(build_dir, "apt_sources.list")).read()):
+            h.update(urllib2.urlopen(url, timeout=timeout).read())
+        return h.hexdigest()
+
+    def _expired(self, file_name):
+        return time.time() - os.path.getmtime(file_name) > self.max_age * 3600
+
+    def get(self, key):
+        "Get path of cached setup state tar, or None."
+        file_name = os.path.join(self.path, key + ".tar")
+        if os.path.exists(file_name) and not self._expired(file_name):
+            return file_name
+
+    def put(self, key, tar_file):
+        "Move given setup state tar into the cache (atomically), and purge expired entries."
+        mini_buildd.misc.mkdirs(self.path)
+        os.rename(tar_file, os.path.join(self.path, key + ".tar"))
+        for f in glob.glob(os.path.join(self.path, "*.tar")):
+            if self._expired(f):
+                LOG.info("Chroot setup cache: Purging expired: {f}".format(f=f))
+                os.remove(f)
+
+
+class BuildLogParser(object):
+    """
+    Incremental parser for sbuild output.
+
+    Collects sbuild's summary status values, and keeps track of the
+    current build phase (from sbuild's section headers).
+
+    .. note:: In case the build itself writes the same output
+    like 'Status: xyz', sbuild's correct status at the bottom
+    will override this later.
+
+    >>> p = BuildLogParser()
+    >>> for l in ["+----+", "| Update chroot  |", "+----+", "| Not a phase |", "Status: failed", "Status: successful", "Lintian: pass"]:
+    ...     p.parse(l + "\\n")
+    >>> p.phase
+    u'Update chroot'
+    >>> sorted(p.status.items())
+    [(u'Lintian', u'pass'), (u'Status', u'successful')]
+    """
+    STATUS_RE = re.compile("^(Status|Lintian): [^ ]+$")
+
+    def __init__(self):
+        self.phase = "n/a"
+        self.status = {}
+        self._border, self._title = False, None
+
+    def parse(self, line):
+        # Section header: A single '| Title |' line in a box
+        if line.startswith("+-"):
+            if self._title:
+                self.phase = self._title
+            self._border, self._title = True, None
+        else:
+            self._title = line.strip().strip("|").strip() if self._border and line.startswith("| ") else None
+            self._border = False
+
+        if self.STATUS_RE.match(line):
+            LOG.debug("Build log line detected as build status: {l}".format(l=line.strip()))
+            key, _sep, value = line.partition(":")
+            self.status[key] = value.strip()
+
+
 class Build(mini_buildd.misc.Status):
     FAILED = -1
     CHECKING = 0
@@ -22,7 +324,10 @@ class Build(mini_buildd.misc.Status):
     UPLOADING = 2
     UPLOADED = 10
 
-    def __init__(self, breq, gnupg, sbuild_jobs):
+    # Chroot-side stamp file: Setup commands changed all files newer than this (see SetupCache)
+    SETUP_STAMP = "/var/lib/mini-buildd-setup.stamp"
+
+    def __init__(self, breq, gnupg, jobs, setup_cache=None, blob_store=None):
         super(Build, self).__init__(
             stati={self.FAILED: "FAILED",
                    self.CHECKING: "CHECKING",
@@ -32,7 +337,9 @@ class Build(mini_buildd.misc.Status):
 
         self._breq = breq
         self._gnupg = gnupg
-        self._sbuild_jobs = sbuild_jobs
+        self.jobs = jobs
+        self._setup_cache = setup_cache
+        self._blob_store = blob_store
 
         self._build_dir = self._breq.get_spool_dir()
         self._chroot = "mini-buildd-{d}-{a}".format(d=self._breq["Base-Distribution"], a=self.architecture)
@@ -49,13 +356,18 @@ class Build(mini_buildd.misc.Status):
 
         self.uploaded = None
 
+        self._log_parser = BuildLogParser()
+        self.logging = False
+
     def __unicode__(self):
         date_format = "%Y-%b-%d %H:%M:%S"
-        return "{s}: [{h}] {k} ({c}): Started {start} ({took} seconds), uploaded {uploaded}: {desc}".format(
+        return "{s}: [{h}] {k} ({c}, parallel={j}, phase {p}): Started {start} ({took} seconds), uploaded {uploaded}: {desc}".format(
             s=self.status,
             h=self.upload_result_to,
             k=self.key,
             c=self._chroot,
+            j=self.jobs,
+            p=self.phase,
             start=self.started.strftime(date_format) if self.started else "n/a",
             took=self.took,
             uploaded=self.uploaded.strftime(date_format) if self.uploaded else "n/a",
@@ -85,6 +397,38 @@ class Build(mini_buildd.misc.Status):
     def upload_result_to(self):
         return self._breq["Upload-Result-To"]
 
+    @property
+    def phase(self):
+        return self._log_parser.phase
+
+    @property
+    def buildlog_path(self):
+        return os.path.join(self._build_dir, self._breq.buildlog_name)
+
+    @property
+    def has_log(self):
+        "If there is a build log (yet)."
+        return os.path.exists(self.buildlog_path)
+
+    # Max bytes per read_log() call (logs may be huge; callers continue from the next offset)
+    READ_LOG_MAX = 1024 * 1024
+
+    def read_log(self, offset=0, size=READ_LOG_MAX):
+        "Read (at most size bytes of the) build log from byte offset (empty if there is no log (yet))."
+        try:
+            with open(self.buildlog_path, "rb") as f:
+                f.seek(offset)
+                return f.read(size)
+        except IOError:
+            return b""
+
+    def get_log_size(self):
+        "Current size of the build log (0 if there is no log (yet))."
+        try:
+            return os.path.getsize(self.buildlog_path)
+        except OSError:
+            return 0
+
     @property
     def sbuildrc_path(self):
         return os.path.join(self._build_dir, ".sbuildrc")
@@ -122,28 +466,16 @@ $apt_allow_unauthenticated = {apt_allow_unauthenticated};
 """.format(apt_allow_unauthenticated=self._breq["Apt-Allow-Unauthenticated"],
            custom_snippet=mini_buildd.misc.open_utf8(os.path.join(self._build_dir, "sbuildrc_snippet"), 'rb').read())).save()
 
-    def _buildlog_to_buildresult(self, buildlog):
+    def _get_chroot_stamp(self):
         """
-        Parse sbuild's summary status from build log.
-
-        .. note:: This will iterate all lines of the build log,
-        and parse out the selection of sbuild's summary status
-        we need.  In case the build log above does write the
-        same output like 'Status: xyz', sbuild's correct status
-        at the bottom will override this later.  Best thing,
-        though, would be if sbuild would eventually provide a
-        better way to get these values.
+        Stamp of the chroot's state: Last checks of the chroot and its source (both update the chroot).
         """
-        regex = re.compile("^(Status|Lintian): [^ ]+$")
-        with mini_buildd.misc.open_utf8(buildlog) as f:
-            for l in f:
-                if regex.match(l):
-                    LOG.debug("Build log line detected as build status: {l}".format(l=l.strip()))
-                    s = l.split(":")
-                    self._bres["Sbuild-" + s[0]] = s[1].strip()
+        chroot = mini_buildd.models.chroot.Chroot.objects.get(source__codename=self._breq["Base-Distribution"], architecture__name=self.architecture)
+        return "{n}:{c}:{s}".format(n=self._chroot, c=chroot.last_checked.isoformat(), s=chroot.source.last_checked.isoformat())
 
     def build(self):
         self._breq.untar(path=self._build_dir)
+        self._breq.untar_blobs(self._blob_store, path=self._build_dir)
         self._generate_sbuildrc()
         self.started = self._get_started_stamp()
 
@@ -157,19 +489,56 @@ $apt_allow_unauthenticated = {apt_allow_unauthenticated};
                     LOG.info("{p}: Found https source: {l}".format(p=self.key, l=apt_line))
                     break
 
+        # Look up chroot setup cache (the key includes the state of chroot and apt sources)
+        setup_state_tar = os.path.join(self._build_dir, "setup_state.tar")
+        cache_key, cached = None, None
+        if self._setup_cache:
+            try:
+                cache_key = self._setup_cache.key(self._build_dir,
+                                                  self._get_chroot_stamp() + ":" + self._setup_cache.get_sources_stamp(self._build_dir))
+                cached = self._setup_cache.get(cache_key)
+            except Exception as e:
+                mini_buildd.setup.log_exception(LOG, "{p}: Chroot setup cache failed (ignoring)".format(p=self.key), e, logging.WARN)
+                cache_key = None
+
         sbuild_cmd = ["sbuild",
                       "--dist={0}".format(self.distribution),
                       "--arch={0}".format(self.architecture),
                       "--chroot={c}".format(c=self._chroot)]
-        sbuild_cmd += apt_transports
+
+        if cache_key and not cached:
+            # Stamp to find all files changed by the setup commands
+            sbuild_cmd += ["--chroot-setup-command=touch {s}".format(s=self.SETUP_STAMP)]
+
+        if cached:
+            # Cached setup state: Just extract; setup commands are skipped
+            LOG.info("{p}: Using chroot setup cache: {k}".format(p=self.key, k=cache_key))
+            shutil.copy(cached, setup_state_tar)
+            sbuild_cmd += ["--chroot-setup-command=tar --extract --file={t} --directory=/".format(t=setup_state_tar)]
+        else:
+            sbuild_cmd += apt_transports
+
         sbuild_cmd += ["--chroot-setup-command=cp {s} /etc/apt/sources.list".format(s=sources_list_file),
                        "--chroot-setup-command=cat /etc/apt/sources.list",
                        "--chroot-setup-command=cp {p}/apt_preferences /etc/apt/preferences".format(p=self._build_dir),
                        "--chroot-setup-command=cat /etc/apt/preferences",
-                       "--chroot-setup-command=apt-key add {p}/apt_keys".format(p=self._build_dir),
-                       "--chroot-setup-command=apt-get --option=Acquire::Languages=none update",
-                       "--chroot-setup-command={p}/chroot_setup_script".format(p=self._build_dir),
-                       "--chroot-setup-command=apt-cache policy",
+                       "--chroot-setup-command=apt-key add {p}/apt_keys".format(p=self._build_dir)]
+
+        if not cached:
+            sbuild_cmd += ["--chroot-setup-command=apt-get --option=Acquire::Languages=none update"]
+            sbuild_cmd += ["--chroot-setup-command={p}/chroot_setup_script".format(p=self._build_dir)]
+            if cache_key:
+                # Save all files changed by the setup commands (the build dir is bind-mounted, i.e. on another file system)
+                save_script = os.path.join(self._build_dir, "setup_state_save")
+                mini_buildd.misc.open_utf8(save_script, "w").write("""\
+#!/bin/sh -e
+find / -xdev -cnewer {s} ! -type d ! -path {s} ! -path '/tmp/*' ! -name lock ! -path '*/partial/*' -print0 | tar --create --null --no-recursion --files-from=- --file={t}
+rm -f {s}
+""".format(s=self.SETUP_STAMP, t=setup_state_tar))
+                os.chmod(save_script, stat.S_IRWXU)
+                sbuild_cmd += ["--chroot-setup-command={s}".format(s=save_script)]
+
+        sbuild_cmd += ["--chroot-setup-command=apt-cache policy",
                        "--build-dep-resolver={r}".format(r=self._breq["Build-Dep-Resolver"]),
                        "--keyid={k}".format(k=self._gnupg.get_first_sec_key().key_id),
                        "--nolog", "--log-external-command-output", "--log-external-command-error"]
@@ -188,19 +557,42 @@ $apt_allow_unauthenticated = {apt_allow_unauthenticated};
 
         # Actually run sbuild
         mini_buildd.misc.sbuild_keys_workaround()
-        buildlog = os.path.join(self._build_dir, self._breq.buildlog_name)
+        buildlog = self.buildlog_path
         LOG.info("{p}: Running sbuild: {c}".format(p=self.key, c=" ".join(sbuild_cmd)))
-        with mini_buildd.misc.open_utf8(buildlog, "w") as l:
-            retval = subprocess.call(sbuild_cmd,
-                                     cwd=self._build_dir,
-                                     env=mini_buildd.misc.taint_env({"HOME": self._build_dir,
-                                                                     "GNUPGHOME": os.path.join(mini_buildd.setup.HOME_DIR, ".gnupg"),
-                                                                     "DEB_BUILD_OPTIONS": "parallel={j}".format(j=self._sbuild_jobs)}),
-                                     stdout=l, stderr=subprocess.STDOUT)
+        self.logging = True
+        try:
+            with open(buildlog, "wb") as l:
+                sbuild = subprocess.Popen(sbuild_cmd,
+                                          cwd=self._build_dir,
+                                          env=mini_buildd.misc.taint_env({"HOME": self._build_dir,
+                                                                          "GNUPGHOME": os.path.join(mini_buildd.setup.HOME_DIR, ".gnupg"),
+                                                                          "DEB_BUILD_OPTIONS": "parallel={j}".format(j=self.jobs)}),
+                                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+                # Tee sbuild's output to the build log (flushed regularly for live readers), and parse it on the fly
+                flushed = time.time()
+                for line in iter(sbuild.stdout.readline, b""):
+                    l.write(line)
+                    if time.time() - flushed > 1.0:
+                        l.flush()
+                        flushed = time.time()
+                    self._log_parser.parse(line.decode(mini_buildd.setup.CHAR_ENCODING, "replace"))
+                retval = sbuild.wait()
+        finally:
+            self.logging = False
+
+        # Save setup state to chroot setup cache
+        if cache_key and not cached and os.path.exists(setup_state_tar):
+            try:
+                self._setup_cache.put(cache_key, setup_state_tar)
+                LOG.info("{p}: Added to chroot setup cache: {k}".format(p=self.key, k=cache_key))
+            except Exception as e:
+                mini_buildd.setup.log_exception(LOG, "{p}: Can't add to chroot setup cache (ignoring)".format(p=self.key), e, logging.WARN)
 
         # Add build results to build request object
         self._bres["Sbuildretval"] = unicode(retval)
-        self._buildlog_to_buildresult(buildlog)
+        for key, value in self._log_parser.status.items():
+            self._bres["Sbuild-" + key] = value
 
         LOG.info("{p}: Sbuild finished: Sbuildretval={r}, Status={s}".format(p=self.key, r=retval, s=self._bres.get("Sbuild-Status")))
         self._bres.add_file(buildlog)
@@ -210,15 +602,19 @@ $apt_allow_unauthenticated = {apt_allow_unauthenticated};
                                                                                             self.architecture))
         if os.path.exists(build_changes_file):
             build_changes = mini_buildd.changes.Changes(build_changes_file)
-            build_changes.tar(tar_path=self._bres.file_path + ".tar")
-            self._bres.add_file(self._bres.file_path + ".tar")
+            codec = build_changes.pick_tar_codec(self._breq.get("Tar-Codecs", "none").split())
+            build_changes.tar(tar_path=self._bres.get_tar_path(codec), codec=codec)
+            self._bres.add_file(self._bres.get_tar_path(codec))
 
         self._bres.save(self._gnupg)
         self.built = self._get_built_stamp()
 
-    def upload(self):
-        hopo = mini_buildd.misc.HoPo(self.upload_result_to)
-        self._bres.upload(hopo)
+    def upload(self, local_queue=None):
+        "Upload build result; if local_queue is given, the result goes to ourselves (no ftp)."
+        if local_queue:
+            self._bres.upload_local(local_queue)
+        else:
+            self._bres.upload(mini_buildd.misc.HoPo(self.upload_result_to))
         self.uploaded = datetime.datetime.now()
 
     def clean(self):
@@ -265,11 +661,11 @@ def build_close(daemon, build):
             del daemon.builds[build.key]
 
 
-def build(daemon_, breq):
+def build(daemon_, breq, jobs):
     build = None
     try:
         # First, get build object. This will automagically set the status right.
-        build = Build(breq, daemon_.model.mbd_gnupg, daemon_.model.sbuild_jobs)
+        build = Build(breq, daemon_.model.mbd_gnupg, jobs, setup_cache=daemon_.chroot_setup_cache, blob_store=daemon_.blob_store)
         daemon_.builds[build.key] = build
 
         # Authorization
@@ -283,7 +679,7 @@ def build(daemon_, breq):
 
         # Try upload
         try:
-            build.upload()
+            build.upload(local_queue=daemon_.incoming_queue if build.upload_result_to == daemon_.model.mbd_get_ftp_hopo().string else None)
             build.set_status(build.UPLOADED)
         except Exception as e:
             mini_buildd.setup.log_exception(LOG, "Upload failed (retry later)", e, logging.WARN)
@@ -299,19 +695,27 @@ def build(daemon_, breq):
     finally:
         if build:
             build_close(daemon_, build)
-        daemon_.build_queue.task_done()
+        daemon_.build_queue.task_done(jobs)
 
 
 def run(daemon_):
     while True:
-        event = daemon_.build_queue.get()
+        event, jobs = daemon_.build_queue.get()
         if event == "SHUTDOWN":
             break
 
         LOG.info("Builder status: {s}.".format(s=daemon_.build_queue))
 
+        try:
+            breq = mini_buildd.changes.Changes(event)
+        except Exception as e:
+            mini_buildd.setup.log_exception(LOG, "Invalid build request (ignoring): {e}".format(e=event), e)
+            daemon_.build_queue.task_done(jobs)
+            continue
+
         mini_buildd.misc.run_as_thread(
             build,
             daemon=True,
             daemon_=daemon_,
-            breq=mini_buildd.changes.Changes(event))
+            breq=breq,
+            jobs=jobs)
@@ -5,12 +5,19 @@ from __future__ import unicode_literals
 
 import os
 import stat
-import glob
+import hashlib
 import logging
 import tarfile
 import socket
 import ftplib
 import re
+import random
+import time
+import urllib2
+import threading
+import Queue
+import subprocess
+import distutils.spawn
 import contextlib
 
 import debian.deb822
@@ -18,6 +25,7 @@ import debian.deb822
 import mini_buildd.setup
 import mini_buildd.misc
 import mini_buildd.gnupg
+import mini_buildd.ftpd
 
 import mini_buildd.models.repository
 import mini_buildd.models.gnupg
@@ -25,6 +33,201 @@ import mini_buildd.models.gnupg
 LOG = logging.getLogger(__name__)
 
 
+class FtpPool(object):
+    """
+    Uploader keeping a pool of logged-in ftp connections per remote.
+
+    Files of one upload are transferred in parallel (up to
+    'parallel' connections), with the changes file always last,
+    when all other files are complete. The changes file's
+    connection is closed right away, as the receiver queues the
+    upload on disconnect.
+
+    Partial uploads of files larger than 'blocksize' are resumed
+    via REST (i.e., a file found on the remote with a smaller
+    size is continued from there); such files already on the
+    remote with the full size are skipped. Smaller files are
+    cheap enough to always be sent in full, so a stale remote
+    file of the same size is never mistaken for the current one.
+
+    Idle connections are kept for 'idle_timeout' seconds.
+    """
+    def __init__(self, parallel=3, blocksize=1024 * 1024, retries=3, idle_timeout=60):
+        self.parallel = parallel
+        self.blocksize = blocksize
+        self.retries = retries
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # (host, port): [(ftp, idle_since), ...]
+        self._idle = {}
+
+    def configure(self, parallel, blocksize):
+        self.parallel = max(1, parallel)
+        self.blocksize = max(8192, blocksize)
+
+    @classmethod
+    def _close(cls, ftp):
+        try:
+            ftp.quit()
+        except Exception:
+            ftp.close()
+
+    def _get(self, hopo):
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get((hopo.host, hopo.port), [])
+            while idle:
+                ftp, since = idle.pop()
+                if now - since < self.idle_timeout:
+                    try:
+                        ftp.voidcmd("NOOP")
+                        return ftp
+                    except Exception as e:
+                        LOG.debug("FTP: Pooled connection to '{h}' dead: {e}".format(h=hopo.host, e=e))
+                self._close(ftp)
+
+        ftp = ftplib.FTP()
+        ftp.connect(hopo.host, hopo.port)
+        ftp.login()
+        ftp.cwd("/incoming")
+        ftp.voidcmd("TYPE I")
+        return ftp
+
+    def _put(self, hopo, ftp):
+        with self._lock:
+            idle = self._idle.setdefault((hopo.host, hopo.port), [])
+            idle.append((ftp, time.time()))
+            while len(idle) > self.parallel:
+                self._close(idle.pop(0)[0])
+
+    def _store(self, hopo, path, remote=None, resume=True, keep=True):
+        """
+        Store one file (as remote path, defaults to the plain file name in incoming), resuming a partial upload.
+
+        With 'keep', the connection goes back to the pool, else it is closed.
+
+        Returns the number of bytes actually transferred.
+        """
+        remote, size = remote or os.path.basename(path), os.path.getsize(path)
+        resume = resume and size > self.blocksize
+        for attempt in range(1, self.retries + 1):
+            ftp = self._get(hopo)
+            try:
+                remote_size = None
+                if resume:
+                    try:
+                        remote_size = ftp.size(remote)
+                    except ftplib.error_perm:
+                        pass
+
+                if remote_size == size:
+                    LOG.info("FTP: '{f}' already on '{h}', skipping.".format(f=remote, h=hopo.host))
+                    transferred = 0
+                else:
+                    rest = remote_size if remote_size and remote_size < size else None
+                    if rest:
+                        LOG.info("FTP: Resuming '{f}' at {r}/{s} bytes.".format(f=remote, r=rest, s=size))
+                    with open(path, "rb") as f:
+                        if rest:
+                            f.seek(rest)
+                        ftp.storbinary("STOR {f}".format(f=remote), f, blocksize=self.blocksize, rest=rest)
+                    transferred = size - (rest or 0)
+                if keep:
+                    self._put(hopo, ftp)
+                else:
+                    self._close(ftp)
+                return transferred
+            except Exception as e:
+                self._close(ftp)
+                if attempt >= self.retries:
+                    raise
+                mini_buildd.setup.log_exception(LOG, "FTP: Uploading '{f}' failed (attempt {a}/{r}), retrying".format(f=remote, a=attempt, r=self.retries), e, logging.WARNING)
+
+    def _store_parallel(self, hopo, files):
+        "Store list of (path, remote) in parallel. Returns list of bytes transferred."
+        todo = Queue.Queue()
+        for f in files:
+            todo.put(f)
+        transferred, errors = [], []
+
+        def worker():
+            while not errors:
+                try:
+                    path, remote = todo.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    LOG.debug("FTP: Uploading file: '{f}'".format(f=path))
+                    transferred.append(self._store(hopo, path, remote))
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _i in range(min(self.parallel, len(files)))]
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        return transferred
+
+    @classmethod
+    def _log_throughput(cls, what, hopo, transferred, start):
+        took = max(time.time() - start, 0.001)
+        LOG.info("FTP: Uploaded {w} ({b} bytes) to '{h}' in {t:.1f}s ({r:.1f} KiB/s).".format(w=what, b=transferred, h=hopo.host, t=took, r=transferred / took / 1024))
+
+    def upload(self, hopo, files, changes):
+        """
+        Upload files in parallel, then the changes file.
+        """
+        start = time.time()
+        transferred = self._store_parallel(hopo, [(f, None) for f in files])
+
+        # Changes last, and always transferred in full (it's the trigger for the receiver, on disconnect)
+        transferred.append(self._store(hopo, changes, resume=False, keep=False))
+        self._log_throughput(os.path.basename(changes), hopo, sum(transferred), start)
+
+    def upload_blobs(self, hopo, blobs):
+        """
+        Upload dict of blobs sha256: path to remote blob store.
+        """
+        start = time.time()
+        transferred = self._store_parallel(hopo, [(path, "/blobs/{s}".format(s=sha256)) for sha256, path in blobs.items()])
+        self._log_throughput("{n} blobs".format(n=len(blobs)), hopo, sum(transferred), start)
+
+
+FTP_POOL = FtpPool()
+
+
+class TarStats(object):
+    """
+    Thread-safe per-codec tar statistics: Number of tars, plain and compressed bytes.
+
+    >>> s = TarStats()
+    >>> s.add("gz", 3000, 1000)
+    >>> s.add("gz", 1000, 1000)
+    >>> s.get()
+    {u'gz': {u'tars': 2, u'tar_size': 2000, u'size': 4000}}
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._codecs = {}
+
+    def add(self, codec, size, tar_size):
+        with self._lock:
+            stats = self._codecs.setdefault(codec, {"tars": 0, "size": 0, "tar_size": 0})
+            stats["tars"] += 1
+            stats["size"] += size
+            stats["tar_size"] += tar_size
+
+    def get(self):
+        with self._lock:
+            return dict([(c, dict(s)) for c, s in self._codecs.items()])
+
+TAR_STATS = TarStats()
+
+
 class Changes(debian.deb822.Changes):
     # Extra mini-buildd changes file types we invent
     TYPE_DEFAULT = 0
@@ -37,6 +240,12 @@ class Changes(debian.deb822.Changes):
     BUILDREQUEST_RE = re.compile("^.+" + TYPES[TYPE_BREQ] + "_[^_]+.changes$")
     BUILDRESULT_RE = re.compile("^.+" + TYPES[TYPE_BRES] + "_[^_]+.changes$")
 
+    # Tar codecs: codec: (file extension, compress command, decompress command). Without commands, tarfile does it.
+    TAR_CODECS = {"none": (".tar", None, None),
+                  "gz": (".tar.gz", None, None),
+                  "xz": (".tar.xz", ["xz", "--compress", "--stdout", "--threads=0"], ["xz", "--decompress", "--stdout"]),
+                  "zstd": (".tar.zst", ["zstd", "--quiet", "--stdout", "-T0"], ["zstd", "--decompress", "--quiet", "--stdout"])}
+
     def __init__(self, file_path):
         self._file_path = file_path
         self._file_name = os.path.basename(file_path)
@@ -208,14 +417,17 @@ class Changes(debian.deb822.Changes):
         >>> c.save(None)
         >>> c["key"] = "Ünicöde «value»"
         >>> c.save(None)
+        >>> c._sha1 == mini_buildd.misc.sha1_of_file(t.name)
+        True
         """
         try:
             LOG.info("Saving changes: {f}".format(f=self._file_path))
-            self.dump(fd=open(self._file_path, "w+"), encoding=mini_buildd.setup.CHAR_ENCODING)
-            LOG.info("Signing changes: {f}".format(f=self._file_path))
+            data = self.dump().encode(mini_buildd.setup.CHAR_ENCODING)
             if gnupg:
-                gnupg.sign(self._file_path)
-            self._sha1 = mini_buildd.misc.sha1_of_file(self._file_path)
+                LOG.info("Signing changes: {f}".format(f=self._file_path))
+                data = gnupg.sign_text(data)
+            mini_buildd.misc.write_atomic(self._file_path, data)
+            self._sha1 = hashlib.sha1(data).hexdigest()
         except:
             # Existence of the file name is used as flag
             if os.path.exists(self._file_path):
@@ -227,28 +439,68 @@ class Changes(debian.deb822.Changes):
         if os.path.exists(upload):
             LOG.info("FTP: '{f}' already uploaded to '{h}'...".format(f=self._file_name, h=mini_buildd.misc.open_utf8(upload).read()))
         else:
-            ftp = ftplib.FTP()
-            ftp.connect(hopo.host, hopo.port)
-            ftp.login()
-            ftp.cwd("/incoming")
-            for fd in self.get_files() + [{"name": self._file_name}]:
-                f = fd["name"]
-                LOG.debug("FTP: Uploading file: '{f}'".format(f=f))
-                ftp.storbinary("STOR {f}".format(f=f), open(os.path.join(os.path.dirname(self._file_path), f), "rb"))
+            FTP_POOL.upload(hopo,
+                            [os.path.join(os.path.dirname(self._file_path), f) for f in self.get_files(key="name")],
+                            self._file_path)
             mini_buildd.misc.open_utf8(upload, "w").write("{h}:{p}".format(h=hopo.host, p=hopo.port))
             LOG.info("FTP: '{f}' uploaded to '{h}'...".format(f=self._file_name, h=hopo.host))
 
-    def upload_buildrequest(self, local_hopo):
+    def upload_local(self, queue, blob_store=None):
+        """
+        Fast path for uploads to ourselves: Hardlink (or copy) all files to incoming, and queue the changes directly.
+
+        The changes is still signed, and verified by the receiver as usual.
+        """
+        upload = os.path.splitext(self._file_path)[0] + ".upload"
+        if os.path.exists(upload):
+            LOG.info("Local: '{f}' already uploaded to '{h}'...".format(f=self._file_name, h=mini_buildd.misc.open_utf8(upload).read()))
+        else:
+            blobs = self.get_blob_paths()
+            blob_store.pin(blobs.keys())
+            for sha256, path in blobs.items():
+                blob_store.add(path, sha256)
+
+            # Changes file last, so the incoming watcher never sees an incomplete upload
+            for fd in self.get_files() + [{"name": self._file_name}]:
+                mini_buildd.misc.link_or_copy(os.path.join(os.path.dirname(self._file_path), fd["name"]),
+                                              os.path.join(mini_buildd.setup.INCOMING_DIR, fd["name"]))
+                LOG.debug("Local: Linked to incoming: '{f}'".format(f=fd["name"]))
+
+            changes = os.path.join(mini_buildd.setup.INCOMING_DIR, self._file_name)
+            if mini_buildd.ftpd.Incoming.claim(changes):
+                queue.put(changes)
+            mini_buildd.misc.open_utf8(upload, "w").write("local")
+            LOG.info("Local: '{f}' queued to ourselves.".format(f=self._file_name))
+
+    def upload_buildrequest(self, local_hopo, local_queue=None, remote_status=None, blob_store=None, gnupg=None):
+        """
+        Upload build request to the best builder (ourselves or a remote).
+
+        With a remote status table given, statuses are taken from
+        there (no extra http calls and db writes per request), and
+        the builder is picked (and a slot reserved) via the table.
+
+        The build request tar is compressed with the first of our
+        preferred codecs (see 'Tar-Codecs') the remote advertises
+        in its status; remotes without blob support get a variant
+        of the build request with all files in a plain tar. Both
+        variants are signed with gnupg; without gnupg, the plain
+        build request is uploaded.
+        """
         arch = self["Architecture"]
         codename = self["Base-Distribution"]
 
-        remotes = {}
+        # Candidates: List of (key, status) tuples
+        candidates = []
+
+        def add_status(key, status):
+            if status and status.running and status.has_chroot(codename, arch):
+                candidates.append((key, status))
+                LOG.debug("Remote[{l}]={r}".format(l=status.load, r=key))
+            return status
 
         def add_remote(remote, update):
-            status = remote.mbd_get_status(update)
-            if status.running and status.has_chroot(codename, arch):
-                remotes[status.load] = status
-                LOG.debug("Remote[{l}]={r}".format(l=status.load, r=remote))
+            return add_status(remote.http, remote.mbd_get_status(update))
 
         def check_remote(remote):
             try:
@@ -257,43 +509,246 @@ class Changes(debian.deb822.Changes):
             except Exception as e:
                 mini_buildd.setup.log_exception(LOG, "Builder check failed", e, logging.WARNING)
 
-        # Always add our own instance as pseudo remote first
-        add_remote(mini_buildd.models.gnupg.Remote(http=local_hopo.string), True)
+        if remote_status:
+            # Our own instance as pseudo remote first, then all active or auto-deactivated remotes
+            local = add_status(local_hopo.string, remote_status.get_local())
+            for r in mini_buildd.models.gnupg.Remote.mbd_get_active_or_auto_reactivate():
+                add_status(r.http, remote_status.get(r))
+        else:
+            # Always add our own instance as pseudo remote first
+            local = add_remote(mini_buildd.models.gnupg.Remote(http=local_hopo.string), True)
 
-        # Check all active or auto-deactivated remotes
-        for r in mini_buildd.models.gnupg.Remote.mbd_get_active_or_auto_reactivate():
-            check_remote(r)
+            # Check all active or auto-deactivated remotes
+            for r in mini_buildd.models.gnupg.Remote.mbd_get_active_or_auto_reactivate():
+                check_remote(r)
 
-        if not remotes:
+        if not candidates:
             raise Exception("No builder found for {c}/{a}".format(c=codename, a=arch))
 
-        for _load, remote in sorted(remotes.items()):
-            try:
-                self.upload(mini_buildd.misc.HoPo(remote.ftp))
-                self.remote_http_url = "http://{r}".format(r=remote.http)
-                return
-            except Exception as e:
-                mini_buildd.setup.log_exception(LOG, "Uploading to '{h}' failed".format(h=remote.ftp), e, logging.WARNING)
+        def upload(remote):
+            if remote is local and local_queue and blob_store:
+                self.upload_local(local_queue, blob_store)
+            else:
+                hopo = mini_buildd.misc.HoPo(remote.ftp)
+                codec = self.pick_tar_codec([c for c in self.get("Tar-Codecs", "none").split() if c in (getattr(remote, "tar_codecs", None) or ["none"])])
+                breq = self.gen_buildrequest_variant(gnupg, codec) if gnupg else self
+                try:
+                    breq.upload_blobs(remote.http, hopo)
+                    breq.upload(hopo)
+                except urllib2.HTTPError as e:
+                    if e.code != 404 or gnupg is None:
+                        raise
+                    LOG.info("Remote '{r}' has no blob support, uploading with full tar.".format(r=remote.http))
+                    self.gen_buildrequest_variant(gnupg, full=True).upload(hopo)
+            self.remote_http_url = "http://{r}".format(r=remote.http)
+
+        if remote_status:
+            while candidates:
+                key, remote = remote_status.pick(candidates)
+                try:
+                    upload(remote)
+                    return
+                except Exception as e:
+                    remote_status.release(key)
+                    candidates.remove((key, remote))
+                    mini_buildd.setup.log_exception(LOG, "Uploading to '{h}' failed".format(h=remote.ftp), e, logging.WARNING)
+        else:
+            for _score, _random, _key, remote in sorted([(s.get_score(), random.random(), k, s) for k, s in candidates]):
+                try:
+                    upload(remote)
+                    return
+                except Exception as e:
+                    mini_buildd.setup.log_exception(LOG, "Uploading to '{h}' failed".format(h=remote.ftp), e, logging.WARNING)
 
         raise Exception("Buildrequest upload failed for {a}/{c}".format(a=arch, c=codename))
 
-    def tar(self, tar_path, add_files=None):
-        with contextlib.closing(tarfile.open(tar_path, "w")) as tar:
-            tar_add = lambda f: tar.add(f, arcname=os.path.basename(f))
-            tar_add(self._file_path)
-            for f in self.get_files():
-                tar_add(os.path.join(os.path.dirname(self._file_path), f["name"]))
-            if add_files:
-                for f in add_files:
-                    tar_add(f)
+    def add_blob(self, file_name):
+        """
+        Add file as blob: Not part of the tar, but transferred via blob negotiation (see upload_blobs()).
+
+        The file must be in the same directory as the changes file.
+
+        >>> import tempfile
+        >>> d = tempfile.mkdtemp()
+        >>> open(os.path.join(d, "hello_1.0.orig.tar.gz"), "w").write("orig")
+        >>> c = Changes(os.path.join(d, "hello_1.0-1_mini-buildd-buildrequest_i386.changes"))
+        >>> c.add_blob(os.path.join(d, "hello_1.0.orig.tar.gz"))
+        >>> c.get_blobs()
+        [{u'sha256': u'14e0ffdc8215c81da0cde40f581237ee35177ddac4f1fc7613cad3004798d25f', u'name': u'hello_1.0.orig.tar.gz', u'size': 4}]
+        """
+        self["Blobs"] = self.get("Blobs", "") + "\n {s} {b} {n}".format(s=mini_buildd.misc.CHECKSUMS.get(file_name, "sha256"),
+                                                                        b=os.path.getsize(file_name),
+                                                                        n=os.path.basename(file_name))
+
+    def get_blobs(self):
+        result = []
+        for line in self.get("Blobs", "").splitlines():
+            if line.strip():
+                sha256, size, name = line.split()
+                result.append({"sha256": sha256, "size": int(size), "name": name})
+        return result
+
+    def get_blob_paths(self):
+        "Get dict sha256: path of our blob files."
+        return dict([(b["sha256"], os.path.join(os.path.dirname(self._file_path), b["name"])) for b in self.get_blobs()])
+
+    def upload_blobs(self, http, hopo):
+        """
+        Blob negotiation: Ask remote which of our blobs it lacks, and upload only these.
+        """
+        blobs = self.get_blob_paths()
+        if blobs:
+            url = "http://{h}/mini_buildd/blobs?missing={s}".format(h=http, s=",".join(blobs.keys()))
+            missing = urllib2.urlopen(url, timeout=30).read().split()
+            LOG.info("Blobs: {m}/{n} missing on '{h}'.".format(m=len(missing), n=len(blobs), h=http))
+            FTP_POOL.upload_blobs(hopo, dict([(s, p) for s, p in blobs.items() if s in missing]))
+
+    def untar_blobs(self, blob_store, path):
+        "Get all our blobs from blob store to path."
+        for b in self.get_blobs():
+            file_name = os.path.join(path, b["name"])
+            blob_store.get(b["sha256"], file_name)
+            if os.path.getsize(file_name) != b["size"] or mini_buildd.misc.CHECKSUMS.get(file_name, "sha256") != b["sha256"]:
+                raise Exception("Blob mismatch: {n}".format(n=b["name"]))
+
+    def gen_buildrequest_variant(self, gnupg, codec="none", full=False):
+        """
+        Get variant of this build request with the tar compressed with codec, and optionally all blobs in the tar (for remotes without blob support).
+
+        A variant is generated (and signed) once, in a subdir named after it.
+
+        >>> import tempfile
+        >>> d = tempfile.mkdtemp()
+        >>> open(os.path.join(d, "hello_1.0.orig.tar.gz"), "w").write("orig")
+        >>> c = Changes(os.path.join(d, "hello_1.0-1_mini-buildd-buildrequest_i386.changes"))
+        >>> c["Source"] = "hello"
+        >>> c.add_blob(os.path.join(d, "hello_1.0.orig.tar.gz"))
+        >>> c.save()
+        >>> c.tar(c.get_tar_path())
+        >>> c.add_file(c.get_tar_path())
+        >>> c.save()
+        >>> c.gen_buildrequest_variant(None) is c
+        True
+        >>> g = c.gen_buildrequest_variant(None, codec="gz")
+        >>> g.get_files(key="name"), len(g.get_blobs())
+        ([u'hello_1.0-1_mini-buildd-buildrequest_i386.changes.tar.gz'], 1)
+        >>> f = c.gen_buildrequest_variant(None, full=True)
+        >>> "Blobs" in f, f.get_files(key="name")
+        (False, [u'hello_1.0-1_mini-buildd-buildrequest_i386.changes.tar'])
+        >>> f.untar(os.path.join(d, "x"))
+        >>> sorted(os.listdir(os.path.join(d, "x")))
+        [u'hello_1.0-1_mini-buildd-buildrequest_i386.changes', u'hello_1.0.orig.tar.gz']
+        """
+        if codec == "none" and not full:
+            return self
+
+        path = os.path.join(os.path.dirname(self._file_path), codec + ("-full" if full else ""))
+        variant = Changes(os.path.join(path, self._file_name))
+        if variant.is_new():
+            mini_buildd.misc.mkdirs(path)
+            for k, v in self.items():
+                if k not in ["Files", "Blobs"]:
+                    variant[k] = v
+
+            with contextlib.closing(mini_buildd.misc.TmpDir()) as t:
+                self.untar(t.tmpdir)
+                for blob in self.get_blob_paths().values():
+                    if full:
+                        mini_buildd.misc.link_or_copy(blob, os.path.join(t.tmpdir, os.path.basename(blob)))
+                    else:
+                        mini_buildd.misc.link_or_copy(blob, os.path.join(path, os.path.basename(blob)))
+                        variant.add_blob(os.path.join(path, os.path.basename(blob)))
+                self._tar_files(variant.get_tar_path(codec), [os.path.join(t.tmpdir, f) for f in sorted(os.listdir(t.tmpdir))], codec)
+            variant.add_file(variant.get_tar_path(codec))
+            variant.save(gnupg)
+        return variant
+
+    @classmethod
+    def has_tar_codec(cls, codec):
+        """
+        Check if we can (de)compress tars with this codec.
+
+        >>> Changes.has_tar_codec("gz"), Changes.has_tar_codec("lzip")
+        (True, False)
+        """
+        return codec in cls.TAR_CODECS and (cls.TAR_CODECS[codec][1] is None or distutils.spawn.find_executable(cls.TAR_CODECS[codec][1][0]) is not None)
+
+    @classmethod
+    def pick_tar_codec(cls, codecs):
+        """
+        Pick first codec from list we support ('none' if none).
+
+        >>> Changes.pick_tar_codec(["lzip", "gz", "none"])
+        u'gz'
+        >>> Changes.pick_tar_codec([])
+        u'none'
+        """
+        for codec in codecs:
+            if cls.has_tar_codec(codec):
+                return codec
+        return "none"
+
+    def get_tar_path(self, codec="none"):
+        return self._file_path + self.TAR_CODECS[codec][0]
+
+    @classmethod
+    def _tar_files(cls, tar_path, files, codec="none"):
+        "Create tar from files (flat), compressed with codec."
+        _ext, compress, _decompress = cls.TAR_CODECS[codec]
+        plain_path = tar_path + ".plain" if compress else tar_path
+        with contextlib.closing(tarfile.open(plain_path, "w:gz" if codec == "gz" else "w")) as tar:
+            for f in files:
+                tar.add(f, arcname=os.path.basename(f))
+            size = sum([m.size for m in tar.getmembers()])
+
+        if compress:
+            with open(plain_path, "rb") as i, open(tar_path, "wb") as o:
+                subprocess.check_call(compress, stdin=i, stdout=o)
+            os.remove(plain_path)
+
+        tar_size = os.path.getsize(tar_path)
+        TAR_STATS.add(codec, size, tar_size)
+        LOG.info("Tar ({c}): {f}: {s} -> {t} bytes (ratio {r:.1f}).".format(c=codec, f=os.path.basename(tar_path), s=size, t=tar_size, r=float(size) / max(1, tar_size)))
+
+    def tar(self, tar_path, add_files=None, exclude=None, codec="none"):
+        """
+        Create tar, compressed with codec.
+
+        >>> import tempfile
+        >>> d = tempfile.mkdtemp()
+        >>> c = Changes(os.path.join(d, "test_1.0_mini-buildd-buildrequest_i386.changes"))
+        >>> c["Source"] = "test"
+        >>> c.save()
+        >>> c.tar(c.get_tar_path("gz"), codec="gz")
+        >>> c.add_file(c.get_tar_path("gz"))
+        >>> c.untar(os.path.join(d, "x"))
+        >>> os.listdir(os.path.join(d, "x"))
+        [u'test_1.0_mini-buildd-buildrequest_i386.changes']
+        """
+        self._tar_files(tar_path,
+                        [self._file_path] +
+                        [os.path.join(os.path.dirname(self._file_path), f["name"]) for f in self.get_files() if f["name"] not in (exclude or [])] +
+                        (add_files or []),
+                        codec)
 
     def untar(self, path):
-        tar_file = self._file_path + ".tar"
-        if os.path.exists(tar_file):
-            with contextlib.closing(tarfile.open(tar_file, "r")) as tar:
-                tar.extractall(path=path)
-        else:
-            LOG.info("No tar file (skipping): {f}".format(f=tar_file))
+        """
+        Extract our tar (with any codec) to path.
+        """
+        for codec, (ext, _compress, decompress) in self.TAR_CODECS.items():
+            tar_file = self._file_path + ext
+            if os.path.basename(tar_file) in self.get_files(key="name") or (codec == "none" and os.path.exists(tar_file)):
+                if decompress:
+                    proc = subprocess.Popen(decompress + [tar_file], stdout=subprocess.PIPE)
+                    with contextlib.closing(tarfile.open(fileobj=proc.stdout, mode="r|")) as tar:
+                        tar.extractall(path=path)
+                    if proc.wait() != 0:
+                        raise Exception("Decompressing failed ({c}): {f}".format(c=codec, f=tar_file))
+                else:
+                    with contextlib.closing(tarfile.open(tar_file, "r")) as tar:
+                        tar.extractall(path=path)
+                return
+        LOG.info("No tar file (skipping): {f}".format(f=self._file_path))
 
     def move_to_pkglog(self, installed):
         logdir = self.get_pkglog_dir(installed, relative=False)
@@ -301,6 +756,7 @@ class Changes(debian.deb822.Changes):
             os.makedirs(logdir)
 
         LOG.info("Moving changes to package log: '{f}'->'{l}'".format(f=self._file_path, l=logdir))
+        variants = []
         for fd in [{"name": self._file_name}] + self.get_files():
             f = fd["name"]
             f_abs = os.path.join(os.path.dirname(self._file_path), f)
@@ -309,10 +765,24 @@ class Changes(debian.deb822.Changes):
             if logdir and (not installed or re.match(r"(.*\.buildlog$|.*changes$)", f)):
                 LOG.info("Moving '{f}' to '{d}'". format(f=f, d=logdir))
                 os.rename(f_abs, os.path.join(logdir, f))
+                # Precompressed variant for http serving
+                if re.match(r"(.*\.buildlog$|.*changes$)", f):
+                    variants.append(os.path.join(logdir, f))
             else:
                 LOG.info("Removing '{f}'". format(f=f))
                 mini_buildd.misc.skip_if_keep_in_debug(os.remove, f_abs)
 
+        # Compress in the background (http serving uses the variant only once it's there)
+        def gen_gzip_variants(file_names):
+            for file_name in file_names:
+                try:
+                    mini_buildd.misc.gen_gzip_variant(file_name)
+                except Exception as e:
+                    mini_buildd.setup.log_exception(LOG, "Can't generate gzip variant for '{f}' (ignoring)".format(f=file_name), e, logging.WARN)
+
+        if variants:
+            mini_buildd.misc.run_as_thread(gen_gzip_variants, daemon=True, file_names=variants)
+
     def remove(self):
         LOG.info("Removing changes: '{f}'".format(f=self._file_path))
         for fd in [{"name": self._file_name}] + self.get_files():
@@ -329,15 +799,18 @@ class Changes(debian.deb822.Changes):
         # - Check md5 against possible pool files.
         # - Add missing from pool (i.e., orig.tar.gz).
         # - make sure all files from dsc are actually available
-        files_from_pool = []
+        # - All dsc files go as blobs.
+        blob_files = []
         dsc = debian.deb822.Dsc(open(self.dsc_file_name))
+        pool_index = repository.mbd_get_pool_index()
         for f in dsc["Files"]:
             in_changes = f["name"] in self.get_files(key="name")
             from_pool = False
-            for p in glob.glob(os.path.join(repository.mbd_get_path(), "pool", "*", "*", self["Source"], f["name"])):
-                if f["md5sum"] == mini_buildd.misc.md5_of_file(p):
+            for e in pool_index.find(f["name"], source=self["Source"]):
+                p = pool_index.get_path(e)
+                if f["md5sum"] == e["md5"]:
                     if not in_changes:
-                        files_from_pool.append(p)
+                        blob_files.append(p)
                         from_pool = True
                         LOG.info("Buildrequest: File added from pool: {f}".format(f=p))
                 else:
@@ -346,6 +819,8 @@ class Changes(debian.deb822.Changes):
             # Check that this file is available
             if not in_changes and not from_pool:
                 raise Exception("Missing file '{f}' neither in upload, nor in pool (use '-sa' for uploads with new upstream)".format(f=f["name"]))
+            if in_changes:
+                blob_files.append(os.path.join(os.path.dirname(self._file_path), f["name"]))
 
         breq_dict = {}
         for ao in dist.architectureoption_set.all():
@@ -369,14 +844,22 @@ class Changes(debian.deb822.Changes):
                 os.chmod(chroot_setup_script, stat.S_IRWXU)
                 mini_buildd.misc.open_utf8(os.path.join(path, "sbuildrc_snippet"), "w").write(dist.mbd_get_sbuildrc_snippet(ao.architecture.name))
 
-                # Generate tar from original changes
-                self.tar(tar_path=breq.file_path + ".tar",
+                # Generate (plain) tar from original changes (without the blobs); compressed variants are made per remote on upload
+                self.tar(tar_path=breq.get_tar_path(),
                          add_files=[os.path.join(path, "apt_sources.list"),
                                     os.path.join(path, "apt_preferences"),
                                     os.path.join(path, "apt_keys"),
                                     chroot_setup_script,
-                                    os.path.join(path, "sbuildrc_snippet")] + files_from_pool)
-                breq.add_file(breq.file_path + ".tar")
+                                    os.path.join(path, "sbuildrc_snippet")],
+                         exclude=[os.path.basename(f) for f in blob_files])
+                breq.add_file(breq.get_tar_path())
+                # Codecs we prefer for build request tars, and accept for the build result tar, in order of preference
+                breq["Tar-Codecs"] = " ".join([c for c in daemon.tar_codecs if self.has_tar_codec(c)] + ["none"])
+
+                for f in blob_files:
+                    blob = os.path.join(path, os.path.basename(f))
+                    mini_buildd.misc.link_or_copy(f, blob)
+                    breq.add_blob(blob)
 
                 breq["Upload-Result-To"] = daemon.mbd_get_ftp_hopo().string
                 breq["Base-Distribution"] = dist.base_source.codename
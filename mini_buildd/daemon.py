@@ -4,12 +4,13 @@ from __future__ import unicode_literals
 import os
 import re
 import time
+import random
 import shutil
 import glob
 import tempfile
 import threading
 import subprocess
-import Queue
+import socket
 import collections
 import urllib2
 import logging
@@ -280,26 +281,57 @@ class DSTPackage(mini_buildd.misc.TmpDir):
 
 class Keyrings(object):
     """
-    Hold/manage all gnupg keyrings (for remotes and all repository uploaders).
+    Hold/manage all gnupg keys (for remotes and all repository uploaders).
+
+    All keys live in one shared keyring. Updates only import
+    new (or changed) and delete vanished keys; authorization is
+    a lookup of the signing key's fingerprint in the set of
+    fingerprints authorized for remotes, or per repository.
     """
+    class Authorizer(object):
+        "Verify signatures, and authorize against a set of fingerprints."
+        def __init__(self, gnupg, fingerprints):
+            self._gnupg = gnupg
+            self.fingerprints = fingerprints
+
+        def verify(self, signature, data=None):
+            fingerprint = self._gnupg.verify(signature, data)
+            if fingerprint not in self.fingerprints:
+                raise Exception("GnuPG authorization failed: Key {f} not authorized.".format(f=fingerprint))
+            return fingerprint
+
+        def get_pub_colons(self, type_regex="pub"):
+            return self._gnupg.get_pub_colons(type_regex=type_regex, identities=sorted(self.fingerprints)) if self.fingerprints else iter([])
+
     def __init__(self):
-        self._our_pub_key = get().model.mbd_get_pub_key()
-        self._remotes = self._gen_remotes()
-        self._uploaders = self._gen_uploaders()
-        self._needs_update = False
+        # Keyrings are used by parallel packager workers; protects the update
+        self._lock = threading.Lock()
+        self._gnupg = mini_buildd.gnupg.TmpGnuPG()
+        # fingerprint: key (all keys in the shared keyring)
+        self._keys = {}
+        # keyring file: (mtime, fingerprints)
+        self._keyring_fingerprints = {}
+        self._remotes = None
+        self._uploaders = None
+        self._needs_update = True
+        self._update()
 
     def set_needs_update(self):
         self._needs_update = True
 
     def close(self):
-        self._remotes.close()
-        for u in self._uploaders.values():
-            u.close()
+        self._gnupg.close()
 
     def _update(self):
-        if self._needs_update:
-            self.close()
-            self.__init__()
+        with self._lock:
+            if self._needs_update:
+                # Reset before generating so updates requested meanwhile are not lost; re-set if generation fails
+                self._needs_update = False
+                try:
+                    self._gen()
+                except:
+                    self._needs_update = True
+                    raise
 
     def get_remotes(self):
         self._update()
@@ -309,26 +341,232 @@ class Keyrings(object):
         self._update()
         return self._uploaders
 
-    def _gen_remotes(self):
-        remotes = mini_buildd.gnupg.TmpGnuPG()
-        # keyring["remotes"]: Remotes keyring to authorize buildrequests and buildresults
-        # Always add our own key
-        if self._our_pub_key:
-            remotes.add_pub_key(self._our_pub_key)
+    def _get_keyring_fingerprints(self, keyring):
+        mtime = os.path.getmtime(keyring) if os.path.exists(keyring) else None
+        cached = self._keyring_fingerprints.get(keyring)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, self._gnupg.get_keyring_fingerprints(keyring) if mtime else set())
+            self._keyring_fingerprints[keyring] = cached
+        return cached[1]
+
+    def _gen(self):
+        keys, remotes, uploaders = {}, set(), {}
+
+        def add_key(obj, fingerprints):
+            if obj.key_fingerprint and obj.key:
+                keys[obj.key_fingerprint] = obj.key
+                fingerprints.add(obj.key_fingerprint)
+                LOG.debug("Key authorized: {k}: {n}".format(k=obj.key_long_id, n=obj.key_name))
+            else:
+                LOG.warn("Skipping key w/o fingerprint (needs prepare?): {o}".format(o=obj))
+
+        # Always add our own key (for remotes, and for internal builds for all repositories)
+        our_fingerprint, our_pub_key = get().model.mbd_gnupg_fingerprint, get().model.mbd_get_pub_key()
+        our_fingerprints = set()
+        if our_fingerprint and our_pub_key:
+            keys[our_fingerprint] = our_pub_key
+            our_fingerprints.add(our_fingerprint)
+
+        # Remotes: Authorize buildrequests and buildresults
+        remotes |= our_fingerprints
         for r in mini_buildd.models.gnupg.Remote.mbd_get_active_or_auto_reactivate():
-            remotes.add_pub_key(r.key)
-            LOG.info("Remote key added for '{r}': {k}: {n}".format(r=r, k=r.key_long_id, n=r.key_name))
-        return remotes
+            add_key(r, remotes)
 
-    def _gen_uploaders(self):
-        "All uploader keyrings for each repository."
-        uploaders = {}
+        # Uploaders: Per repository, from django users and extra keyrings
         for r in mini_buildd.models.repository.Repository.mbd_get_active():
-            uploaders[r.identity] = r.mbd_get_uploader_keyring()
-            # Always add our key too for internal builds
-            if self._our_pub_key:
-                uploaders[r.identity].add_pub_key(self._our_pub_key)
-        return uploaders
+            uploaders[r.identity] = set(our_fingerprints)
+            for keyring in r.mbd_get_extra_uploader_keyrings():
+                self._gnupg.add_keyring(keyring)
+                uploaders[r.identity] |= self._get_keyring_fingerprints(keyring)
+
+        for u in mini_buildd.models.gnupg.Uploader.objects.filter(user__is_active=True).prefetch_related("may_upload_to"):
+            if u.mbd_is_active():
+                authorized = set()
+                add_key(u, authorized)
+                for r in u.may_upload_to.all():
+                    if r.identity in uploaders:
+                        uploaders[r.identity] |= authorized
+
+        # Apply deltas to the shared keyring
+        added = [f for f in keys if self._keys.get(f) != keys[f]]
+        removed = [f for f in self._keys if f not in keys]
+        failed = set()
+        if added:
+            try:
+                self._gnupg.add_pub_key("\n".join([keys[f] for f in added]))
+            except Exception as e:
+                mini_buildd.setup.log_exception(LOG, "Bulk key import failed, retrying per key", e, logging.WARN)
+                for f in added:
+                    try:
+                        self._gnupg.add_pub_key(keys[f])
+                    except Exception as e:
+                        failed.add(f)
+                        mini_buildd.setup.log_exception(LOG, "Key import failed: {f}".format(f=f), e)
+
+        # gpg fails (exit 2) on missing keys: Only check/delete what is actually in the keyring
+        present = self._gnupg.get_pub_fingerprints()
+        failed |= set([f for f in added if f not in present])
+        self._gnupg.remove_pub_keys([f for f in removed if f in present])
+
+        # Failed imports are retried with the next update; keys not in the keyring at all are not authorized
+        for f in failed:
+            if f in present and f in self._keys:
+                keys[f] = self._keys[f]
+            else:
+                del keys[f]
+            if f not in present:
+                remotes.discard(f)
+                for fingerprints in uploaders.values():
+                    fingerprints.discard(f)
+        if failed:
+            LOG.warn("Keyrings: {n} key imports failed (will retry): {f}".format(n=len(failed), f=" ".join(sorted(failed))))
+            self._needs_update = True
+        self._keys = keys
+
+        self._remotes = self.Authorizer(self._gnupg, remotes)
+        self._uploaders = dict([(i, self.Authorizer(self._gnupg, f)) for i, f in uploaders.items()])
+        LOG.info("Keyrings updated: {a} keys added/changed, {r} removed, {n} total".format(a=len(added), r=len(removed), n=len(keys)))
+
+
+class RemoteStatus(object):
+    """
+    In-memory table of remote statuses, refreshed concurrently in the background.
+
+    Build request dispatch reads statuses from here; entries older
+    than the TTL are refreshed on access. The database (the
+    remote's check state and pickled status) is only written
+    when the state of a remote actually changes.
+    """
+    # Reservations are dropped with the first status taken this much after the reservation
+    RESERVATION_GRACE = 5.0
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # http: (timestamp, status or None if unusable)
+        self._table = {}
+        # http: [timestamp, ...]
+        self._reserved = {}
+        self._shutdown = threading.Event()
+
+    @classmethod
+    def _signature(cls, status):
+        "State of a remote status we care about (volatile values like load excluded)."
+        return (status.version,
+                status.running,
+                sorted(status.remotes),
+                sorted([(codename, sorted(archs)) for codename, archs in status.chroots.items()]))
+
+    def _refresh(self, remote):
+        try:
+            status = remote.mbd_fetch_status()
+            usable = status.running and get().model.mbd_get_http_hopo().string in status.remotes
+        except Exception as e:
+            mini_buildd.setup.log_exception(LOG, "Remote '{r}': Status update failed".format(r=remote.http), e, logging.WARNING)
+            status, usable = None, False
+
+        # Write to db (via a full check) only on change
+        if usable != remote.mbd_is_active() or (status and self._signature(status) != self._signature(remote.mbd_get_status())):
+            try:
+                LOG.info("Remote '{r}': State changed, running check.".format(r=remote.http))
+                mini_buildd.models.gnupg.Remote.Admin.mbd_check(None, remote, force=True)
+            except Exception as e:
+                mini_buildd.setup.log_exception(LOG, "Remote '{r}': Check failed".format(r=remote.http), e, logging.WARNING)
+                usable = False
+
+        with self._lock:
+            self._table[remote.http] = (time.time(), status if usable else None)
+        return status if usable else None
+
+    def get(self, remote):
+        "Get usable status of remote (or None); refreshes synchronously if older than TTL."
+        with self._lock:
+            stamp, status = self._table.get(remote.http, (0, None))
+        if time.time() - stamp > self.ttl:
+            return self._refresh(remote)
+        return status
+
+    def pick(self, candidates):
+        """
+        Pick builder from list of (key, status) candidates, and reserve a slot there.
+
+        Weighted least-loaded choice (see api.Status.get_score()),
+        counting in our own reservations (builds sent there the
+        status does not yet know about); ties are broken
+        randomly.
+        """
+        with self._lock:
+            scored = []
+            for key, status in candidates:
+                # Local status is always fresh
+                stamp = self._table.get(key, (time.time(), None))[0]
+                reserved = [r for r in self._reserved.get(key, []) if r > stamp - self.RESERVATION_GRACE]
+                self._reserved[key] = reserved
+                scored.append((status.get_score(len(reserved)), random.random(), key, status))
+
+            _score, _random, key, status = min(scored)
+            self._reserved[key].append(time.time())
+            LOG.info("Picked builder '{k}' (score {s}).".format(k=key, s=_score))
+            return key, status
+
+    def release(self, key):
+        "Release a reservation (when the upload failed)."
+        with self._lock:
+            if self._reserved.get(key):
+                self._reserved[key].pop()
+
+    @classmethod
+    def get_local(cls):
+        "Get status of our own instance (in-process)."
+        status = mini_buildd.api.Status({})
+        status.run(get())
+        return status
+
+    def refresh_all(self):
+        threads = [mini_buildd.misc.run_as_thread(self._refresh, daemon=True, remote=r) for r in mini_buildd.models.gnupg.Remote.mbd_get_active_or_auto_reactivate()]
+        for t in threads:
+            t.join()
+
+    def run(self):
+        while not self._shutdown.wait(self.ttl):
+            self.refresh_all()
+
+    def shutdown(self):
+        self._shutdown.set()
+
+
+def _handle_invalid_changes(event, changes, exception):
+    """
+    Handle an invalid incoming changes file: Log, try to notify, and try to remove it from incoming.
+    """
+    mini_buildd.setup.log_exception(LOG, "Invalid changes file", exception)
+
+    # Try to notify
+    try:
+        subject = "INVALID CHANGES: {c}: {e}".format(c=event, e=exception)
+        body = mini_buildd.misc.open_utf8(event, "r").read()
+        get().model.mbd_notify(subject, body)
+    except Exception as e:
+        mini_buildd.setup.log_exception(LOG, "Invalid changes notify failed", e)
+
+    # Try to clean up
+    try:
+        if changes:
+            changes.remove()
+        else:
+            os.remove(event)
+    except Exception as e:
+        mini_buildd.setup.log_exception(LOG, "Invalid changes cleanup failed", e)
+
+
+def _run_packager(_source, changes):
+    "Packager pool worker function: Run packager for a user upload or build result."
+    try:
+        mini_buildd.packager.run(
+            daemon=get(),
+            changes=changes)
+    except Exception as e:
+        _handle_invalid_changes(changes.file_path, changes, e)
 
 
 def run():
@@ -339,64 +577,59 @@ def run():
     ftpd_thread = mini_buildd.misc.run_as_thread(
         mini_buildd.ftpd.run,
         bind=get().model.ftpd_bind,
-        queue=get().incoming_queue)
+        queue=get().incoming_queue,
+        blob_store=get().blob_store,
+        is_remote=get().is_remote_address)
 
     builder_thread = mini_buildd.misc.run_as_thread(
         mini_buildd.builder.run,
         daemon_=get())
 
+    # Incoming watcher: Changes not uploaded via ftp (rsync, scp, local copies)
+    incoming_watcher = mini_buildd.ftpd.IncomingWatcher(get().incoming_queue, mode=get().model.incoming_watcher)
+    incoming_watcher_thread = mini_buildd.misc.run_as_thread(incoming_watcher.run)
+
+    remote_status_thread = mini_buildd.misc.run_as_thread(get().remote_status.run)
+
+    # Packager: Events for the same source package are serialized, all others run in parallel.
+    # Events are only taken from incoming when a packager worker is free, so incoming's scheduling applies.
+    get().packager_pool = mini_buildd.misc.KeyedWorkerPool(get().model.packager_workers, _run_packager, name="packager",
+                                                           on_release=get().incoming_queue.wakeup)
+
     while True:
-        event = get().incoming_queue.get()
+        event = get().incoming_queue.get(may_package=get().packager_pool.has_free_worker)
         if event == "SHUTDOWN":
             break
 
+        changes = None
         try:
-            LOG.info("Status: {0} active packages, {1} changes waiting in incoming.".
-                     format(len(get().packages), get().incoming_queue.qsize()))
+            LOG.info("Status: {0} active packages, {1} changes waiting in incoming, packager {2}.".
+                     format(len(get().packages), get().incoming_queue.qsize(), get().packager_pool))
 
-            changes = None
             changes = mini_buildd.changes.Changes(event)
 
             if changes.type == changes.TYPE_BREQ:
-                # Build request: builder
-
-                def queue_buildrequest(event):
-                    "Queue in extra thread so we don't block here in case builder is busy."
-                    get().build_queue.put(event)
-                mini_buildd.misc.run_as_thread(queue_buildrequest, daemon=True, event=event)
+                # Build request: builder (the scheduler never blocks on put)
+                get().build_queue.put(event)
 
             else:
                 # User upload or build result: packager
-                mini_buildd.packager.run(
-                    daemon=get(),
-                    changes=changes)
+                get().packager_pool.put(changes["Source"], changes)
 
         except Exception as e:
-            mini_buildd.setup.log_exception(LOG, "Invalid changes file", e)
-
-            # Try to notify
-            try:
-                subject = "INVALID CHANGES: {c}: {e}".format(c=event, e=e)
-                body = mini_buildd.misc.open_utf8(event, "r").read()
-                get().model.mbd_notify(subject, body)
-            except Exception as e:
-                mini_buildd.setup.log_exception(LOG, "Invalid changes notify failed", e)
-
-            # Try to clean up
-            try:
-                if changes:
-                    changes.remove()
-                else:
-                    os.remove(event)
-            except Exception as e:
-                mini_buildd.setup.log_exception(LOG, "Invalid changes cleanup failed", e)
+            _handle_invalid_changes(event, changes, e)
 
         finally:
             get().incoming_queue.task_done()
 
+    get().packager_pool.shutdown()
     get().build_queue.put("SHUTDOWN")
     mini_buildd.ftpd.shutdown()
+    incoming_watcher.shutdown()
+    get().remote_status.shutdown()
     builder_thread.join()
+    incoming_watcher_thread.join()
+    remote_status_thread.join()
     ftpd_thread.join()
 
     # keyrings.close() is not called implicitly; this leaves tmp files around.
@@ -423,6 +656,12 @@ class Daemon(object):
         self.keyrings = None
         self.incoming_queue = None
         self.build_queue = None
+        self.chroot_setup_cache = None
+        self.remote_status = None
+        self.blob_store = None
+        self._remote_addresses = (0, set())
+        self.packager_pool = None
+        self.journal = None
         self.packages = None
         self.builds = None
         self.last_packages = None
@@ -445,9 +684,28 @@ class Daemon(object):
             self.keyrings = Keyrings()
         else:
             self.keyrings.set_needs_update()
-        self.incoming_queue = Queue.Queue()
-        self.build_queue = mini_buildd.misc.BlockQueue(maxsize=self.model.build_queue_size)
-        self.packages = {}
+        self.incoming_queue = mini_buildd.ftpd.IncomingQueue(repository_weights=self.model.incoming_weights)
+        self.build_queue = mini_buildd.builder.Scheduler(max_builds=self.model.build_queue_size,
+                                                         max_jobs=self.model.build_max_jobs,
+                                                         min_jobs=self.model.sbuild_jobs,
+                                                         min_memory=self.model.build_min_memory,
+                                                         min_disk=self.model.build_min_disk,
+                                                         spool_dir=mini_buildd.setup.SPOOL_DIR)
+        self.chroot_setup_cache = mini_buildd.builder.SetupCache(os.path.join(mini_buildd.setup.CACHE_DIR, "chroot-setup"),
+                                                                 max_age=self.model.chroot_setup_cache_hours) if self.model.chroot_setup_cache_hours else None
+        self.remote_status = RemoteStatus(ttl=self.model.remote_status_ttl)
+        # Blob store keeps usage and pins in memory: Only reconfigure
+        if self.blob_store is None:
+            self.blob_store = mini_buildd.misc.BlobStore(os.path.join(mini_buildd.setup.CACHE_DIR, "blobs"), max_size=self.model.blob_store_size)
+        else:
+            self.blob_store.max_size = self.model.blob_store_size
+        self._remote_addresses = (0, set())
+        mini_buildd.changes.FTP_POOL.configure(parallel=self.model.ftp_upload_parallel,
+                                               blocksize=self.model.ftp_upload_blocksize * 1024)
+        self.packager_pool = None
+        if self.journal is None:
+            self.journal = mini_buildd.packager.Journal(os.path.join(mini_buildd.setup.HOME_DIR, "packages.journal"))
+        self.packages = mini_buildd.packager.restore(self)
         self.builds = {}
         self.last_packages = collections.deque(maxlen=self.model.show_last_packages)
         self.last_builds = collections.deque(maxlen=self.model.show_last_builds)
@@ -545,6 +803,32 @@ class Daemon(object):
     def get_active_or_auto_reactivate_remotes(cls):
         return mini_buildd.models.gnupg.Remote.mbd_get_active_or_auto_reactivate()
 
+    REMOTE_ADDRESSES_TTL = 60
+
+    def is_remote_address(self, address):
+        "Check if address belongs to one of our (active or auto-reactivated) remotes (resolved addresses are cached for a while)."
+        if address.startswith("::ffff:"):
+            address = address[7:]
+        timestamp, addresses = self._remote_addresses
+        if time.time() - timestamp > self.REMOTE_ADDRESSES_TTL:
+            addresses = set()
+            for remote in self.get_active_or_auto_reactivate_remotes():
+                try:
+                    addresses |= set([a[4][0] for a in socket.getaddrinfo(mini_buildd.misc.HoPo(remote.http).host, None)])
+                except socket.error as e:
+                    LOG.warn("Remote '{r}': Can't resolve: {e}".format(r=remote.http, e=e))
+            self._remote_addresses = (time.time(), addresses)
+        return address in addresses
+
+    @classmethod
+    def get_tar_codecs(cls):
+        "Get tar codecs we can (de)compress."
+        return sorted([c for c in mini_buildd.changes.Changes.TAR_CODECS if mini_buildd.changes.Changes.has_tar_codec(c)])
+
+    @classmethod
+    def get_tar_stats(cls):
+        return mini_buildd.changes.TAR_STATS.get()
+
     @classmethod
     def get_subscription_objects(cls):
         return mini_buildd.models.subscription.Subscription.objects
@@ -564,7 +848,10 @@ class Daemon(object):
 
         return repository, distribution, suite, dist_parsed.rollback_no
 
-    def port(self, package, from_dist, to_dist, version):
+    def port_check(self, package, from_dist, to_dist, version):
+        """
+        Check that a port is possible; return tuple (dsc_url, port_version).
+        """
         # check from_dist
         from_repository, from_distribution, from_suite, _from_rollback = self.parse_distribution(from_dist)
         p = from_repository.mbd_package_find(package, distribution=from_dist, version=version)
@@ -590,8 +877,30 @@ class Daemon(object):
         if not url:
             raise Exception("Port failed: Can't find DSC for {p}-{v} in pool".format(p=package, v=p["sourceversion"]))
 
+        return url, port_version
+
+    def port(self, package, from_dist, to_dist, version):
+        url, port_version = self.port_check(package, from_dist, to_dist, version)
         self._port(url, package, to_dist, port_version)
 
+    def port_bulk(self, packages, from_dist, to_dists):
+        """
+        Port many packages to many distributions; all ports are checked before any is started.
+        """
+        ports, errors = [], []
+        for package in packages:
+            for to_dist in to_dists:
+                try:
+                    ports.append((package, to_dist) + self.port_check(package, from_dist, to_dist, None))
+                except Exception as e:
+                    errors.append("{p} -> {d}: {e}".format(p=package, d=to_dist, e=e))
+        if errors:
+            raise Exception("Bulk check failed for {n} port(s), nothing done: {e}".format(n=len(errors), e="; ".join(errors)))
+
+        for package, to_dist, url, port_version in ports:
+            self._port(url, package, to_dist, port_version)
+        return ports
+
     def portext(self, dsc_url, to_dist):
         # check to_dist
         to_repository, to_distribution, to_suite, to_rollback = self.parse_distribution(to_dist)
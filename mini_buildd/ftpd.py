@@ -3,13 +3,24 @@ from __future__ import unicode_literals
 
 import os
 import stat
+import copy
 import glob
 import shutil
+import collections
 import fnmatch
+import threading
+import time
 import logging
 
 import debian.deb822
 
+# pylint: disable=F0401
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+# pylint: enable=F0401
+
 import pyftpdlib.handlers
 import pyftpdlib.authorizers
 import pyftpdlib.servers
@@ -24,18 +35,89 @@ LOG = logging.getLogger(__name__)
 class Incoming(object):
     "Tool collection for some extra incoming directory handling."
 
+    # Changes files claimed for queuing: path -> (inode, mtime)
+    _claimed = {}
+    _claimed_lock = threading.Lock()
+
     @classmethod
     def is_changes(cls, file_name):
         return fnmatch.fnmatch(file_name, "*.changes")
 
+    @classmethod
+    def _claim_key(cls, changes_file):
+        try:
+            s = os.stat(changes_file)
+            return s.st_ino, s.st_mtime
+        except OSError:
+            return None
+
+    @classmethod
+    def is_claimed(cls, changes_file):
+        with cls._claimed_lock:
+            return cls._claimed.get(os.path.realpath(changes_file)) == cls._claim_key(changes_file)
+
+    @classmethod
+    def claim(cls, changes_file):
+        """
+        Claim changes file for queuing.
+
+        Several ingestion paths (ftpd, incoming watcher, startup
+        re-queue) may see the same changes file; only the first
+        one to claim it should queue it.
+
+        >>> import tempfile
+        >>> f = tempfile.NamedTemporaryFile(suffix=".changes")
+        >>> Incoming.claim(f.name), Incoming.claim(f.name), Incoming.is_claimed(f.name)
+        (True, False, True)
+        >>> f.close()
+        >>> Incoming.claim(f.name), Incoming.is_claimed(f.name)
+        (False, False)
+        """
+        key = cls._claim_key(changes_file)
+        if key is None:
+            return False
+
+        with cls._claimed_lock:
+            # Forget about files that are gone (i.e., processed)
+            for c in [c for c in cls._claimed if not os.path.exists(c)]:
+                del cls._claimed[c]
+
+            path = os.path.realpath(changes_file)
+            if cls._claimed.get(path) == key:
+                return False
+            cls._claimed[path] = key
+            return True
+
+    @classmethod
+    def is_complete(cls, changes_file, is_closed=lambda path: True):
+        """
+        Check that all files of a changes file are present with the announced size, and closed.
+        """
+        try:
+            files = debian.deb822.Changes(mini_buildd.misc.open_utf8(changes_file)).get("Files")
+            if not files or not is_closed(changes_file):
+                return False
+
+            for fd in files:
+                path = os.path.join(os.path.dirname(changes_file), fd["name"])
+                if not os.path.exists(path) or os.path.getsize(path) != int(fd["size"]) or not is_closed(path):
+                    return False
+            return True
+        except Exception as e:
+            mini_buildd.setup.log_exception(LOG, "Incoming: Can't check changes file (not yet complete?): {f}".format(f=changes_file), e, logging.DEBUG)
+            return False
+
     @classmethod
     def get_changes(cls):
         return glob.glob(os.path.join(mini_buildd.setup.INCOMING_DIR, "*.changes"))
 
     @classmethod
-    def remove_cruft_files(cls, files):
+    def remove_cruft_files(cls, files, min_age=0):
         """
         Remove all files from list of files not mentioned in a changes file.
+
+        Files not mentioned, but younger than 'min_age' seconds,
+        are kept, and returned.
         """
         valid_files = []
         for changes_file in files:
@@ -50,8 +132,12 @@ class Incoming(object):
                 except Exception as e:
                     mini_buildd.setup.log_exception(LOG, "Invalid changes file: {f}".format(f=changes_file), e, logging.WARNING)
 
+        kept = []
         for f in files:
-            if os.path.basename(f) not in valid_files:
+            if os.path.basename(f) not in valid_files and os.path.exists(f):
+                if min_age and time.time() - os.path.getmtime(f) < min_age:
+                    kept.append(f)
+                    continue
                 # Be sure to never ever fail, just because cruft removal fails (instead log accordingly)
                 try:
                     if os.path.isdir(f):
@@ -61,6 +147,7 @@ class Incoming(object):
                     LOG.warn("Cruft file (not in any changes file) removed: {f}".format(f=f))
                 except Exception as e:
                     mini_buildd.setup.log_exception(LOG, "Can't remove cruft from incoming: {f}".format(f=f), e, logging.CRITICAL)
+        return kept
 
     @classmethod
     def remove_cruft(cls):
@@ -69,21 +156,324 @@ class Incoming(object):
         """
         cls.remove_cruft_files(["{p}/{f}".format(p=mini_buildd.setup.INCOMING_DIR, f=f) for f in os.listdir(mini_buildd.setup.INCOMING_DIR)])
 
+    @classmethod
+    def reset_claims(cls):
+        "Forget all claims (claims are only valid for the queue of one daemon run)."
+        with cls._claimed_lock:
+            cls._claimed.clear()
+
     @classmethod
     def requeue_changes(cls, queue):
         """
         Re-queue all existing changes in incoming.
 
-        We must feed the the user uploads first, so the daemon
-        does not get any yet-unknown build results (hence the
-        sorting).
+        This starts a new daemon run, so all claims of previous
+        runs (i.e., for the old queue) are dropped first.
+
+        Order does not matter here: The incoming queue holds back
+        build results until the user upload of the same package
+        has been taken.
+
+        >>> import tempfile, Queue
+        >>> mini_buildd.setup.INCOMING_DIR = tempfile.mkdtemp()
+        >>> open(os.path.join(mini_buildd.setup.INCOMING_DIR, "test.changes"), "w").write("")
+        >>> q = Queue.Queue()
+        >>> Incoming.requeue_changes(q)
+        >>> q.qsize()
+        1
+        >>> q = Queue.Queue()  # Daemon stop/start: new run, new queue
+        >>> Incoming.requeue_changes(q)
+        >>> q.qsize()
+        1
         """
-        for c in sorted(cls.get_changes(), cmp=lambda c0, c1: 1 if fnmatch.fnmatch(c0, "*mini-buildd-build*") else -1):
-            LOG.info("Incoming: Re-queuing: {c}".format(c=c))
-            queue.put(c)
+        cls.reset_claims()
+        for c in cls.get_changes():
+            if cls.claim(c):
+                LOG.info("Incoming: Re-queuing: {c}".format(c=c))
+                queue.put(c)
+
+
+class IncomingWatcher(object):
+    """
+    Watch incoming directory for changes files not uploaded via ftp (rsync, scp, local copies).
+
+    A changes file is queued as soon as it and all files listed
+    in it are present with the announced size, and closed. With
+    pyinotify, closed means we have seen the close (or move) for
+    a file after its last write; in polling mode, it means the
+    file did not change since the last poll.
+    """
+    MODES = ["auto", "inotify", "poll", "off"]
+
+    def __init__(self, queue, mode="auto", interval=5.0):
+        if mode not in self.MODES:
+            raise Exception("Unknown incoming watcher mode '{m}' (use one of: {ms})".format(m=mode, ms=", ".join(self.MODES)))
+        if mode == "inotify" and not pyinotify:
+            raise Exception("Incoming watcher mode 'inotify' needs pyinotify (python-pyinotify)")
+        if mode == "auto":
+            mode = "inotify" if pyinotify else "poll"
+
+        self.mode = mode
+        self._queue = queue
+        self._interval = interval
+        self._shutdown = threading.Event()
+
+    def _scan(self, is_closed):
+        for c in Incoming.get_changes():
+            if not Incoming.is_claimed(c) and Incoming.is_complete(c, is_closed) and Incoming.claim(c):
+                LOG.info("Incoming watcher: Queuing complete changes file: {c}".format(c=c))
+                self._queue.put(c)
+
+    def _run_inotify(self):
+        # File names written to, but not closed yet
+        writing = set()
+
+        class Handler(pyinotify.ProcessEvent):
+            # pylint: disable=C0103
+            def process_IN_CREATE(self, event):
+                writing.add(event.pathname)
+
+            process_IN_MODIFY = process_IN_CREATE
+
+            def process_IN_CLOSE_WRITE(self, event):
+                writing.discard(event.pathname)
+
+            process_IN_MOVED_TO = process_IN_CLOSE_WRITE
+            process_IN_DELETE = process_IN_CLOSE_WRITE
+            process_IN_MOVED_FROM = process_IN_CLOSE_WRITE
+            # pylint: enable=C0103
+
+        wm = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(wm, Handler(), timeout=int(self._interval * 1000))
+        wm.add_watch(mini_buildd.setup.INCOMING_DIR,
+                     pyinotify.IN_CREATE | pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM)
+        try:
+            while not self._shutdown.is_set():
+                if notifier.check_events():
+                    notifier.read_events()
+                    notifier.process_events()
+                    self._scan(lambda path: path not in writing)
+        finally:
+            notifier.stop()
+
+    def _run_poll(self):
+        # path -> (size, mtime) from last poll
+        last = {}
+        while not self._shutdown.wait(self._interval):
+            current = {}
+            for f in os.listdir(mini_buildd.setup.INCOMING_DIR):
+                path = os.path.join(mini_buildd.setup.INCOMING_DIR, f)
+                try:
+                    s = os.stat(path)
+                    current[path] = (s.st_size, s.st_mtime)
+                except OSError:
+                    pass
+
+            self._scan(lambda path, last=last, current=current: path in current and last.get(path) == current[path])
+            last = current
+
+    def run(self):
+        LOG.info("Incoming watcher: Watching '{d}' (mode {m}).".format(d=mini_buildd.setup.INCOMING_DIR, m=self.mode))
+        if self.mode == "inotify":
+            self._run_inotify()
+        elif self.mode == "poll":
+            self._run_poll()
+
+    def shutdown(self):
+        self._shutdown.set()
+
+
+class IncomingQueue(object):
+    """
+    Scheduler for incoming events (changes file paths); may be used as drop-in for Queue.Queue.
+
+    Events are divided into classes, which are served in strict priority order:
+
+    - build:  Build results and build requests. Build results for a package whose user upload is still queued are held back.
+    - upload: User uploads, weighted fair queued per repository, and then per uploader.
+    - port:   Internal ports (changes files in our tmp dir), fair queued like uploads.
+
+    The special event "SHUTDOWN" is always served first. Wait times
+    are collected per class.
+
+    get() may be given a 'may_package' callable: While it
+    returns False (i.e., no packager worker is free), only build
+    requests (which don't need the packager) are served, so all
+    other events wait here, in scheduling order; wakeup() makes
+    waiting consumers check again.
+
+    >>> mini_buildd.setup.TMP_DIR = "/var/lib/mini-buildd/var/tmp"
+    >>> q = IncomingQueue()
+    >>> q.put("/incoming/a_1_amd64.changes")
+    >>> q.put("/incoming/a_1_mini-buildd-buildresult_amd64.changes")
+    >>> q.put("/incoming/b_1_mini-buildd-buildresult_amd64.changes")
+    >>> q.put("/var/lib/mini-buildd/var/tmp/t123/c_1_source.changes")
+    >>> q.put("/incoming/d_1_source.changes")
+    >>> q.qsize()
+    5
+    >>> for _i in range(q.qsize()):
+    ...     print(q.get())
+    /incoming/b_1_mini-buildd-buildresult_amd64.changes
+    /incoming/a_1_amd64.changes
+    /incoming/a_1_mini-buildd-buildresult_amd64.changes
+    /incoming/d_1_source.changes
+    /var/lib/mini-buildd/var/tmp/t123/c_1_source.changes
+    >>> [(c, w.count) for c, w in q.get_waits()]
+    [(u'build', 2), (u'upload', 2), (u'port', 1)]
+    >>> q.put("/incoming/e_1_source.changes")
+    >>> q.put("/incoming/e_1_mini-buildd-buildrequest_amd64.changes")
+    >>> print(q.get(may_package=lambda: False))
+    /incoming/e_1_mini-buildd-buildrequest_amd64.changes
+    >>> print(q.get(may_package=lambda: True))
+    /incoming/e_1_source.changes
+    """
+    CLASS_BUILD = "build"
+    CLASS_UPLOAD = "upload"
+    CLASS_PORT = "port"
+    CLASSES = [CLASS_BUILD, CLASS_UPLOAD, CLASS_PORT]
+
+    SHUTDOWN = "SHUTDOWN"
+    WAIT_BOUNDS = [1, 5, 15, 60, 300, 900, 3600]
+
+    def __init__(self, repository_weights=None):
+        self._cond = threading.Condition()
+        self._unfinished = 0
+
+        weights = repository_weights if repository_weights else {}
+        self._shutdown = 0
+        self._build = collections.deque()
+        self._fair = {self.CLASS_UPLOAD: mini_buildd.misc.FairQueue(levels=2, weight=lambda r: weights.get(r, 1.0)),
+                      self.CLASS_PORT: mini_buildd.misc.FairQueue(levels=2, weight=lambda r: weights.get(r, 1.0))}
+        # pkg_id: number of queued user uploads
+        self._uploads = collections.defaultdict(int)
+        self._waits = dict((c, mini_buildd.misc.Histogram(self.WAIT_BOUNDS)) for c in self.CLASSES)
+
+    def __unicode__(self):
+        return ", ".join(["{c}: {n}".format(c=c, n=n) for c, n in self.get_queued()])
+
+    @classmethod
+    def _pkg_id(cls, file_name):
+        "Package id from changes file name (epoch already stripped), i.e. 'SOURCE_VERSION'."
+        return "_".join(os.path.basename(file_name).split("_")[:2])
+
+    @classmethod
+    def _flow(cls, file_name):
+        "Get (repository, uploader) tuple; this must never fail (unparsable events are checked later)."
+        try:
+            changes = debian.deb822.Changes(mini_buildd.misc.open_utf8(file_name))
+            dist = changes.get("Distribution", "")
+            try:
+                repository = mini_buildd.misc.Distribution(dist).repository
+            except:
+                repository = dist
+            return repository, changes.get("Changed-By", "")
+        except:
+            return "", ""
+
+    @classmethod
+    def classify(cls, file_name):
+        if fnmatch.fnmatch(file_name, "*_mini-buildd-build*.changes"):
+            return cls.CLASS_BUILD
+        elif mini_buildd.setup.TMP_DIR and mini_buildd.misc.TmpDir.file_dir(file_name):
+            return cls.CLASS_PORT
+        else:
+            return cls.CLASS_UPLOAD
+
+    def put(self, event, *_args, **_kwargs):
+        with self._cond:
+            if event == self.SHUTDOWN:
+                self._shutdown += 1
+            else:
+                cls = self.classify(event)
+                item = (event, time.time())
+                if cls == self.CLASS_BUILD:
+                    self._build.append(item)
+                else:
+                    if cls == self.CLASS_UPLOAD:
+                        self._uploads[self._pkg_id(event)] += 1
+                    self._fair[cls].put(self._flow(event), item)
+            self._unfinished += 1
+            self._cond.notify()
+
+    def _take(self, may_package=True):
+        "Take next item, or None if nothing can be served (caller must hold lock)."
+        if self._shutdown:
+            self._shutdown -= 1
+            return self.SHUTDOWN, None, None
+
+        for i, item in enumerate(self._build):
+            is_bres = fnmatch.fnmatch(item[0], "*_mini-buildd-buildresult_*.changes")
+            if not (is_bres and (not may_package or self._uploads.get(self._pkg_id(item[0])))):
+                del self._build[i]
+                return item[0], item[1], self.CLASS_BUILD
+
+        if not may_package:
+            return None
+
+        for cls in [self.CLASS_UPLOAD, self.CLASS_PORT]:
+            if self._fair[cls]:
+                event, queued = self._fair[cls].get()
+                if cls == self.CLASS_UPLOAD:
+                    pkg_id = self._pkg_id(event)
+                    self._uploads[pkg_id] -= 1
+                    if not self._uploads[pkg_id]:
+                        del self._uploads[pkg_id]
+                return event, queued, cls
+
+        return None
+
+    def get(self, *_args, **kwargs):
+        may_package = kwargs.get("may_package")
+        with self._cond:
+            while True:
+                taken = self._take(may_package=may_package() if may_package else True)
+                if taken:
+                    event, queued, cls = taken
+                    if cls:
+                        self._waits[cls].add(time.time() - queued)
+                    return event
+                self._cond.wait()
+
+    def wakeup(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def task_done(self):
+        with self._cond:
+            self._unfinished -= 1
+
+    def qsize(self):
+        with self._cond:
+            return self._shutdown + len(self._build) + sum([len(f) for f in self._fair.values()])
+
+    def get_queued(self):
+        "Get list of (class, number of queued events) tuples."
+        with self._cond:
+            return [(self.CLASS_BUILD, len(self._build))] + [(c, len(self._fair[c])) for c in [self.CLASS_UPLOAD, self.CLASS_PORT]]
+
+    def get_waits(self):
+        "Get list of (class, wait time histogram) tuples."
+        with self._cond:
+            return [(c, copy.deepcopy(self._waits[c])) for c in self.CLASSES]
 
 
 class FtpDHandler(pyftpdlib.handlers.FTPHandler):
+    """
+    Uploaders may use several (pooled, parallel) connections for
+    one upload, and resume partial uploads later. So files not
+    mentioned in any changes file in incoming are only removed
+    when no other session from the same client is connected,
+    and the file has not been written to for CRUFT_GRACE
+    seconds; until then, they are rechecked on later
+    disconnects of that client.
+    """
+    CRUFT_GRACE = 300
+
+    # remote ip: number of connected sessions
+    _mbd_sessions = collections.Counter()
+    # remote ip: files not (yet) mentioned in any changes file
+    _mbd_unreferenced = {}
+
     def __init__(self, *args, **kwargs):
         # Note: FTPHandler is not a new style class, so we can't use 'super' here
         pyftpdlib.handlers.FTPHandler.__init__(self, *args, **kwargs)
@@ -92,34 +482,80 @@ class FtpDHandler(pyftpdlib.handlers.FTPHandler):
     def on_file_received(self, file_name):
         """
         Make any incoming file read-only as soon as it arrives; avoids overriding uploads of the same file.
+
+        Blobs (see changes.Changes.upload_blobs()) go to the blob
+        store right away (checksummed in the background, so we
+        don't block the server loop).
         """
+        if os.path.dirname(file_name) == mini_buildd.setup.BLOBS_DIR:
+            LOG.info("Blob received: {f}".format(f=file_name))
+            try:
+                self.mini_buildd_blob_store.add_background(file_name, os.path.basename(file_name))
+            except Exception as e:
+                mini_buildd.setup.log_exception(LOG, "Invalid blob: {f}".format(f=file_name), e, logging.WARNING)
+                os.remove(file_name)
+            return
+
         os.chmod(file_name, stat.S_IRUSR | stat.S_IRGRP)
         self._mbd_files_received.append(file_name)
         LOG.info("File received: {f}".format(f=file_name))
 
     def on_incomplete_file_received(self, file_name):
         LOG.warning("Incomplete file received: {f}".format(f=file_name))
-        self._mbd_files_received.append(file_name)
+        if os.path.dirname(file_name) != mini_buildd.setup.BLOBS_DIR:
+            self._mbd_files_received.append(file_name)
+
+    def on_connect(self):
+        # Only our remotes may write to the blob store
+        if self.mini_buildd_is_remote(self.remote_ip):
+            self.authorizer = self.mini_buildd_remote_authorizer
+        self._mbd_sessions[self.remote_ip] += 1
 
     def on_disconnect(self):
+        self._mbd_sessions[self.remote_ip] -= 1
         for file_name in (f for f in self._mbd_files_received if Incoming.is_changes(f)):
-            LOG.info("Queuing incoming changes file: {f}".format(f=file_name))
-            self.mini_buildd_queue.put(file_name)
-        Incoming.remove_cruft_files(self._mbd_files_received)
-
-
-def run(bind, queue):
+            if Incoming.claim(file_name):
+                LOG.info("Queuing incoming changes file: {f}".format(f=file_name))
+                self.mini_buildd_queue.put(file_name)
+            else:
+                LOG.info("Incoming changes file already queued: {f}".format(f=file_name))
+
+        unreferenced = self._mbd_unreferenced.setdefault(self.remote_ip, set())
+        unreferenced.update(f for f in self._mbd_files_received if not Incoming.is_changes(f))
+        if self._mbd_sessions[self.remote_ip] <= 0:
+            del self._mbd_sessions[self.remote_ip]
+            kept = Incoming.remove_cruft_files(Incoming.get_changes() + list(unreferenced), min_age=self.CRUFT_GRACE)
+            if kept:
+                self._mbd_unreferenced[self.remote_ip] = set(kept)
+            else:
+                del self._mbd_unreferenced[self.remote_ip]
+
+
+def run(bind, queue, blob_store, is_remote):
     mini_buildd.misc.clone_log("pyftpdlib")
 
     ba = mini_buildd.misc.HoPo(bind)
 
+    def authorizer(blobs):
+        result = pyftpdlib.authorizers.DummyAuthorizer()
+        result.add_anonymous(homedir=mini_buildd.setup.HOME_DIR, perm="")
+        result.override_perm(username="anonymous", directory=mini_buildd.setup.INCOMING_DIR, perm="elrw")
+        if blobs:
+            result.override_perm(username="anonymous", directory=mini_buildd.setup.BLOBS_DIR, perm="elw")
+        return result
+
     handler = FtpDHandler
-    handler.authorizer = pyftpdlib.authorizers.DummyAuthorizer()
-    handler.authorizer.add_anonymous(homedir=mini_buildd.setup.HOME_DIR, perm="")
-    handler.authorizer.override_perm(username="anonymous", directory=mini_buildd.setup.INCOMING_DIR, perm="elrw")
+    handler.authorizer = authorizer(blobs=False)
+    handler.mini_buildd_remote_authorizer = authorizer(blobs=True)
+    handler.mini_buildd_is_remote = staticmethod(is_remote)
 
     handler.banner = "mini-buildd {v} ftp server ready (pyftpdlib {V}).".format(v=mini_buildd.__version__, V=pyftpdlib.__ver__)
     handler.mini_buildd_queue = queue
+    handler.mini_buildd_blob_store = blob_store
+
+    # Partial blob uploads from before
+    for f in glob.glob(os.path.join(mini_buildd.setup.BLOBS_DIR, "*")):
+        os.remove(f)
 
     Incoming.remove_cruft()
     Incoming.requeue_changes(queue)
@@ -6,6 +6,9 @@ import re
 import tempfile
 import shutil
 import subprocess
+import itertools
+import threading
+import collections
 import logging
 
 import mini_buildd.misc
@@ -13,6 +16,34 @@ import mini_buildd.setup
 
 LOG = logging.getLogger(__name__)
 
+# Unique keyring generations (for the verification cache)
+_GENERATIONS = itertools.count()
+
+
+class Stats(object):
+    """
+    Thread-safe counters for gpg usage ('forks', 'verify_cache_hits', and processed 'packages').
+
+    >>> s = Stats()
+    >>> s.count("forks")
+    >>> s.count("forks")
+    >>> s.get()
+    {u'forks': 2}
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+
+    def count(self, key):
+        with self._lock:
+            self._counters[key] += 1
+
+    def get(self):
+        with self._lock:
+            return dict(self._counters)
+
+STATS = Stats()
+
 
 class Colons(object):
     """
@@ -52,90 +83,192 @@ class Colons(object):
 
 
 class BaseGnuPG(object):
+    # Verification outcomes: (generation, keyring files state, signature sha256, data sha256) -> fingerprint or None
+    _VERIFY_CACHE = collections.OrderedDict()
+    _VERIFY_CACHE_MAX = 1000
+    _VERIFY_CACHE_LOCK = threading.Lock()
+
     def __init__(self, home):
         self.home = home
         self.gpg_cmd = ["gpg",
                         "--homedir={h}".format(h=home),
                         "--display-charset={charset}".format(charset=mini_buildd.setup.CHAR_ENCODING),
                         "--batch"]
+        self._generation = next(_GENERATIONS)
+        # Memoized secret key colons (immutable unless we generate a key)
+        self._sec_keys = {}
+
+    def _call(self, args, **kwargs):
+        STATS.count("forks")
+        return mini_buildd.misc.call(args, **kwargs)
+
+    def _changed(self):
+        "Keys changed: Start a new generation (invalidates cached verifications)."
+        self._generation = next(_GENERATIONS)
+        self._sec_keys = {}
 
     def gen_secret_key(self, template):
         with tempfile.TemporaryFile() as t:
             t.write(template.encode(mini_buildd.setup.CHAR_ENCODING))
             t.seek(0)
-            mini_buildd.misc.call(self.gpg_cmd + ["--gen-key"], stdin=t)
+            self._call(self.gpg_cmd + ["--gen-key"], stdin=t)
+        self._changed()
 
     def export(self, dest_file, identity=""):
         with mini_buildd.misc.open_utf8(dest_file, "w") as f:
+            STATS.count("forks")
             subprocess.check_call(self.gpg_cmd + ["--export={i}".format(i=identity)], stdout=f)
 
     def get_pub_key(self, identity):
-        return mini_buildd.misc.call(self.gpg_cmd + ["--armor", "--export={i}".format(i=identity)])
+        return self._call(self.gpg_cmd + ["--armor", "--export={i}".format(i=identity)])
 
-    def _get_colons(self, list_arg="--list-public-keys", type_regex=".*"):
-        for line in mini_buildd.misc.call(self.gpg_cmd + [list_arg, "--with-fingerprint", "--with-colons"]).splitlines():
+    def _get_colons(self, list_arg="--list-public-keys", type_regex=".*", identities=None):
+        for line in self._call(self.gpg_cmd + [list_arg, "--with-fingerprint", "--with-colons"] + (identities or [])).splitlines():
             colons = Colons(line)
             LOG.debug("{c}".format(c=colons))
             if re.match(type_regex, colons.type):
                 yield colons
 
-    def get_pub_colons(self, type_regex="pub"):
-        return self._get_colons(list_arg="--list-public-keys", type_regex=type_regex)
+    def get_pub_colons(self, type_regex="pub", identities=None):
+        return self._get_colons(list_arg="--list-public-keys", type_regex=type_regex, identities=identities)
+
+    def get_pub_fingerprints(self):
+        "Get set of all (primary) key fingerprints in the keyring(s)."
+        return set([c.user_id for c in self.get_pub_colons(type_regex="fpr")])
+
+    def get_keyring_fingerprints(self, keyring):
+        "Get set of all (primary and sub) key fingerprints in a keyring file."
+        gpg_cmd = BaseGnuPG(self.home).gpg_cmd + ["--no-default-keyring", "--keyring={k}".format(k=keyring)]
+        # Twice '--with-fingerprint' also lists fingerprints of subkeys
+        return set([Colons(line).user_id
+                    for line in self._call(gpg_cmd + ["--list-public-keys", "--with-fingerprint", "--with-fingerprint", "--with-colons"]).splitlines()
+                    if Colons(line).type == "fpr"])
 
     def get_sec_colons(self, type_regex="sec"):
         return self._get_colons(list_arg="--list-secret-keys", type_regex=type_regex)
 
+    def _get_first_sec_colons(self, type_regex):
+        if type_regex not in self._sec_keys:
+            try:
+                self._sec_keys[type_regex] = self.get_sec_colons(type_regex=type_regex).next()
+            except StopIteration:
+                return Colons("")
+        return self._sec_keys[type_regex]
+
     def get_first_sec_key(self):
-        try:
-            return self.get_sec_colons().next()
-        except StopIteration:
-            return Colons("")
+        return self._get_first_sec_colons("sec")
 
     def get_first_sec_key_fingerprint(self):
-        try:
-            return self.get_sec_colons(type_regex="fpr").next()
-        except StopIteration:
-            return Colons("")
+        return self._get_first_sec_colons("fpr")
 
     def recv_key(self, keyserver, identity):
-        return mini_buildd.misc.call(self.gpg_cmd + ["--armor", "--keyserver={ks}".format(ks=keyserver), "--recv-keys", identity])
+        result = self._call(self.gpg_cmd + ["--armor", "--keyserver={ks}".format(ks=keyserver), "--recv-keys", identity])
+        self._changed()
+        return result
 
     def add_pub_key(self, key):
         with tempfile.TemporaryFile() as t:
             t.write(key.encode(mini_buildd.setup.CHAR_ENCODING))
             t.seek(0)
-            mini_buildd.misc.call(self.gpg_cmd + ["--import"], stdin=t)
+            self._call(self.gpg_cmd + ["--import"], stdin=t)
+        self._changed()
+
+    def remove_pub_keys(self, fingerprints):
+        if fingerprints:
+            self._call(self.gpg_cmd + ["--yes", "--delete-keys"] + fingerprints)
+            self._changed()
 
     def add_keyring(self, keyring):
-        if os.path.exists(keyring):
-            self.gpg_cmd.append("--keyring={k}".format(k=keyring))
+        keyring_arg = "--keyring={k}".format(k=keyring)
+        if keyring_arg in self.gpg_cmd:
+            LOG.debug("Keyring already added: {k}".format(k=keyring))
+        elif os.path.exists(keyring):
+            self.gpg_cmd.append(keyring_arg)
+            self._changed()
         else:
             LOG.warn("Skipping non-existing keyring file: {k}".format(k=keyring))
 
+    def _keyrings_state(self):
+        "Modification times of extra keyring files (these may change under our feet)."
+        return tuple([(a, os.path.getmtime(a[10:]) if os.path.exists(a[10:]) else None) for a in self.gpg_cmd if a.startswith("--keyring=")])
+
     def verify(self, signature, data=None):
+        """
+        Verify signature; return the fingerprint of the signing (primary) key.
+
+        Outcomes are cached per keyring generation and file contents;
+        failures only when gpg definitely rejected the signature.
+        """
+        cache_key = (self._generation,
+                     self._keyrings_state(),
+                     mini_buildd.misc.CHECKSUMS.get(signature, "sha256"),
+                     mini_buildd.misc.CHECKSUMS.get(data, "sha256") if data else None)
+        with self._VERIFY_CACHE_LOCK:
+            if cache_key in self._VERIFY_CACHE:
+                STATS.count("verify_cache_hits")
+                fingerprint, error = self._VERIFY_CACHE[cache_key]
+                if error:
+                    raise Exception(error)
+                return fingerprint
+
+        fingerprint, error = self._verify(signature, data)
+        with self._VERIFY_CACHE_LOCK:
+            self._VERIFY_CACHE[cache_key] = (fingerprint, error)
+            while len(self._VERIFY_CACHE) > self._VERIFY_CACHE_MAX:
+                self._VERIFY_CACHE.popitem(last=False)
+        if error:
+            raise Exception(error)
+        return fingerprint
+
+    def _verify(self, signature, data=None):
+        """
+        Return (fingerprint, None) for a valid signature, or (None, error message) if gpg definitely rejected it.
+
+        Other failures (gpg not runnable, I/O errors, ...) raise, and are not to be cached.
+        """
+        STATS.count("forks")
         try:
-            mini_buildd.misc.call(self.gpg_cmd + ["--verify", signature] + ([data] if data else []), error_log_on_fail=False)
-        except:
-            raise Exception("GnuPG authorization failed.")
+            gpg = subprocess.Popen(self.gpg_cmd + ["--status-fd=1", "--verify", signature] + ([data] if data else []),
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+            status, stderr = gpg.communicate()
+        except Exception as e:
+            raise Exception("GnuPG authorization failed: {e}".format(e=e))
+
+        definite = gpg.returncode == 0
+        for line in status.decode(mini_buildd.setup.CHAR_ENCODING, "replace").splitlines():
+            # [GNUPG:] VALIDSIG <fpr> <date> <timestamp> <expire> <version> <reserved> <pk-algo> <hash-algo> <class> <primary-fpr>
+            fields = line.split()
+            if gpg.returncode == 0 and fields[1:2] == ["VALIDSIG"]:
+                return fields[11] if len(fields) > 11 else fields[2], None
+            if fields[1:2] in [["BADSIG"], ["ERRSIG"], ["NO_PUBKEY"], ["NODATA"]]:
+                definite = True
+        if definite:
+            return None, "GnuPG authorization failed: No valid signature."
+        raise Exception("GnuPG authorization failed: {e}".format(e=stderr.decode(mini_buildd.setup.CHAR_ENCODING, "replace").strip()))
+
+    def sign_text(self, text, identity=None):
+        """
+        Clearsign text (bytes) via gpg's stdin/stdout; return the signed text.
+
+        Like 'debsign' from devscripts, an extra new line is added
+        (dpkg-source <= squeeze will have problems without the newline).
+        """
+        STATS.count("forks")
+        gpg = subprocess.Popen(self.gpg_cmd +
+                               ["--armor", "--textmode", "--clearsign"] +
+                               (["--local-user={i}".format(i=identity)] if identity else []),
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+        signed, stderr = gpg.communicate(text + b"\n")
+        if gpg.returncode != 0:
+            raise Exception("GnuPG signing failed: {e}".format(e=stderr.decode(mini_buildd.setup.CHAR_ENCODING, "replace").strip()))
+        return signed
 
     def sign(self, file_name, identity=None):
-        # 1st: copy the unsigned file and add an extra new line
-        # (Like 'debsign' from devscripts does: dpkg-source <= squeeze will have problems without the newline)
-        unsigned_file = file_name + ".asc"
-        shutil.copyfile(file_name, unsigned_file)
-        with open(unsigned_file, "a") as unsigned:
-            unsigned.write("\n")
-
-        # 2nd: Sign the file copy
-        signed_file = file_name + ".signed"
-        mini_buildd.misc.call(self.gpg_cmd +
-                              ["--armor", "--textmode", "--clearsign", "--output={f}".format(f=signed_file)] +
-                              (["--local-user={i}".format(i=identity)] if identity else []) +
-                              [unsigned_file])
-
-        # 3rd: Success, move to orig file and cleanup
-        os.rename(signed_file, file_name)
-        os.remove(unsigned_file)
+        signed = self.sign_text(open(file_name, "rb").read(), identity=identity)
+        mini_buildd.misc.write_atomic(file_name, signed)
 
 
 class GnuPG(BaseGnuPG):
@@ -156,6 +289,7 @@ Name-Email: {e}
             LOG.info("GnuPG key already prepared...")
 
     def remove(self):
+        self._changed()
         if os.path.exists(self.home):
             shutil.rmtree(self.home)
             LOG.info("GnuPG setup removed: {h}".format(h=self.home))
@@ -182,12 +316,24 @@ class TmpGnuPG(BaseGnuPG, mini_buildd.misc.TmpDir):
     >>> t.write("A test file\\n")
     >>> t.flush()
     >>> gnupg.sign(file_name=t.name, identity="test@key.org")
-    >>> gnupg.verify(t.name)
+    >>> fingerprint = gnupg.get_first_sec_key_fingerprint().user_id
+    >>> gnupg.verify(t.name) == fingerprint
+    True
     >>> pub_key = gnupg.get_pub_key(identity="test@key.org")
     >>> gnupg.close()
     >>> tgnupg = TmpGnuPG()
     >>> tgnupg.add_pub_key(pub_key)
+    >>> tgnupg.verify(t.name) == fingerprint
+    True
+    >>> tgnupg.remove_pub_keys([fingerprint])
+    >>> tgnupg.verify(t.name)
+    Traceback (most recent call last):
+    ...
+    Exception: GnuPG authorization failed: No valid signature.
     >>> tgnupg.verify(t.name)
+    Traceback (most recent call last):
+    ...
+    Exception: GnuPG authorization failed: No valid signature.
     >>> tgnupg.close()
     """
     def __init__(self):
@@ -4,16 +4,19 @@ from __future__ import unicode_literals
 import os
 import re
 import stat
+import json
+import mimetypes
+import threading
 import email.utils
 import logging
 
 import cherrypy
 import cherrypy.lib.cptools
 import cherrypy.lib.http
-import cherrypy.lib.static
 
 import mini_buildd.misc
 import mini_buildd.setup
+import mini_buildd.reprepro
 
 LOG = logging.getLogger(__name__)
 
@@ -37,30 +40,22 @@ class StaticWithIndex(cherrypy._cptools.HandlerTool):
  <td align="right"><tt>{size}</tt></td>
 </tr>"""
 
+    _LISTINGS = mini_buildd.misc.DirListings()
+
+    # Pool files currently checksummed in the background
+    _HASHING = set()
+    _HASHING_LOCK = threading.Lock()
+
     @classmethod
     def _mbd_html_index(cls, directory):
         "Generate a directory index as html."
 
         def table_rows(directory):
             "Return an array of strings formatted as html table rows for all directory entries."
-            result = []
-
-            def add(path, entry, as_dir):
-                entry_path = os.path.join(path, entry)
-                result.append(cls._TABLE_ROW.format(name=entry + ("/" if as_dir else ""),
-                                                    mod=email.utils.formatdate(os.path.getmtime(entry_path)),
-                                                    size="DIR" if as_dir else os.path.getsize(entry_path)))
-
-            # Only walk one step
-            path, dirs, files = next(os.walk(directory))
-            # Dirs first, and sort entries by name
-            for entry in sorted(dirs):
-                add(path, entry, True)
-
-            for entry in sorted(files):
-                add(path, entry, False)
-
-            return result
+            return [cls._TABLE_ROW.format(name=e["name"] + ("/" if e["dir"] else ""),
+                                          mod=email.utils.formatdate(e["mtime"]),
+                                          size="DIR" if e["dir"] else e["size"])
+                    for e in cls._LISTINGS.get(directory)]
 
         return """\
 <!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
@@ -90,20 +85,185 @@ class StaticWithIndex(cherrypy._cptools.HandlerTool):
            cp_version=cherrypy.__version__)
 
     @classmethod
-    def _mbd_serve_index(cls, _section, directory, root="", match="", **_kwargs):
+    def _mbd_pool_path(cls, path):
+        "Get (repository identity, path relative to the repository) for a repository pool file, or None."
+        if path.startswith(mini_buildd.setup.REPOSITORIES_DIR + os.sep):
+            # <REPOSITORIES_DIR>/<identity>/pool/...
+            relpath = os.path.relpath(path, mini_buildd.setup.REPOSITORIES_DIR).split(os.sep, 1)
+            if len(relpath) == 2 and relpath[1].startswith("pool" + os.sep):
+                return relpath[0], relpath[1]
+
+    @classmethod
+    def _mbd_checksums(cls, path, stat_result):
+        "Get known checksums of a file (from checksum cache, or a repository's pool index); never computes."
+        checksums = mini_buildd.misc.CHECKSUMS.peek(path, stat_result)
+        pool_path = cls._mbd_pool_path(path) if checksums is None else None
+        if pool_path:
+            entry = mini_buildd.reprepro.get_pool_index(os.path.join(mini_buildd.setup.REPOSITORIES_DIR, pool_path[0])).peek_by_path(pool_path[1])
+            if entry and entry["size"] == stat_result.st_size:
+                checksums = dict([(h, entry[h]) for h in mini_buildd.misc.Checksums.HASH_TYPES])
+        return checksums or {}
+
+    @classmethod
+    def _mbd_hash_background(cls, path):
+        "Checksum file in the background (once), so later requests get a strong ETag."
+        with cls._HASHING_LOCK:
+            if path in cls._HASHING:
+                return
+            cls._HASHING.add(path)
+
+        def run():
+            try:
+                mini_buildd.misc.CHECKSUMS.get(path, "sha256")
+            except Exception as e:
+                mini_buildd.setup.log_exception(LOG, "Can't checksum '{p}' (ignoring)".format(p=path), e, logging.WARN)
+            finally:
+                with cls._HASHING_LOCK:
+                    cls._HASHING.discard(path)
+
+        thread = threading.Thread(target=run)
+        thread.setDaemon(True)
+        thread.start()
+
+    @classmethod
+    def _mbd_json_index(cls, directory):
+        "Generate a directory index as json (with sizes, mtimes and checksums, where known)."
+        result = []
+        for e in cls._LISTINGS.get(directory):
+            entry = {"name": e["name"],
+                     "type": "dir" if e["dir"] else "file",
+                     "mtime": e["mtime"]}
+            if not e["dir"]:
+                entry["size"] = e["size"]
+                entry.update(cls._mbd_checksums(os.path.join(directory, e["name"]), e["stat"]))
+            result.append(entry)
+        return json.dumps({"path": cherrypy.request.path_info, "entries": result})
+
+    # Text files we may have precompressed variants for: (content coding, file extension)
+    _VARIANT_FILES = r"(\.buildlog|\.changes|\.log)$"
+    _VARIANTS = [("gzip", ".gz"), ("xz", ".xz")]
+    _CHUNK_SIZE = 1024 * 1024
+
+    @classmethod
+    def _mbd_resolve(cls, directory, root, match):
+        "Get absolute path to serve, and its stat (or None)."
         if match and not re.search(match, cherrypy.request.path_info):
             raise cherrypy.HTTPError(403, "Requested path does not match allowed regex.")
 
-        # Compute absolute directory path to serve
+        # Compute absolute path to serve
         path = os.path.realpath(os.path.join(root, directory, cherrypy.request.path_info.lstrip("/")))
 
         if not path.startswith(os.path.normpath(root)):
             raise cherrypy.HTTPError(403, "Requested path outside root directory.")
 
-        # Check that the path actually exists
         try:
-            path_stat = os.stat(path)
+            return path, os.stat(path)
         except OSError:
+            return path, None
+
+    @classmethod
+    def _mbd_etag(cls, path, path_stat):
+        "Strong ETag from content checksum where known; weak ETag otherwise (pool files, which are immutable, are checksummed in the background)."
+        sha256 = cls._mbd_checksums(path, path_stat).get("sha256")
+        if sha256 is None and cls._mbd_pool_path(path):
+            cls._mbd_hash_background(path)
+        if sha256:
+            return '"{s}"'.format(s=sha256)
+        return 'W/"{i:x}-{s:x}-{m:x}"'.format(i=path_stat.st_ino, s=path_stat.st_size, m=int(path_stat.st_mtime))
+
+    @classmethod
+    def _mbd_pick_variant(cls, path, path_stat):
+        "Pick precompressed variant acceptable to the client: (content coding, path, stat), or None."
+        accepted = [e.value.lower() for e in cherrypy.request.headers.elements("Accept-Encoding") if e.qvalue > 0]
+        for coding, extension in cls._VARIANTS:
+            if coding in accepted:
+                try:
+                    variant_stat = os.stat(path + extension)
+                    if variant_stat.st_mtime >= path_stat.st_mtime:
+                        return coding, path + extension, variant_stat
+                except OSError:
+                    pass
+
+    @classmethod
+    def _mbd_get_range(cls, size, etag, mtime):
+        """
+        Get (start, end) of a satisfiable single byte range request, or None to serve the whole file.
+
+        Multiple ranges are ignored (allowed per RFC 7233). An 'If-Range'
+        not matching our (strong) ETag or Last-Modified also means 'whole file'.
+        """
+        range_header = cherrypy.request.headers.get("Range")
+        if not range_header:
+            return None
+
+        if_range = cherrypy.request.headers.get("If-Range")
+        if if_range:
+            if if_range.startswith('"') or if_range.startswith("W/"):
+                if etag.startswith("W/") or if_range != etag:
+                    return None
+            else:
+                if_range_date = email.utils.parsedate_tz(if_range)
+                if if_range_date is None or email.utils.mktime_tz(if_range_date) != int(mtime):
+                    return None
+
+        m = re.match(r"^bytes=(\d*)-(\d*)$", range_header.strip())
+        if not m or m.group(1) == m.group(2) == "":
+            return None
+        if m.group(1) == "":
+            # Suffix range: last N bytes
+            start, end = max(0, size - int(m.group(2))), size - 1
+        else:
+            start, end = int(m.group(1)), min(size - 1, int(m.group(2))) if m.group(2) else size - 1
+        if start >= size or start > end:
+            cherrypy.response.headers["Content-Range"] = "bytes */{s}".format(s=size)
+            raise cherrypy.HTTPError(416, "Requested range not satisfiable.")
+        return start, end
+
+    @classmethod
+    def _mbd_serve_file(cls, path, path_stat, content_types=None):
+        "Serve a file with (strong) ETag, conditional GET, single Range, and precompressed variants."
+        headers = cherrypy.response.headers
+
+        # Content type is always the type of the original file
+        extension = os.path.splitext(path)[1].lstrip(".")
+        headers["Content-Type"] = (content_types or {}).get(extension) or mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+        # Precompressed variant
+        if re.search(cls._VARIANT_FILES, path):
+            headers["Vary"] = "Accept-Encoding"
+            variant = cls._mbd_pick_variant(path, path_stat)
+            if variant:
+                coding, path, path_stat = variant
+                headers["Content-Encoding"] = coding
+
+        # Validators (these may raise "304 Not Modified")
+        etag = cls._mbd_etag(path, path_stat)
+        headers["ETag"] = etag
+        headers["Last-Modified"] = cherrypy.lib.http.HTTPDate(path_stat.st_mtime)
+        headers["Accept-Ranges"] = "bytes"
+        cherrypy.lib.cptools.validate_etags()
+        cherrypy.lib.cptools.validate_since()
+
+        size = path_stat.st_size
+        byte_range = cls._mbd_get_range(size, etag, path_stat.st_mtime)
+        start, end = byte_range or (0, size - 1)
+        if byte_range:
+            cherrypy.response.status = 206
+            headers["Content-Range"] = "bytes {s}-{e}/{t}".format(s=start, e=end, t=size)
+
+        headers["Content-Length"] = end - start + 1
+        if cherrypy.request.method != "HEAD":
+            f = open(path, "rb")
+            f.seek(start)
+            cherrypy.response.body = cherrypy.lib.file_generator_limited(f, end - start + 1, cls._CHUNK_SIZE)
+        return True
+
+    @classmethod
+    def _mbd_serve_index(cls, _section, directory, root="", match="", **_kwargs):
+        path, path_stat = cls._mbd_resolve(directory, root, match)
+
+        # Check that the path actually exists
+        if path_stat is None:
             # This will trigger a 404
             return False
 
@@ -119,19 +279,25 @@ class StaticWithIndex(cherrypy._cptools.HandlerTool):
             # This may return a "301 Moved Permanently" with Location dir + "/"
             cherrypy.lib.cptools.trailing_slash()
 
-            # Produce and deliver a new index
-            cherrypy.response.body = cls._mbd_html_index(path)
-            cherrypy.response.headers["Content-Type"] = "text/html"
+            # Produce and deliver a new index ('?format=json' for a machine-readable index)
+            if cherrypy.request.params.get("format") == "json":
+                cherrypy.response.body = cls._mbd_json_index(path)
+                cherrypy.response.headers["Content-Type"] = "application/json"
+            else:
+                cherrypy.response.body = cls._mbd_html_index(path)
+                cherrypy.response.headers["Content-Type"] = "text/html"
             return True
 
         return False
 
     @classmethod
-    def _mbd_serve(cls, section, directory, **kwargs):
-        "Try cherrypy static serve, fallback to . Try built-in static dir first"
-        if cherrypy.lib.static.staticdir(section, directory, **kwargs):
-            return True
-        return cls._mbd_serve_index(section, directory, **kwargs)
+    def _mbd_serve(cls, section, directory, root="", match="", content_types=None, **kwargs):
+        "Serve files via our static file engine, fall back to directory index."
+        if cherrypy.request.method in ("GET", "HEAD"):
+            path, path_stat = cls._mbd_resolve(directory, root, match)
+            if path_stat is not None and stat.S_ISREG(path_stat.st_mode):
+                return cls._mbd_serve_file(path, path_stat, content_types)
+        return cls._mbd_serve_index(section, directory, root=root, match=match, **kwargs)
 
     def __init__(self):
         super(StaticWithIndex, self).__init__(self._mbd_serve)
@@ -2,6 +2,7 @@
 from __future__ import unicode_literals
 
 import os
+import stat
 import copy
 import datetime
 import shutil
@@ -9,12 +10,16 @@ import codecs
 import glob
 import errno
 import subprocess
+import time
 import threading
+import collections
 import socket
 import Queue
 import multiprocessing
 import tempfile
 import hashlib
+import gzip
+import contextlib
 import base64
 import re
 import urllib
@@ -163,41 +168,237 @@ class ConfFile(object):
         open_utf8(self._file_path, "w").write(self._content)
 
 
-class BlockQueue(Queue.Queue):
+class FairQueue(object):
     """
-    Wrapper around Queue to get put() block until <= maxsize tasks are actually done.
-    In Queue.Queue, task_done() is only used together with join().
+    Weighted fair queue with any number of levels.
+
+    Items are put with a tuple of flow keys (one key per
+    level). On each level, the next item is taken from the flow
+    that got the least service relative to its weight, so a
+    burst of items in one flow does not starve the others. Items
+    of the same flow are taken in FIFO order. The weight function
+    applies to the top level only.
+
+    >>> q = FairQueue(levels=2, weight=lambda key: 2.0 if key == "big" else 1.0)
+    >>> for i in range(4):
+    ...     q.put(("big", "alice"), "alice{i}".format(i=i))
+    >>> q.put(("big", "bob"), "bob0")
+    >>> for i in range(3):
+    ...     q.put(("small", "carl"), "carl{i}".format(i=i))
+    >>> len(q)
+    8
+    >>> [q.get() for _i in range(len(q))]
+    [u'alice0', u'carl0', u'bob0', u'alice1', u'carl1', u'alice2', u'alice3', u'carl2']
+    >>> q.get()
+    Traceback (most recent call last):
+    ...
+    IndexError: get from an empty FairQueue
+    """
+    def __init__(self, levels=1, weight=None):
+        self._levels = levels
+        self._weight = weight if weight else lambda _key: 1.0
+        # key: [virtual time, sub queue]
+        self._flows = collections.OrderedDict()
+        self._vtime = 0.0
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def put(self, keys, item):
+        key = keys[0]
+        if key not in self._flows:
+            # New (or re-activated) flows start at the current virtual time
+            self._flows[key] = [self._vtime, FairQueue(levels=self._levels - 1) if self._levels > 1 else collections.deque()]
+
+        if self._levels > 1:
+            self._flows[key][1].put(keys[1:], item)
+        else:
+            self._flows[key][1].append(item)
+        self._len += 1
+
+    def get(self):
+        if not self._len:
+            raise IndexError("get from an empty FairQueue")
+
+        # min() gives the first match on ties, i.e., the oldest flow
+        key = min(self._flows, key=lambda k: self._flows[k][0])
+        flow = self._flows[key]
+        self._vtime = flow[0]
+        flow[0] += 1.0 / self._weight(key)
+
+        item = flow[1].get() if self._levels > 1 else flow[1].popleft()
+        self._len -= 1
+        if not flow[1]:
+            del self._flows[key]
+        return item
+
+
+class Histogram(object):
+    """
+    Simple histogram, for example for wait times in seconds.
+
+    >>> h = Histogram([1, 10, 60])
+    >>> for v in [0.5, 2, 3, 30, 100]:
+    ...     h.add(v)
+    >>> h.count, h.total
+    (5, 135.5)
+    >>> h.get()
+    [(1, 1), (10, 2), (60, 1), (None, 1)]
+    >>> h.__unicode__()
+    u'<=1s: 1, <=10s: 2, <=60s: 1, >60s: 1 (5 total, mean 27.1s)'
+    """
+    def __init__(self, bounds):
+        self._bounds = sorted(bounds)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def __unicode__(self):
+        return "{h} ({c} total, mean {m}s)".format(
+            h=", ".join(["{b}: {n}".format(b="<={b}s".format(b=b) if b is not None else ">{b}s".format(b=self._bounds[-1]), n=n) for b, n in self.get()]),
+            c=self.count,
+            m=self.mean)
+
+    @property
+    def mean(self):
+        return round(self.total / self.count, 1) if self.count else 0.0
+
+    def add(self, value):
+        index = len(self._bounds)
+        for i, b in enumerate(self._bounds):
+            if value <= b:
+                index = i
+                break
+        self._counts[index] += 1
+        self.count += 1
+        self.total += value
+
+    def get(self):
+        "Get list of (upper bound, count) tuples; the last bound is None (infinity)."
+        return zip(self._bounds + [None], self._counts)
+
 
-    This way can use the Queue directly to limit the number of
-    actually worked-on items for incoming and builds.
+class KeyedWorkerPool(object):
     """
-    def __init__(self, maxsize):
-        self._maxsize = maxsize
-        self._pending = 0
-        self._active = Queue.Queue(maxsize=maxsize)
-        Queue.Queue.__init__(self, maxsize=maxsize)
+    Bounded pool of worker threads, serializing items per key.
+
+    Items put with the same key are processed strictly in
+    order, one after another; items with different keys are
+    processed in parallel by up to 'size' workers.
+
+    >>> results = []
+    >>> pool = KeyedWorkerPool(2, lambda key, item: results.append((key, item)), name="test")
+    >>> for i in range(3):
+    ...     pool.put("a", i)
+    >>> pool.put("b", 0)
+    >>> pool.join()
+    >>> sorted(results)
+    [(u'a', 0), (u'a', 1), (u'a', 2), (u'b', 0)]
+    >>> [i for k, i in results if k == "a"]
+    [0, 1, 2]
+    >>> pool.queued, pool.busy, pool.has_free_worker()
+    (0, [None, None], True)
+    >>> pool.shutdown()
+
+    Producers that want to keep their own queue (for scheduling)
+    may only put items when has_free_worker(); 'on_release' is
+    called whenever a worker becomes free.
+    """
+    _SHUTDOWN = object()
+
+    def __init__(self, size, func, name="pool", on_release=None):
+        self._size = max(1, size)
+        self._func = func
+        self._name = name
+        self._on_release = on_release
+        self._shutdown = False
+
+        self._lock = threading.Lock()
+        # Items ready to be picked up by any worker (at most one per key)
+        self._ready = Queue.Queue()
+        # Active keys (queued in 'ready' or being processed), with items waiting for that key
+        self._backlog = {}
+        # Key each worker is currently working on (None if idle)
+        self._busy = [None] * self._size
+
+        self._threads = [run_as_thread(self._work, daemon=True, index=i) for i in range(self._size)]
 
     def __unicode__(self):
-        return "{l}: {n}/{m} ({p} pending)".format(
-            l=self.load,
-            n=self._active.qsize(),
-            m=self._maxsize,
-            p=self._pending)
+        return "{b}/{s} busy ({q} queued)".format(b=len([k for k in self.busy if k is not None]), s=self._size, q=self.queued)
+
+    @property
+    def size(self):
+        return self._size
 
     @property
-    def load(self):
-        return round(float(self._active.qsize() + self._pending) / self._maxsize, 2)
+    def queued(self):
+        "Number of items waiting to be processed."
+        with self._lock:
+            return self._ready.qsize() + sum([len(b) for b in self._backlog.values()])
 
-    def put(self, item, **kwargs):
-        self._pending += 1
-        self._active.put(item)
-        Queue.Queue.put(self, item, **kwargs)
-        self._pending -= 1
+    @property
+    def busy(self):
+        "List of keys each worker currently works on (None if idle)."
+        return list(self._busy)
+
+    def has_free_worker(self):
+        "If an item with a new key put now would be processed right away."
+        with self._lock:
+            return len(self._backlog) < self._size
+
+    def put(self, key, item):
+        with self._lock:
+            if key in self._backlog:
+                LOG.debug("{n}: Key '{k}' busy, item queued to its backlog".format(n=self._name, k=key))
+                self._backlog[key].append(item)
+            else:
+                self._backlog[key] = collections.deque()
+                self._ready.put((key, item))
+
+    def _work(self, index):
+        while True:
+            key, item = self._ready.get()
+            try:
+                if key is self._SHUTDOWN:
+                    break
 
-    def task_done(self):
-        self._active.get()
-        self._active.task_done()
-        return Queue.Queue.task_done(self)
+                if self._shutdown:
+                    LOG.info("{n}: Shutting down, skipping: {k}".format(n=self._name, k=key))
+                else:
+                    self._busy[index] = key
+                    try:
+                        self._func(key, item)
+                    except Exception as e:
+                        mini_buildd.setup.log_exception(LOG, "{n}: Worker {i} failed on '{k}'".format(n=self._name, i=index, k=key), e)
+                    finally:
+                        self._busy[index] = None
+
+                # Release the key, or pass on the next item waiting for it
+                with self._lock:
+                    released = not self._backlog[key] or self._shutdown
+                    if released:
+                        del self._backlog[key]
+                    else:
+                        self._ready.put((key, self._backlog[key].popleft()))
+                if released and self._on_release:
+                    self._on_release()
+            finally:
+                self._ready.task_done()
+
+    def join(self):
+        "Block until all items put so far are processed."
+        self._ready.join()
+
+    def shutdown(self):
+        """
+        Stop all workers. Items currently processed are finished, any other queued items are skipped.
+        """
+        self._shutdown = True
+        for _t in self._threads:
+            self._ready.put((self._SHUTDOWN, None))
+        for t in self._threads:
+            t.join()
 
 
 class HoPo(object):
@@ -440,18 +641,452 @@ def run_as_thread(thread_func=None, daemon=False, **kwargs):
     return thread
 
 
+class Checksums(object):
+    """
+    Checksum engine: Compute (common) digests of a file in one pass, with a stat-keyed cache.
+
+    Files are read in large chunks, and all requested digests
+    are updated from the same buffer. Results are memoized by
+    (device, inode, size, mtime), so hashing the same (possibly
+    huge) file again is just a stat() call.
+
+    Asking for one digest only computes (and caches) that one;
+    all digests are computed in one pass when asking for the
+    full dict (i.e., for files we know we need them all for).
+
+    >>> import tempfile
+    >>> t = tempfile.NamedTemporaryFile()
+    >>> t.write(b"mini-buildd")
+    >>> t.flush()
+    >>> c = Checksums()
+    >>> c.get(t.name)["md5"]
+    '96bdca2d106eee69e9e7ba67145ed0ae'
+    >>> c.get(t.name)["sha1"] == c.get(t.name, "sha1")
+    True
+    >>> c.hits, c.misses
+    (2, 1)
+    >>> c.get(t.name, "sha512")[:16]
+    'aa9566d6d7263460'
+    >>> sorted(c.get_many([t.name, t.name]).keys()) == [t.name]
+    True
+
+    >>> c = Checksums()
+    >>> c.get(t.name, "sha1")
+    'db295eb9bd7b23464a468f45524b226d5301bb6b'
+    >>> sorted(c.peek(t.name).keys())
+    [u'sha1']
+    >>> c.get(t.name)["md5"]
+    '96bdca2d106eee69e9e7ba67145ed0ae'
+    >>> sorted(c.peek(t.name).keys())
+    [u'md5', u'sha1', u'sha256']
+    >>> c.hits, c.misses
+    (0, 2)
+    """
+    HASH_TYPES = ["md5", "sha1", "sha256"]
+    BUFFER_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, max_entries=4096):
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        # (dev, ino, size, mtime): {hash_type: hexdigest}
+        self._cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __unicode__(self):
+        return "{n} cached ({h} hits, {m} misses)".format(n=len(self._cache), h=self.hits, m=self.misses)
+
+    @classmethod
+    def _key(cls, file_name):
+        # Note: Python 2.7 has no st_mtime_ns; float st_mtime still carries sub-second resolution
+        s = os.stat(file_name)
+        return (s.st_dev, s.st_ino, s.st_size, s.st_mtime)
+
+    @classmethod
+    def compute(cls, file_name, hash_types=None):
+        "Compute digests of file contents in one pass (uncached)."
+        hashes = [(t, hashlib.new(t)) for t in hash_types or cls.HASH_TYPES]
+        with open(file_name, "rb") as f:
+            while True:
+                data = f.read(cls.BUFFER_SIZE)
+                if not data:
+                    break
+                for _t, h in hashes:
+                    h.update(data)
+        return dict([(t, h.hexdigest()) for t, h in hashes])
+
+    def get(self, file_name, hash_type=None):
+        """
+        Get digests dict of file (or just the one digest of hash_type).
+
+        Digests of hash types other than HASH_TYPES are not cached.
+        """
+        if hash_type and hash_type not in self.HASH_TYPES:
+            return self.compute(file_name, [hash_type])[hash_type]
+
+        wanted = [hash_type] if hash_type else self.HASH_TYPES
+        key = self._key(file_name)
+        with self._lock:
+            digests = dict(self._cache.get(key, {}))
+            missing = [t for t in wanted if t not in digests]
+            if not missing:
+                self.hits += 1
+                self._cache[key] = self._cache.pop(key)
+
+        if missing:
+            computed = self.compute(file_name, missing)
+            digests.update(computed)
+            with self._lock:
+                self.misses += 1
+                # Only cache if the file did not change while we were reading it
+                if self._key(file_name) == key:
+                    entry = self._cache.pop(key, {})
+                    entry.update(computed)
+                    self._cache[key] = entry
+                    while len(self._cache) > self._max_entries:
+                        self._cache.popitem(last=False)
+
+        return digests[hash_type] if hash_type else digests
+
+    def peek(self, file_name, stat_result=None):
+        "Get cached digests dict of file (None if not known); never computes."
+        s = stat_result or os.stat(file_name)
+        with self._lock:
+            return self._cache.get((s.st_dev, s.st_ino, s.st_size, s.st_mtime))
+
+    def get_many(self, file_names, workers=4):
+        """
+        Get {file_name: digests} for many files (i.e., all files of one upload) concurrently.
+
+        hashlib releases the GIL for large updates, so this
+        actually runs in parallel on multiple CPUs.
+        """
+        file_names = list(collections.OrderedDict.fromkeys(file_names))
+        results, errors = {}, []
+        todo = Queue.Queue()
+        for f in file_names:
+            todo.put(f)
+
+        def worker():
+            while True:
+                try:
+                    f = todo.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    results[f] = self.get(f)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _i in range(min(workers, len(file_names)))]
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        return results
+
+
+CHECKSUMS = Checksums()
+
+
+class DirListings(object):
+    """
+    Cache of directory listings, keyed by directory path and mtime.
+
+    A listing is made in one os.listdir() and lstat() pass
+    (symlinks are resolved). As only the directory's mtime is
+    checked, in-place changes of entries (like a growing file)
+    are not reflected until the directory itself changes.
+
+    >>> d = tempfile.mkdtemp()
+    >>> os.mkdir(os.path.join(d, "subdir"))
+    >>> open(os.path.join(d, "file"), "w").write("1234")
+    >>> l = DirListings()
+    >>> [(e["name"], e["dir"], e["size"]) for e in l.get(d)]
+    [('subdir', True, None), ('file', False, 4)]
+    >>> l.get(d) is l.get(d), l.hits
+    (True, 2)
+    >>> open(os.path.join(d, "file2"), "w").write("")
+    >>> os.utime(d, (0, 0))
+    >>> [e["name"] for e in l.get(d)]
+    ['subdir', 'file', 'file2']
+    """
+    def __init__(self, max_entries=256):
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        # path: (mtime, entries)
+        self._cache = collections.OrderedDict()
+        self.hits = 0
+
+    @classmethod
+    def _list(cls, directory):
+        entries = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                s = os.lstat(path)
+                if stat.S_ISLNK(s.st_mode):
+                    s = os.stat(path)
+            except OSError:
+                # Vanished, or dangling symlink
+                continue
+            is_dir = stat.S_ISDIR(s.st_mode)
+            entries.append({"name": name,
+                            "dir": is_dir,
+                            "size": None if is_dir else s.st_size,
+                            "mtime": s.st_mtime,
+                            "stat": s})
+        # Dirs first, and sort entries by name
+        return sorted(entries, key=lambda e: (not e["dir"], e["name"]))
+
+    def get(self, directory):
+        "Get list of entry dicts (name, dir, size, mtime, stat) of directory."
+        mtime = os.stat(directory).st_mtime
+        with self._lock:
+            cached = self._cache.get(directory)
+            if cached is not None and cached[0] == mtime:
+                self.hits += 1
+                self._cache[directory] = self._cache.pop(directory)
+                return cached[1]
+
+        entries = self._list(directory)
+        with self._lock:
+            self._cache[directory] = (mtime, entries)
+            while len(self._cache) > self._max_entries:
+                self._cache.popitem(last=False)
+        return entries
+
+
+class BlobStore(object):
+    """
+    Content-addressed (sha256) file store with a size cap; least recently used blobs are evicted first.
+
+    Blobs are hardlinks to pool or upload files, so usage is
+    recorded in the store (never via the files' mtimes). Blobs
+    negotiated (see missing()) are pinned until a build request
+    gets them, or PIN_TIMEOUT passes; a blob just added is never
+    evicted right away (even if it alone exceeds the cap). Blobs
+    may be added in the background (see add_background());
+    get() waits for these.
+
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> open(os.path.join(d, "orig.tar.gz"), "w").write("orig")
+    >>> mtime = os.path.getmtime(os.path.join(d, "orig.tar.gz"))
+    >>> sha = CHECKSUMS.get(os.path.join(d, "orig.tar.gz"), "sha256")
+    >>> b = BlobStore(os.path.join(d, "store"), max_size=1)
+    >>> b.missing([sha, "0" * 64]) == [sha, "0" * 64]
+    True
+    >>> b.add(os.path.join(d, "orig.tar.gz"), sha)
+    >>> b.missing([sha, "0" * 64]) == ["0" * 64]
+    True
+    >>> b.get(sha, os.path.join(d, "copy.tar.gz"))
+    >>> open(os.path.join(d, "copy.tar.gz")).read()
+    'orig'
+    >>> os.path.getmtime(os.path.join(d, "orig.tar.gz")) == mtime
+    True
+    >>> b.add(os.path.join(d, "orig.tar.gz"), "0" * 64)
+    Traceback (most recent call last):
+    ...
+    Exception: Blob checksum mismatch: 0000000000000000000000000000000000000000000000000000000000000000
+    >>> b.max_size = 0
+    >>> b.add(os.path.join(d, "orig.tar.gz"), sha)
+    >>> b.missing([sha]) == []
+    True
+    >>> b.expire()
+    >>> os.path.exists(os.path.join(b.path, sha))
+    True
+    >>> b.get(sha, os.path.join(d, "copy1.tar.gz"))
+    >>> b.get(sha, os.path.join(d, "copy2.tar.gz"))
+    >>> b.expire()
+    >>> b.missing([sha]) == [sha]
+    True
+    >>> shutil.copy(os.path.join(d, "orig.tar.gz"), os.path.join(d, "received"))
+    >>> b.add_background(os.path.join(d, "received"), sha)
+    >>> b.get(sha, os.path.join(d, "copy3.tar.gz"))
+    >>> os.path.exists(os.path.join(d, "received"))
+    False
+    """
+    PIN_TIMEOUT = 3600
+
+    def __init__(self, path, max_size=8192):
+        self.path = path
+        # MiB
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # sha256: time of last use
+        self._used = {}
+        # sha256: list of pin expiry times (one per negotiation)
+        self._pins = {}
+        # Blobs currently added in the background
+        self._adding = set()
+        self._adding_cond = threading.Condition()
+        mkdirs(self.path)
+
+    def _path(self, sha256):
+        if not re.match(r"^[0-9a-f]{64}$", sha256):
+            raise Exception("Invalid blob id: {s}".format(s=sha256))
+        return os.path.join(self.path, sha256)
+
+    def pin(self, sha256s):
+        "Pin blobs (present, or still to come) until a build request gets them (or PIN_TIMEOUT passes)."
+        with self._lock:
+            for sha256 in sha256s:
+                self._path(sha256)
+                self._pins.setdefault(sha256, []).append(time.time() + self.PIN_TIMEOUT)
+
+    def _unpin(self, sha256):
+        with self._lock:
+            pins = self._pins.get(sha256)
+            if pins:
+                pins.pop(0)
+            if not pins:
+                self._pins.pop(sha256, None)
+
+    def _use(self, sha256):
+        with self._lock:
+            self._used[sha256] = time.time()
+
+    def missing(self, sha256s):
+        "Get list of blobs we don't have. All blobs asked for are pinned, blobs we have are marked as used."
+        self.pin(sha256s)
+        result = []
+        for sha256 in sha256s:
+            if os.path.exists(self._path(sha256)):
+                self._use(sha256)
+            else:
+                result.append(sha256)
+        return result
+
+    def add(self, file_name, sha256):
+        "Add file as blob (hardlinked if possible)."
+        path = self._path(sha256)
+        tmp = path + ".new"
+        link_or_copy(file_name, tmp)
+        if CHECKSUMS.get(tmp, "sha256") != sha256:
+            os.remove(tmp)
+            raise Exception("Blob checksum mismatch: {s}".format(s=sha256))
+        os.rename(tmp, path)
+        self._use(sha256)
+        self.expire(keep=path)
+
+    def add_background(self, file_name, sha256):
+        "Add file as blob in a background thread (checksumming may take a while), and remove file."
+        def run():
+            try:
+                self.add(file_name, sha256)
+                LOG.info("Blob added: {s}".format(s=sha256))
+            except Exception as e:
+                mini_buildd.setup.log_exception(LOG, "Invalid blob: {f}".format(f=file_name), e, logging.WARNING)
+            finally:
+                os.remove(file_name)
+                with self._adding_cond:
+                    self._adding.discard(sha256)
+                    self._adding_cond.notify_all()
+
+        with self._adding_cond:
+            self._adding.add(sha256)
+        thread = threading.Thread(target=run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def get(self, sha256, file_name):
+        "Put blob at file_name (hardlinked if possible), and release one pin."
+        path = self._path(sha256)
+        with self._adding_cond:
+            while sha256 in self._adding:
+                self._adding_cond.wait()
+        if not os.path.exists(path):
+            raise Exception("Blob missing: {s}".format(s=sha256))
+        self._use(sha256)
+        link_or_copy(path, file_name)
+        self._unpin(sha256)
+
+    def expire(self, keep=None):
+        "Evict least recently used blobs (but never 'keep', or pinned ones) until we are below max_size."
+        with self._lock:
+            now = time.time()
+            for sha256, pins in self._pins.items():
+                pins[:] = [p for p in pins if p > now]
+                if not pins:
+                    del self._pins[sha256]
+
+            # Blobs not used since we started: Creation time is the best guess
+            blobs = sorted([(self._used.get(os.path.basename(f)) or os.path.getmtime(f), os.path.getsize(f), f)
+                            for f in glob.glob(os.path.join(self.path, "*")) if not f.endswith(".new")])
+            size = sum([b[1] for b in blobs])
+            for _used, blob_size, f in blobs:
+                if size <= self.max_size * 1024 * 1024:
+                    break
+                sha256 = os.path.basename(f)
+                if f != keep and sha256 not in self._pins:
+                    LOG.info("Blob store: Evicting: {f}".format(f=f))
+                    os.remove(f)
+                    self._used.pop(sha256, None)
+                    size -= blob_size
+
+
+def link_or_copy(src, dst):
+    "Hardlink src to dst, or copy if not on the same file system. An existing dst is replaced."
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+
+def write_atomic(path, data):
+    """
+    Write data (bytes) to a temporary file, and rename it to path.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "file")
+    >>> write_atomic(path, b"data")
+    >>> open(path).read(), os.path.exists(path + ".new")
+    ('data', False)
+    """
+    tmp = path + ".new"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.rename(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def gen_gzip_variant(file_name, level=6):
+    """
+    Generate a precompressed '.gz' variant of a file (for static http serving).
+
+    The default level is considerably cheaper than 9, at nearly the same ratio for text.
+
+    >>> t = tempfile.NamedTemporaryFile()
+    >>> t.write(b"A log file\\n" * 100)
+    >>> t.flush()
+    >>> import gzip
+    >>> gzip.open(gen_gzip_variant(t.name)).read() == open(t.name).read()
+    True
+    >>> os.remove(t.name + ".gz")
+    """
+    gz_file = file_name + ".gz"
+    tmp = gz_file + ".new"
+    with open(file_name, "rb") as src, contextlib.closing(gzip.GzipFile(tmp, "wb", level)) as dst:
+        shutil.copyfileobj(src, dst)
+    os.rename(tmp, gz_file)
+    return gz_file
+
+
 def hash_of_file(file_name, hash_type="md5"):
     """
     Helper to get any hash from file contents.
     """
-    md5 = hashlib.new(hash_type)
-    with open(file_name, "rb") as f:
-        while True:
-            data = f.read(128)
-            if not data:
-                break
-            md5.update(data)
-    return md5.hexdigest()
+    return CHECKSUMS.get(file_name, hash_type)
 
 
 def md5_of_file(file_name):
@@ -502,6 +1137,33 @@ def get_cpus():
         return 1
 
 
+def get_mem_available():
+    """
+    Get available memory in MiB (from /proc/meminfo; None if not available).
+    """
+    try:
+        info = {}
+        for line in open("/proc/meminfo"):
+            key, _sep, value = line.partition(":")
+            info[key] = int(value.split()[0])
+        # MemAvailable is only available from linux 3.14
+        kib = info["MemAvailable"] if "MemAvailable" in info else info["MemFree"] + info.get("Buffers", 0) + info.get("Cached", 0)
+        return kib // 1024
+    except Exception as e:
+        LOG.debug("Can't get available memory: {e}".format(e=e))
+
+
+def get_disk_free(path):
+    """
+    Get free disk space in MiB for path (None if not available).
+    """
+    try:
+        s = os.statvfs(path)
+        return s.f_bavail * s.f_frsize // (1024 * 1024)
+    except Exception as e:
+        LOG.debug("Can't get free disk space for {p}: {e}".format(p=path, e=e))
+
+
 def list_get(list_, index, default=None):
     try:
         return list_[index]
@@ -85,7 +85,7 @@ automatically added.""")
 
     sbuild_jobs = django.db.models.IntegerField(
         default=1,
-        help_text="Degree of parallelism per build (via sbuild's '--jobs' option).")
+        help_text="Minimum degree of parallelism per build (via DEB_BUILD_OPTIONS 'parallel'). The actual degree is chosen per build as fair share of the CPU cores (see extra option 'Build-Max-Jobs').")
 
     # EMail options
     # DEPRECTATED/UNUSED: With the switch to django mail framework, this is now configured via the --smtp command line argument.
@@ -142,7 +142,24 @@ prepare/remove actions will generate/remove the GnuPG key.
             ("FTP (incoming) Options", {"fields": ("ftpd_bind", "ftpd_options")}),
             ("Load Options", {"fields": ("build_queue_size", "sbuild_jobs")}),
             ("E-Mail Options", {"fields": ("smtp_server", "notify", "allow_emails_to")}),
-            ("Other Options", {"fields": ("gnupg_keyserver", "custom_hooks_directory", "show_last_packages", "show_last_builds")}))
+            ("Other Options", {"fields": ("gnupg_keyserver", "custom_hooks_directory", "show_last_packages", "show_last_builds")}),
+            ("Extra Options", {"classes": ("collapse",),
+                               "description": """
+<b>Supported extra options</b>
+<p><em>Packager-Workers: N</em>: Maximum number of incoming events (user uploads, build results) the packager works on in parallel (defaults to the number of CPUs). Events of the same source package are always processed one after another.</p>
+<p><em>Incoming-Weights: REPOID=WEIGHT[ REPOID=WEIGHT[...</em>: Weights for fair queuing of user uploads per repository (defaults to 1.0). For example, with <tt>Incoming-Weights: test=2</tt>, uploads to repository 'test' get twice the share of other repositories when incoming is busy.</p>
+<p><em>Build-Max-Jobs: N</em>: Maximum degree of parallelism per build (defaults to 0, i.e. no maximum but the build's fair share of the CPU cores).</p>
+<p><em>Build-Min-Memory: MiB</em>: Memory needed per build; only start another build when at least this much memory is available for it (defaults to 1024).</p>
+<p><em>Build-Min-Disk: MiB</em>: Disk space needed per build; only start another build when at least this much disk space is free for it in the spool directory (defaults to 4096).</p>
+<p><em>Chroot-Setup-Cache-Hours: N</em>: Maximum age of cached chroot setup states; builds with the same setup inputs and unchanged apt sources start from such a state, and skip the setup commands (defaults to 24; 0 disables the cache).</p>
+<p><em>Remote-Status-TTL: SECONDS</em>: Remote statuses are refreshed in the background in this interval, and build request dispatch uses these (defaults to 60).</p>
+<p><em>FTP-Upload-Parallel: N</em>: Maximum number of parallel ftp connections per upload to remotes (defaults to 3).</p>
+<p><em>FTP-Upload-Blocksize: KiB</em>: Block size for ftp uploads to remotes (defaults to 1024).</p>
+<p><em>Blob-Store-Size: MiB</em>: Size cap of the store of source files received from other instances via blob negotiation; least recently used ones are evicted first (defaults to 8192).</p>
+<p><em>Tar-Codecs: CODEC ...</em>: Compression for build request and build result tars, in order of preference: 'zstd', 'xz', 'gz' or 'none' (defaults to 'gz'). Build requests use the first one available here that the remote builder advertises in its status (else 'none'); builders use the first one available there for the result.</p>
+<p><em>Incoming-Watcher: auto|inotify|poll|off</em>: How to watch the incoming directory for changes files not uploaded via ftp (rsync, scp, local copies). Defaults to 'auto', i.e. 'inotify' if python-pyinotify is installed, 'poll' otherwise.</p>
+""",
+                               "fields": ("extra_options",)}))
 
         filter_horizontal = ("notify",)
 
@@ -168,6 +185,72 @@ prepare/remove actions will generate/remove the GnuPG key.
         self._mbd_gnupg_long_id = self._mbd_gnupg.get_first_sec_key().key_id
         self._mbd_gnupg_fingerprint = self._mbd_gnupg.get_first_sec_key_fingerprint().user_id
 
+    @property
+    def packager_workers(self):
+        " Field temporarily implemented as extra_option. "
+        return int(self.mbd_get_extra_option("Packager-Workers", "{n}".format(n=mini_buildd.misc.get_cpus())))
+
+    @property
+    def incoming_weights(self):
+        " Field temporarily implemented as extra_option. "
+        weights = {}
+        for w in self.mbd_get_extra_option("Incoming-Weights", "").split():
+            repository, _sep, weight = w.partition("=")
+            weights[repository] = float(weight)
+            if weights[repository] <= 0:
+                raise Exception("Incoming-Weights: Weight must be positive: {w}".format(w=w))
+        return weights
+
+    @property
+    def build_max_jobs(self):
+        " Field temporarily implemented as extra_option. "
+        return int(self.mbd_get_extra_option("Build-Max-Jobs", "0"))
+
+    @property
+    def build_min_memory(self):
+        " Field temporarily implemented as extra_option. "
+        return int(self.mbd_get_extra_option("Build-Min-Memory", "1024"))
+
+    @property
+    def build_min_disk(self):
+        " Field temporarily implemented as extra_option. "
+        return int(self.mbd_get_extra_option("Build-Min-Disk", "4096"))
+
+    @property
+    def chroot_setup_cache_hours(self):
+        " Field temporarily implemented as extra_option. "
+        return int(self.mbd_get_extra_option("Chroot-Setup-Cache-Hours", "24"))
+
+    @property
+    def remote_status_ttl(self):
+        " Field temporarily implemented as extra_option. "
+        return int(self.mbd_get_extra_option("Remote-Status-TTL", "60"))
+
+    @property
+    def ftp_upload_parallel(self):
+        " Field temporarily implemented as extra_option. "
+        return int(self.mbd_get_extra_option("FTP-Upload-Parallel", "3"))
+
+    @property
+    def ftp_upload_blocksize(self):
+        " Field temporarily implemented as extra_option. "
+        return int(self.mbd_get_extra_option("FTP-Upload-Blocksize", "1024"))
+
+    @property
+    def blob_store_size(self):
+        " Field temporarily implemented as extra_option. "
+        return int(self.mbd_get_extra_option("Blob-Store-Size", "8192"))
+
+    @property
+    def tar_codecs(self):
+        " Field temporarily implemented as extra_option. "
+        return self.mbd_get_extra_option("Tar-Codecs", "gz").split()
+
+    @property
+    def incoming_watcher(self):
+        " Field temporarily implemented as extra_option. "
+        return self.mbd_get_extra_option("Incoming-Watcher", "auto")
+
     @property
     def mbd_fullname(self):
         return self._mbd_fullname
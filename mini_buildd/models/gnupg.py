@@ -2,6 +2,7 @@
 from __future__ import unicode_literals
 
 import urllib2
+import pickle
 import contextlib
 import logging
 
@@ -173,10 +174,17 @@ class Remote(KeyringKey):
         return "{h}: {c}".format(h=self.http,
                                  c=status.chroots_str())
 
+    def _mbd_fetch_status_pickled(self):
+        url = "http://{h}/mini_buildd/api?command=status&output=python".format(h=self.http)
+        return urllib2.urlopen(url, timeout=10).read()
+
+    def mbd_fetch_status(self):
+        "Get current status from remote (without saving it)."
+        return pickle.loads(self._mbd_fetch_status_pickled())
+
     def mbd_get_status(self, update=False):
         if update:
-            url = "http://{h}/mini_buildd/api?command=status&output=python".format(h=self.http)
-            self.mbd_set_pickled_data_pickled(urllib2.urlopen(url, timeout=10).read())
+            self.mbd_set_pickled_data_pickled(self._mbd_fetch_status_pickled())
         return self.mbd_get_pickled_data(default=mini_buildd.api.Status({}))
 
     def mbd_prepare(self, request):
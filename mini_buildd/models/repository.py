@@ -6,6 +6,7 @@ from __future__ import unicode_literals
 import os
 import copy
 import contextlib
+import functools
 import shutil
 import glob
 import re
@@ -15,7 +16,6 @@ import debian.debian_support
 
 import django.db
 import django.core.exceptions
-import django.contrib.auth.models
 
 import mini_buildd.setup
 import mini_buildd.misc
@@ -604,6 +604,15 @@ distribution.
         return [r for r in self.repository_set.all()]
 
 
+def _reprepro_batch(method):
+    "Repository method decorator: Run all reprepro calls as one batch (see reprepro.Reprepro.batch())."
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._mbd_reprepro().batch():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class Repository(mini_buildd.models.base.StatusModel):
     identity = django.db.models.CharField(primary_key=True, max_length=50, default="test",
                                           help_text="""\
@@ -734,31 +743,17 @@ Example:
             with contextlib.closing(self.mbd_get_daemon().get_test_package(t)) as package:
                 self._mbd_portext2keyring_suites(request, "file://" + package.dsc)
 
-    def mbd_get_uploader_keyring(self):
-        gpg = mini_buildd.gnupg.TmpGnuPG()
-        # Add keys from django users
-        # pylint: disable=E1101
-        for u in django.contrib.auth.models.User.objects.filter(is_active=True):
-            # pylint: enable=E1101
-            LOG.debug("Checking user: {u}".format(u=u))
-
-            uploader = None
-            try:
-                uploader = u.get_profile()
-            except:
-                LOG.warn("User '{u}' does not have an uploader profile (deliberately removed?)".format(u=u))
-
-            if uploader and uploader.mbd_is_active() and uploader.may_upload_to.all().filter(identity=self.identity):
-                LOG.info("Adding uploader key for '{r}': {k}: {n}".format(r=self, k=uploader.key_long_id, n=uploader.key_name))
-                gpg.add_pub_key(uploader.key)
-
-        # Add configured extra keyrings
+    def mbd_get_extra_uploader_keyrings(self):
+        "Get list of configured extra uploader keyring files."
+        result = []
         for l in self.extra_uploader_keyrings.splitlines():
             l = l.strip()
             if l and l[0] != "#":
-                LOG.info("Adding keyring: {k}".format(k=l))
-                gpg.add_keyring(l)
-        return gpg
+                result.append(l)
+        return result
+
+    def mbd_get_pool_index(self):
+        return self._mbd_reprepro().pool_index
 
     def mbd_get_path(self):
         return os.path.join(mini_buildd.setup.REPOSITORIES_DIR, self.identity)
@@ -1010,9 +1005,10 @@ DscIndices: Sources Release . .gz .bz2
                 shutil.rmtree(pkg_log, ignore_errors=True)
                 msglog.info("Purging orphaned package log: {p}".format(p=pkg_log))
 
-    def mbd_package_purge_orphaned_logs(self, package=None, msglog=LOG):
-        if package:
-            self._mbd_package_purge_orphaned_logs(package, msglog=msglog)
+    def mbd_package_purge_orphaned_logs(self, package=None, packages=None, msglog=LOG):
+        if package or packages:
+            for p in sorted(set((packages or []) + ([package] if package else []))):
+                self._mbd_package_purge_orphaned_logs(p, msglog=msglog)
         else:
             for pkg_dir in glob.glob(mini_buildd.misc.PkgLog.get_path(self.identity, True, "[!_]*")):
                 self._mbd_package_purge_orphaned_logs(os.path.basename(os.path.realpath(pkg_dir)), msglog=msglog)
@@ -1029,12 +1025,12 @@ DscIndices: Sources Release . .gz .bz2
                 mini_buildd.setup.log_exception(LOG, "Rollback failed (ignoring)", e)
         return reprepro_output
 
-    def mbd_package_migrate(self, package, distribution, suite, rollback=None, version=None, msglog=LOG):
-        reprepro_output = ""
-
+    def _mbd_package_migrate_check(self, package, distribution, suite, rollback=None, version=None, msglog=LOG):
+        """
+        Check that a migration is possible; return tuple (src_dist, dst_dist, src_pkg, dst_pkg).
+        """
         src_dist = suite.mbd_get_distribution_string(self, distribution)
         pkg_show = self._mbd_reprepro().show(package)
-        src_pkg = None
 
         if rollback is not None:
             dst_dist = src_dist
@@ -1046,9 +1042,7 @@ DscIndices: Sources Release . .gz .bz2
             src_pkg = self._mbd_package_find(pkg_show, distribution=rob_dist, version=version)
             if src_pkg is None:
                 raise Exception("Package '{p}' has no such version in rollback '{r}'".format(p=package, r=rollback))
-
-            # Actually migrate package in reprepro
-            reprepro_output += self._mbd_reprepro().migrate(package, rob_dist, dst_dist, version)
+            return rob_dist, dst_dist, src_pkg, None
         else:
             # Get src and dst dist strings, and check we are configured to migrate
             if not suite.migrates_to:
@@ -1064,29 +1058,49 @@ DscIndices: Sources Release . .gz .bz2
             dst_pkg = self._mbd_package_find(pkg_show, distribution=dst_dist)
             if dst_pkg is not None and src_pkg["sourceversion"] == dst_pkg["sourceversion"]:
                 raise Exception("Version '{v}' already migrated to '{d}'".format(v=src_pkg["sourceversion"], d=dst_dist))
+            return src_dist, dst_dist, src_pkg, dst_pkg
 
-            # Shift rollbacks in the destination distributions
-            if dst_pkg is not None:
-                reprepro_output += self._mbd_package_shift_rollbacks(distribution, suite.migrates_to, package)
+    def _mbd_package_migrate(self, package, distribution, suite, check, version=None):
+        reprepro_output = ""
+        src_dist, dst_dist, _src_pkg, dst_pkg = check
 
-            # Actually migrate package in reprepro
-            reprepro_output += self._mbd_reprepro().migrate(package, src_dist, dst_dist, version)
+        # Shift rollbacks in the destination distributions
+        if dst_pkg is not None:
+            reprepro_output += self._mbd_package_shift_rollbacks(distribution, suite.migrates_to, package)
+
+        # Actually migrate package in reprepro
+        reprepro_output += self._mbd_reprepro().migrate(package, src_dist, dst_dist, version)
+
+        # Update pool index
+        self._mbd_reprepro().pool_index.update(package)
+        return reprepro_output
 
-        # Finally, purge any now-maybe-orphaned package logs
+    @_reprepro_batch
+    def mbd_package_migrate(self, package, distribution, suite, rollback=None, version=None, msglog=LOG):
+        check = self._mbd_package_migrate_check(package, distribution, suite, rollback=rollback, version=version, msglog=msglog)
+        reprepro_output = self._mbd_package_migrate(package, distribution, suite, check, version)
+
+        # Purge any now-maybe-orphaned package logs
         self.mbd_package_purge_orphaned_logs(package, msglog=msglog)
 
         # Notify
-        self.mbd_package_notify("MIGRATED", dst_dist, src_pkg, reprepro_output, msglog=msglog)
+        self.mbd_package_notify("MIGRATED", check[1], check[2], reprepro_output, msglog=msglog)
 
         return reprepro_output
 
-    def mbd_package_remove(self, package, distribution, suite, rollback=None, version=None, msglog=LOG):
-        reprepro_output = ""
-
+    def _mbd_package_remove_check(self, package, distribution, suite, rollback=None, version=None):
+        """
+        Check that a removal is possible; return tuple (dist_str, src_pkg).
+        """
         dist_str = suite.mbd_get_distribution_string(self, distribution, rollback)
         src_pkg = self.mbd_package_find(package, distribution=dist_str, version=version)
         if not src_pkg:
             raise Exception("Package '{p}' not in '{d}'".format(p=package, d=dist_str))
+        return dist_str, src_pkg
+
+    def _mbd_package_remove(self, package, distribution, suite, check, rollback=None, version=None, msglog=LOG):
+        reprepro_output = ""
+        dist_str, _src_pkg = check
 
         if rollback is None:
             # Shift rollbacks
@@ -1110,14 +1124,90 @@ DscIndices: Sources Release . .gz .bz2
                                                     e,
                                                     logging.WARN)
 
-        # Finally, purge any now-maybe-orphaned package logs
+        # Update pool index
+        self._mbd_reprepro().pool_index.update(package)
+        return reprepro_output
+
+    @_reprepro_batch
+    def mbd_package_remove(self, package, distribution, suite, rollback=None, version=None, msglog=LOG):
+        check = self._mbd_package_remove_check(package, distribution, suite, rollback=rollback, version=version)
+        reprepro_output = self._mbd_package_remove(package, distribution, suite, check, rollback=rollback, version=version, msglog=msglog)
+
+        # Purge any now-maybe-orphaned package logs
         self.mbd_package_purge_orphaned_logs(package, msglog=msglog)
 
         # Notify
-        self.mbd_package_notify("REMOVED", dist_str, src_pkg, reprepro_output, msglog=msglog)
+        self.mbd_package_notify("REMOVED", check[0], check[1], reprepro_output, msglog=msglog)
 
         return reprepro_output
 
+    def mbd_package_resolve(self, dist_str, packages=None, pattern=None):
+        """
+        Get sorted list of unique source package names in a distribution from explicit names and/or a (glob) pattern.
+        """
+        result = set(packages or [])
+        if pattern:
+            result.update([p["package"] for p in self._mbd_reprepro().list(pattern, dist_str, typ="dsc", list_max=100000)])
+        if not result:
+            raise Exception("No packages given or matching in '{d}'".format(d=dist_str))
+        return sorted(result)
+
+    def _mbd_package_bulk(self, status, packages, check_func, run_func, msglog=LOG):
+        """
+        Run a bulk action: Under one repository lock, check all packages first (all or nothing), then run all
+        reprepro calls with one export per distribution. Then purge logs, and notify once (summary).
+
+        ``check_func(package)`` must return a tuple (dist_str, pkg, ...).
+        """
+        results = []
+        with self._mbd_reprepro().batch(locked=True):
+            checks, errors = [], []
+            for package in packages:
+                try:
+                    checks.append((package, check_func(package)))
+                except Exception as e:
+                    errors.append("{p}: {e}".format(p=package, e=e))
+            if errors:
+                raise Exception("Bulk check failed for {n} package(s), nothing done: {e}".format(n=len(errors), e="; ".join(errors)))
+
+            for package, check in checks:
+                results.append((package, check, run_func(package, check)))
+
+        reprepro_output = "".join([r[2] for r in results])
+
+        # Purge any now-maybe-orphaned package logs
+        self.mbd_package_purge_orphaned_logs(packages=[package for package, _check, _output in results], msglog=msglog)
+
+        # Notify (one summary)
+        if results:
+            dist_str = ", ".join(sorted(set([check[0] for _package, check, _output in results])))
+            self.mbd_get_daemon().model.mbd_notify(
+                "{s} ({d}): {n} package(s)".format(s=status, d=dist_str, n=len(results)),
+                "".join(["{d}: {p} {v}\n".format(d=c[0], p=c[1]["source"], v=c[1]["sourceversion"]) for _p, c, _o in results]) + "\n" + reprepro_output,
+                repository=self,
+                distribution=results[0][1][0],
+                msglog=msglog)
+
+        return reprepro_output
+
+    def mbd_package_migrate_bulk(self, packages, distribution, suite, rollback=None, msglog=LOG):
+        def check(package):
+            src_dist, dst_dist, src_pkg, dst_pkg = self._mbd_package_migrate_check(package, distribution, suite, rollback=rollback, msglog=msglog)
+            return dst_dist, src_pkg, (src_dist, dst_dist, src_pkg, dst_pkg)
+
+        return self._mbd_package_bulk("MIGRATED",
+                                      packages,
+                                      check,
+                                      lambda package, c: self._mbd_package_migrate(package, distribution, suite, c[2]),
+                                      msglog=msglog)
+
+    def mbd_package_remove_bulk(self, packages, distribution, suite, rollback=None, msglog=LOG):
+        return self._mbd_package_bulk("REMOVED",
+                                      packages,
+                                      lambda package: self._mbd_package_remove_check(package, distribution, suite, rollback=rollback),
+                                      lambda package, c: self._mbd_package_remove(package, distribution, suite, c, rollback=rollback, msglog=msglog),
+                                      msglog=msglog)
+
     def mbd_package_precheck(self, distribution, suite_option, package, version):
         # 1st, check that the given version matches the distribution's version restrictions
         mandatory_regex = self.layout.mbd_get_mandatory_version_regex(self, distribution, suite_option)
@@ -1150,6 +1240,7 @@ DscIndices: Sources Release . .gz .bz2
                                          dist_str)
             LOG.info("Installed: {p} ({d})".format(p=bres.get_pkg_id(with_arch=True), d=dist_str))
 
+    @_reprepro_batch
     def mbd_package_install(self, distribution, suite_option, changes, bresults):
         """
         Install a dict arch:bres of successful build results.
@@ -1181,12 +1272,13 @@ DscIndices: Sources Release . .gz .bz2
             else:
                 self._mbd_package_install(bres, dist_str)
 
-        # Finally, purge any now-maybe-orphaned package logs
+        # Update pool index, and purge any now-maybe-orphaned package logs
+        self._mbd_reprepro().pool_index.update(package)
         self.mbd_package_purge_orphaned_logs(package)
 
-    def mbd_prepare(self, _request):
+    def mbd_prepare(self, _request, force_reindex=False):
         """
-        Idempotent repository preparation. This may be used as-is as mbd_sync.
+        Idempotent repository preparation. This may be used as-is as mbd_sync (with a full reindex).
         """
         # Architecture sanity checks
         for d in self.distributions.all():
@@ -1219,10 +1311,10 @@ gnupghome {h}
 """.format(h=os.path.join(mini_buildd.setup.HOME_DIR, ".gnupg"), m="morguedir +b/morguedir" if self.reprepro_morguedir else "")).save()
 
         # (Re-)index
-        self._mbd_reprepro().reindex()
+        self._mbd_reprepro().reindex(sign_key=self.mbd_get_daemon().model.mbd_gnupg_fingerprint, force=force_reindex)
 
     def mbd_sync(self, request):
-        self.mbd_prepare(request)
+        self.mbd_prepare(request, force_reindex=True)
 
     def mbd_remove(self, _request):
         if os.path.exists(self.mbd_get_path()):
@@ -1232,6 +1324,9 @@ gnupghome {h}
         # Reprepro check
         MsgLog(LOG, request).log_text(self._mbd_reprepro().check())
 
+        # Re-sync package index (in case reprepro was used manually)
+        self._mbd_reprepro().sync_package_index()
+
         # Purge orphaned logs.
         # Note: This may take some time on bigger repos. We
         # usually run this per package on install/remove/migrate
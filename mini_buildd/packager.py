@@ -4,13 +4,141 @@ from __future__ import unicode_literals
 import os
 import shutil
 import datetime
+import threading
+import collections
+import json
 import logging
 
 import mini_buildd.misc
+import mini_buildd.changes
+import mini_buildd.gnupg
 
 LOG = logging.getLogger(__name__)
 
 
+class Journal(object):
+    """
+    Crash-safe, append-only journal of package state transitions.
+
+    Each line is one JSON record; records are synced to disk
+    before we go on. Replaying the journal gives the state of
+    all packages that have not been closed yet.
+
+    >>> import tempfile
+    >>> j = Journal(os.path.join(tempfile.mkdtemp(), "packages.journal"))
+    >>> j.log("a_1", "CHECKING", changes="/incoming/a_1_source.changes", started="2014-01-01 12:00:00.000000")
+    >>> j.log("b_1", "CHECKING", changes="/incoming/b_1_source.changes", started="2014-01-01 12:00:01.000000")
+    >>> j.log("a_1", "BUILDING", requests={"i386": "/spool/a/i386/a_1_mini-buildd-buildrequest_i386.changes"})
+    >>> j.log("a_1", "RESULT", arch="i386", bres="/incoming/a_1_mini-buildd-buildresult_i386.changes")
+    >>> j.log("b_1", "CLOSED")
+    >>> with open(j.path, "a") as f:
+    ...     f.write('{"pid": "c_1", "ev')
+    >>> packages = j.replay()
+    >>> packages.keys()
+    [u'a_1']
+    >>> packages["a_1"]["status"], packages["a_1"]["requests"], packages["a_1"]["results"]
+    (u'BUILDING', {u'i386': u'/spool/a/i386/a_1_mini-buildd-buildrequest_i386.changes'}, {u'i386': u'/incoming/a_1_mini-buildd-buildresult_i386.changes'})
+
+    Compacting rewrites the journal with one record per given package:
+
+    >>> j.compact(packages)
+    >>> len(open(j.path).readlines())
+    1
+    >>> j.replay() == packages
+    True
+
+    The journal is also compacted automatically every
+    ``compact_closed`` closed packages, so it does not grow
+    while the daemon runs:
+
+    >>> j = Journal(os.path.join(tempfile.mkdtemp(), "packages.journal"), compact_closed=2)
+    >>> for pid in ["a_1", "b_1", "c_1"]:
+    ...     j.log(pid, "CHECKING", changes="/incoming/{p}_source.changes".format(p=pid), started="2014-01-01 12:00:00.000000")
+    >>> j.log("a_1", "CLOSED")
+    >>> len(open(j.path).readlines())
+    4
+    >>> j.log("b_1", "CLOSED")
+    >>> len(open(j.path).readlines()), j.replay().keys()
+    (1, [u'c_1'])
+    """
+    COMPACT_CLOSED = 100
+
+    def __init__(self, path, compact_closed=COMPACT_CLOSED):
+        self.path = path
+        self._lock = threading.Lock()
+        self._compact_closed = compact_closed
+        self._closed = 0
+
+    @classmethod
+    def _write(cls, f, record):
+        f.write(json.dumps(record) + "\n")
+
+    @classmethod
+    def _sync(cls, f):
+        f.flush()
+        os.fsync(f.fileno())
+
+    def log(self, pid, event, **data):
+        record = {"pid": pid, "event": event}
+        record.update(data)
+        with self._lock:
+            with open(self.path, "a") as f:
+                self._write(f, record)
+                self._sync(f)
+
+            if event == "CLOSED":
+                self._closed += 1
+                if self._closed >= self._compact_closed:
+                    LOG.info("Journal: Compacting after {n} closed packages.".format(n=self._closed))
+                    self._compact(self._replay())
+
+    def _replay(self):
+        packages = collections.OrderedDict()
+        if os.path.exists(self.path):
+            for line in open(self.path):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Only the last line might be truncated on a crash
+                    LOG.warn("Journal: Ignoring broken record: {r}".format(r=line.strip()))
+                    continue
+
+                pid, event = record.pop("pid"), record.pop("event")
+                if event == "SNAPSHOT":
+                    packages[pid] = record
+                elif event == "CLOSED":
+                    packages.pop(pid, None)
+                elif pid in packages or event == "CHECKING":
+                    state = packages.setdefault(pid, {"status": event, "requests": {}, "results": {}})
+                    if event == "RESULT":
+                        state["results"][record["arch"]] = record["bres"]
+                    else:
+                        state["status"] = event
+                        state.update(record)
+        return packages
+
+    def replay(self):
+        "Get dict of open packages: pid -> state."
+        with self._lock:
+            return self._replay()
+
+    def _compact(self, packages):
+        tmp_path = self.path + ".new"
+        with open(tmp_path, "w") as f:
+            for pid, state in packages.items():
+                record = {"pid": pid, "event": "SNAPSHOT"}
+                record.update(state)
+                self._write(f, record)
+            self._sync(f)
+        os.rename(tmp_path, self.path)
+        self._closed = 0
+
+    def compact(self, packages):
+        "Atomically rewrite journal with the given open packages only."
+        with self._lock:
+            self._compact(packages)
+
+
 class Package(mini_buildd.misc.Status):
     FAILED = -2
     REJECTED = -1
@@ -37,6 +165,7 @@ class Package(mini_buildd.misc.Status):
         self.repository, self.distribution, self.suite, self.distribution_string = None, None, None, None
         self.requests, self.success, self.failed = {}, {}, {}
         self.port_report = {}
+        self.restored = False
 
     def __unicode__(self):
         def arch_status():
@@ -57,6 +186,44 @@ class Package(mini_buildd.misc.Status):
                                         extra=" ".join(arch_status()),
                                         message=self.status_desc)
 
+    JOURNAL_DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+    def set_status(self, status, desc=""):
+        "Set status, and log the transition to the journal."
+        super(Package, self).set_status(status, desc)
+
+        data = {}
+        if status == self.CHECKING:
+            data = {"changes": self.changes.file_path, "started": self.started.strftime(self.JOURNAL_DATE_FORMAT)}
+        elif status == self.BUILDING:
+            data = {"requests": dict((arch, breq.file_path) for arch, breq in self.requests.items())}
+        self.daemon.journal.log(self.pid, self.status, **data)
+
+    @classmethod
+    def restore(cls, daemon, state):
+        """
+        Restore package (status BUILDING or INSTALLING) from a journal state.
+
+        The recorded status is kept, so a package that was
+        interrupted while installing shows up as INSTALLING. Build
+        results are not restored here: They are still in incoming,
+        and will be re-queued and added again (which re-runs the
+        installation).
+        """
+        package = cls(daemon, mini_buildd.changes.Changes(state["changes"]))
+        package.started = datetime.datetime.strptime(state["started"], cls.JOURNAL_DATE_FORMAT)
+        package.repository, package.distribution, package.suite, _rollback = daemon.parse_distribution(package.changes["Distribution"])
+        package.distribution_string = package.suite.mbd_get_distribution_string(package.repository, package.distribution)
+        for arch, path in state["requests"].items():
+            if not os.path.exists(path):
+                raise Exception("Build request gone: {p}".format(p=path))
+            package.requests[arch] = mini_buildd.changes.Changes(path)
+        package.restored = True
+        # Don't use our set_status(): This is not a transition
+        status = package.INSTALLING if state["status"] == "INSTALLING" else package.BUILDING
+        super(Package, package).set_status(status, "Restored")
+        return package
+
     @property
     def took(self):
         return round(mini_buildd.misc.timedelta_total_seconds(self.finished - self.started), 1) if self.finished else "n/a"
@@ -92,7 +259,11 @@ class Package(mini_buildd.misc.Status):
         # Upload buildrequests
         for _key, breq in self.requests.items():
             try:
-                breq.upload_buildrequest(self.daemon.model.mbd_get_http_hopo())
+                breq.upload_buildrequest(self.daemon.model.mbd_get_http_hopo(),
+                                         local_queue=self.daemon.incoming_queue,
+                                         remote_status=self.daemon.remote_status,
+                                         blob_store=self.daemon.blob_store,
+                                         gnupg=self.daemon.model.mbd_gnupg)
             except Exception as e:
                 mini_buildd.setup.log_exception(LOG,
                                                 "{i}: Buildrequest upload failed".format(i=breq.get_pkg_id()),
@@ -123,6 +294,7 @@ class Package(mini_buildd.misc.Status):
             self.success[arch] = bres
         else:
             self.failed[arch] = bres
+        self.daemon.journal.log(self.pid, "RESULT", arch=arch, bres=bres.file_path)
 
         missing = len(self.requests) - len(self.success) - len(self.failed)
         if missing <= 0:
@@ -266,10 +438,32 @@ def package_close(daemon, package):
         package.move_to_pkglog()
         package.notify()
         daemon.last_packages.appendleft(LastPackage(package))
+        mini_buildd.gnupg.STATS.count("packages")
     except Exception as e:
         mini_buildd.setup.log_exception(LOG, "Error closing package '{p}'".format(p=package.pid), e, level=logging.CRITICAL)
     finally:
         del daemon.packages[package.pid]
+        daemon.journal.log(package.pid, "CLOSED")
+
+
+def restore(daemon):
+    """
+    Restore packages dict from the journal, and compact the journal.
+
+    Packages that did not make it past CHECKING are dropped: The
+    user upload is still in incoming, and will be re-queued.
+    """
+    packages, states = {}, collections.OrderedDict()
+    for pid, state in daemon.journal.replay().items():
+        if state["status"] in ["BUILDING", "INSTALLING"]:
+            try:
+                packages[pid] = Package.restore(daemon, state)
+                states[pid] = state
+                LOG.info("{p}: Package restored from journal.".format(p=pid))
+            except Exception as e:
+                mini_buildd.setup.log_exception(LOG, "{p}: Can't restore package from journal (dropping)".format(p=pid), e, level=logging.WARNING)
+    daemon.journal.compact(states)
+    return packages
 
 
 def run(daemon, changes):
@@ -284,6 +478,7 @@ def run(daemon, changes):
         try:
             package.add_buildresult(changes)
             if package.finished:
+                package.set_status(package.INSTALLING)
                 package.install()
                 package.set_status(package.INSTALLED)
                 package_close(daemon, package)
@@ -294,11 +489,15 @@ def run(daemon, changes):
 
     else:  # User upload
         if pid in daemon.packages:
+            if daemon.packages[pid].restored and daemon.packages[pid].changes.file_path == changes.file_path:
+                LOG.info("{p}: Skipping re-queued user upload (package restored from journal).".format(p=pid))
+                return
             raise Exception("Internal error: Uploaded package already in packages list.")
 
         package = mini_buildd.packager.Package(daemon, changes)
         daemon.packages[pid] = package
         try:
+            package.set_status(package.CHECKING)
             package.precheck()
             package.set_status(package.BUILDING)
         except Exception as e:
@@ -6,7 +6,14 @@ from __future__ import unicode_literals
 
 import os
 import shutil
+import glob
+import re
+import sqlite3
+import contextlib
+import hashlib
 import threading
+import time
+import tempfile
 
 import logging
 
@@ -16,6 +23,331 @@ LOG = logging.getLogger(__name__)
 
 _LOCKS_LOCK = threading.Lock()
 _LOCKS = {}
+_POOL_INDEXES = {}
+_PACKAGE_INDEXES = {}
+_PUBLISHERS = {}
+# Per thread: basedir -> set of distributions to export at the end of the batch
+_BATCHES = threading.local()
+
+
+class PoolIndex(object):
+    """
+    Persistent (SQLite) index of the files in a reprepro pool.
+
+    Maps file names to entries with path (relative to basedir),
+    source, size and checksums. This is kept up to date per
+    source package on install, migrate and remove (only the
+    rows of that source are rewritten), so questions like "is
+    this file already in the pool?" are just a lookup.
+
+    A missing or unreadable index is rebuilt from the pool.
+
+    >>> import tempfile
+    >>> basedir = tempfile.mkdtemp()
+    >>> mini_buildd.misc.mkdirs(os.path.join(basedir, "pool", "main", "h", "hello"))
+    >>> open(os.path.join(basedir, "pool", "main", "h", "hello", "hello_1.0.orig.tar.gz"), "w").write("orig")
+    >>> i = PoolIndex(basedir)
+    >>> e = i.find("hello_1.0.orig.tar.gz", source="hello")[0]
+    >>> e["path"], e["size"], e["md5"]
+    (u'pool/main/h/hello/hello_1.0.orig.tar.gz', 4, u'025f253325b46929cd34f2a7c3c55e7c')
+    >>> os.remove(os.path.join(basedir, "pool", "main", "h", "hello", "hello_1.0.orig.tar.gz"))
+    >>> i.update("hello")
+    >>> i.find("hello_1.0.orig.tar.gz")
+    []
+    >>> open(os.path.join(basedir, "pool", "main", "h", "hello", "hello_1.1.orig.tar.gz"), "w").write("orig1")
+    >>> i.rebuild()
+    >>> [e["path"] for e in PoolIndex(basedir).find("hello_1.1.orig.tar.gz")]
+    [u'pool/main/h/hello/hello_1.1.orig.tar.gz']
+    >>> i.get_by_path("pool/main/h/hello/hello_1.1.orig.tar.gz")["size"]
+    5
+    >>> i.peek_by_path("pool/main/h/hello/hello_1.1.orig.tar.gz")["size"]
+    5
+    >>> PoolIndex(basedir).peek_by_path("pool/main/h/hello/hello_1.1.orig.tar.gz") is None
+    True
+    """
+    FIELDS = [("name", "TEXT"), ("path", "TEXT"), ("source", "TEXT"), ("size", "INTEGER"), ("md5", "TEXT"), ("sha1", "TEXT"), ("sha256", "TEXT")]
+
+    def __init__(self, basedir):
+        self._basedir = basedir
+        self._path = os.path.join(basedir, "pool.sqlite")
+        self._lock = threading.Lock()
+        self._ready = False
+
+    @contextlib.contextmanager
+    def _connect(self):
+        with contextlib.closing(sqlite3.connect(self._path)) as db:
+            db.row_factory = sqlite3.Row
+            with db:
+                yield db
+
+    @classmethod
+    def _dict(cls, row):
+        return dict([(unicode(k), row[k]) for k in row.keys()])
+
+    def _scan(self, db, pattern):
+        paths = [p for p in glob.glob(os.path.join(self._basedir, "pool", "*", "*", pattern, "*")) if os.path.isfile(p)]
+        rows = []
+        for p, checksums in mini_buildd.misc.CHECKSUMS.get_many(paths).items():
+            path = os.path.relpath(p, self._basedir)
+            rows.append([os.path.basename(p), path, path.split(os.sep)[3], os.path.getsize(p)] + [checksums[h] for h in mini_buildd.misc.Checksums.HASH_TYPES])
+        db.executemany("INSERT INTO pool VALUES ({q})".format(q=", ".join(["?"] * len(self.FIELDS))), rows)
+
+    def _rebuild(self):
+        LOG.info("Rebuilding pool index: {p}".format(p=self._path))
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        with self._connect() as db:
+            db.execute("CREATE TABLE pool ({f})".format(f=", ".join(["{c} {t}".format(c=c, t=t) for c, t in self.FIELDS])))
+            for c in ["name", "path", "source"]:
+                db.execute("CREATE INDEX pool_{c} ON pool ({c})".format(c=c))
+            self._scan(db, "*")
+        self._ready = True
+
+    def _load(self):
+        if not self._ready:
+            try:
+                with self._connect() as db:
+                    db.execute("SELECT count(*) FROM pool")
+                self._ready = True
+            except sqlite3.DatabaseError as e:
+                LOG.warn("Pool index '{p}' unusable ({e}).".format(p=self._path, e=e))
+                self._rebuild()
+
+    def rebuild(self):
+        "Rebuild the whole index from the pool."
+        with self._lock:
+            self._rebuild()
+
+    def _update(self, source):
+        with self._connect() as db:
+            db.execute("DELETE FROM pool WHERE source=?", (source,))
+            self._scan(db, source)
+
+    def update(self, source):
+        "Update index for all files of one source package."
+        with self._lock:
+            self._load()
+            self._update(source)
+
+    def _is_stale(self, entry):
+        path = self.get_path(entry)
+        return not os.path.exists(path) or os.path.getsize(path) != entry["size"]
+
+    def _find(self, name):
+        with self._connect() as db:
+            return [self._dict(r) for r in db.execute("SELECT * FROM pool WHERE name=?", (name,))]
+
+    def find(self, name, source=None):
+        """
+        Get list of index entries for the file name (optionally restricted to a source package).
+
+        Entries found to be stale (pool changed behind our back)
+        trigger an update for their source package.
+        """
+        with self._lock:
+            self._load()
+            entries = self._find(name)
+            stale = set([e["source"] for e in entries if self._is_stale(e)])
+            for s in stale:
+                LOG.warn("Pool index: Stale entries for '{s}', updating.".format(s=s))
+                self._update(s)
+            if stale:
+                entries = self._find(name)
+            return [e for e in entries if source is None or e["source"] == source]
+
+    def get_path(self, entry):
+        "Get absolute path of an index entry."
+        return os.path.join(self._basedir, entry["path"])
+
+    def get_by_path(self, path):
+        "Get index entry by path (relative to basedir), or None."
+        with self._lock:
+            self._load()
+            with self._connect() as db:
+                row = db.execute("SELECT * FROM pool WHERE path=?", (path,)).fetchone()
+                return self._dict(row) if row else None
+
+    def peek_by_path(self, path):
+        "Like get_by_path(), but never loads or rebuilds the index (None if not loaded or busy)."
+        if not self._ready or not self._lock.acquire(False):
+            return None
+        try:
+            with self._connect() as db:
+                row = db.execute("SELECT * FROM pool WHERE path=?", (path,)).fetchone()
+                return self._dict(row) if row else None
+        except sqlite3.DatabaseError as e:
+            LOG.warn("Pool index '{p}' unusable ({e}).".format(p=self._path, e=e))
+            return None
+        finally:
+            self._lock.release()
+
+
+class PackageIndex(object):
+    """
+    SQLite index of all packages in a reprepro repository.
+
+    Rows are taken from reprepro's 'list' per distribution. For
+    changes via our Reprepro class (install, migrate, remove),
+    only the rows of the affected source package are re-synced
+    (via 'listfilter'); distributions are fully re-synced on
+    reindex, and the index is rebuilt completely when the
+    database is missing.
+
+    >>> import tempfile
+    >>> i = PackageIndex(tempfile.mkdtemp())
+    >>> i.replace("wheezy-test-unstable", [{"package": "hello", "type": "dsc", "architecture": "source", "version": "1:1.0-1", "source": "hello", "sourceversion": "1:1.0-1", "distribution": "wheezy-test-unstable", "component": "main", "dsc": "pool/main/h/hello/hello_1.0-1.dsc"},
+    ...                                    {"package": "hello", "type": "deb", "architecture": "i386", "version": "1:1.0-1", "source": "hello", "sourceversion": "1:1.0-1", "distribution": "wheezy-test-unstable", "component": "main"},
+    ...                                    {"package": "libhello0", "type": "deb", "architecture": "i386", "version": "1:1.0-1", "source": "hello", "sourceversion": "1:1.0-1", "distribution": "wheezy-test-unstable", "component": "main"}])
+    >>> i.show("hello") == [{"source": "hello", "sourceversion": "1:1.0-1", "distribution": "wheezy-test-unstable"}]
+    True
+    >>> [p["package"] for p in i.list("*hello*", "wheezy-test-unstable", typ="deb")]
+    [u'hello', u'libhello0']
+    >>> i.list("hello", "wheezy-test-unstable", typ="dsc")[0]["dsc"]
+    u'pool/main/h/hello/hello_1.0-1.dsc'
+    >>> i.replace("wheezy-test-unstable", [{"package": "hello", "type": "dsc", "architecture": "source", "version": "1:1.1-1", "source": "hello", "sourceversion": "1:1.1-1", "distribution": "wheezy-test-unstable", "component": "main"}],
+    ...           source="hello")
+    >>> [(p["package"], p["version"]) for p in i.list("*", "wheezy-test-unstable")]
+    [(u'hello', u'1:1.1-1')]
+    >>> i.replace("wheezy-test-unstable", [])
+    >>> i.show("hello")
+    []
+    """
+    FIELDS = ["package", "type", "architecture", "version", "source", "sourceversion", "distribution", "component", "dsc"]
+
+    def __init__(self, basedir):
+        self._path = os.path.join(basedir, "packages.sqlite")
+        self._lock = threading.Lock()
+        self.is_new = not os.path.exists(self._path)
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS packages ({f})".format(f=", ".join(["{c} TEXT".format(c=c) for c in self.FIELDS])))
+            for c in ["package", "source", "distribution"]:
+                db.execute("CREATE INDEX IF NOT EXISTS packages_{c} ON packages ({c})".format(c=c))
+
+    @contextlib.contextmanager
+    def _connect(self):
+        with contextlib.closing(sqlite3.connect(self._path)) as db:
+            db.row_factory = sqlite3.Row
+            with db:
+                yield db
+
+    @classmethod
+    def _dict(cls, row):
+        return dict([(unicode(k), row[k]) for k in row.keys()])
+
+    def replace(self, distribution, rows, source=None):
+        "Replace all rows for distribution (or only those of one source package)."
+        with self._lock, self._connect() as db:
+            if source is None:
+                db.execute("DELETE FROM packages WHERE distribution=?", (distribution,))
+            else:
+                db.execute("DELETE FROM packages WHERE distribution=? AND source=?", (distribution, source))
+            db.executemany("INSERT INTO packages VALUES ({q})".format(q=", ".join(["?"] * len(self.FIELDS))),
+                           [[r.get(f) for f in self.FIELDS] for r in rows])
+
+    def clear(self):
+        with self._lock, self._connect() as db:
+            db.execute("DELETE FROM packages")
+
+    def list(self, pattern, distribution, typ=None, list_max=50):
+        with self._connect() as db:
+            rows = db.execute("SELECT * FROM packages WHERE distribution=? AND package GLOB ?{t} LIMIT ?".format(t=" AND type=?" if typ else ""),
+                              [distribution, pattern] + ([typ] if typ else []) + [list_max])
+            return [self._dict(r) for r in rows]
+
+    def show(self, package):
+        with self._connect() as db:
+            return [self._dict(r) for r in db.execute("SELECT source, sourceversion, distribution FROM packages WHERE type='dsc' AND package=?", (package,))]
+
+
+class DistsPublisher(object):
+    """
+    Publish reprepro's indices as immutable snapshots.
+
+    reprepro exports to a private tree ('dists.work'). Each
+    publish() hardlinks that tree into a new snapshot (in
+    'dists.snapshots/'), and atomically switches the served
+    'dists' symlink to it. Replaced snapshots are removed after
+    a grace period, so clients in the middle of a download
+    never see changing files.
+
+    An old-style 'dists' directory is taken over as work tree.
+
+    >>> basedir = tempfile.mkdtemp()
+    >>> mini_buildd.misc.mkdirs(os.path.join(basedir, "dists", "wheezy"))
+    >>> open(os.path.join(basedir, "dists", "wheezy", "Release"), "w").write("1")
+    >>> p = DistsPublisher(basedir, grace=0)
+    >>> os.path.islink(os.path.join(basedir, "dists")), open(os.path.join(basedir, "dists", "wheezy", "Release")).read()
+    (True, '1')
+    >>> first = p.current()
+    >>> os.rename(os.path.join(p.work_dir, "wheezy", "Release"), os.path.join(p.work_dir, "wheezy", "Release.old"))
+    >>> open(os.path.join(p.work_dir, "wheezy", "Release"), "w").write("2")
+    >>> p.publish()
+    >>> open(os.path.join(basedir, "dists", "wheezy", "Release")).read()
+    '2'
+    >>> os.path.exists(first), len(os.listdir(p.snapshots_dir))
+    (False, 1)
+    """
+    GRACE = 600
+
+    def __init__(self, basedir, grace=GRACE):
+        self._basedir = basedir
+        self._grace = grace
+        self.work_dir = os.path.join(basedir, "dists.work")
+        self.snapshots_dir = os.path.join(basedir, "dists.snapshots")
+        self._link = os.path.join(basedir, "dists")
+
+        if os.path.isdir(self._link) and not os.path.islink(self._link) and not os.path.exists(self.work_dir):
+            LOG.info("Taking over '{d}' as publisher work tree".format(d=self._link))
+            os.rename(self._link, self.work_dir)
+            self.publish()
+
+    def current(self):
+        "Path of the currently published snapshot (or None)."
+        if os.path.islink(self._link):
+            return os.path.join(self._basedir, os.readlink(self._link))
+
+    def publish(self):
+        "Snapshot the work tree and switch to it."
+        mini_buildd.misc.mkdirs(self.work_dir)
+        mini_buildd.misc.mkdirs(self.snapshots_dir)
+        snapshot = tempfile.mkdtemp(dir=self.snapshots_dir, prefix="{t}.".format(t=int(time.time())))
+
+        # Hardlink all files (reprepro always replaces index files, so they are never changed in place)
+        for path, dirs, files in os.walk(self.work_dir):
+            target = os.path.join(snapshot, os.path.relpath(path, self.work_dir))
+            for d in dirs:
+                os.mkdir(os.path.join(target, d))
+            for f in files:
+                os.link(os.path.join(path, f), os.path.join(target, f))
+        os.chmod(snapshot, 0o755)
+
+        # Atomic symlink swap
+        previous = self.current()
+        link_tmp = "{l}.new".format(l=self._link)
+        if os.path.lexists(link_tmp):
+            os.remove(link_tmp)
+        os.symlink(os.path.relpath(snapshot, self._basedir), link_tmp)
+        os.rename(link_tmp, self._link)
+        LOG.info("Published: {s}".format(s=snapshot))
+
+        # Mark replaced snapshot (mtime starts grace period)
+        if previous and os.path.exists(previous):
+            os.utime(previous, None)
+        self.gc()
+
+    def gc(self):
+        "Remove replaced snapshots older than the grace period."
+        current = self.current()
+        for snapshot in glob.glob(os.path.join(self.snapshots_dir, "*")):
+            if snapshot != current and os.path.getmtime(snapshot) + self._grace <= time.time():
+                shutil.rmtree(snapshot, ignore_errors=True)
+                LOG.info("Removed old snapshot: {s}".format(s=snapshot))
+
+
+def get_pool_index(basedir):
+    "Get the (shared) pool index of a repository."
+    with _LOCKS_LOCK:
+        return _POOL_INDEXES.setdefault(basedir, PoolIndex(basedir))
 
 
 class Reprepro(object):
@@ -31,6 +363,18 @@ class Reprepro(object):
 
     For the case that someone else is using reprepro
     manually, we also always run it with '--waitforlock'.
+
+    Exports
+
+    Changing calls are run with '--export=never'. Within a
+    batch (see batch()), touched distributions are exported
+    once at the end of the (outermost) batch; otherwise, right
+    after the call.
+
+    Publishing
+
+    reprepro exports to a private tree; every export is then
+    published as new snapshot (see DistsPublisher).
     """
     def __init__(self, basedir):
         self._basedir = basedir
@@ -38,8 +382,20 @@ class Reprepro(object):
         # Seems dict.setdefault 'should' be atomic, but it may be not the case in all versions >=2.6
         # See: http://bugs.python.org/issue13521
         with _LOCKS_LOCK:
-            self._lock = _LOCKS.setdefault(self._basedir, threading.Lock())
+            self._lock = _LOCKS.setdefault(self._basedir, threading.RLock())
             LOG.debug("Lock for reprepro repository '{r}': {o}".format(r=self._basedir, o=self._lock))
+            self.pool_index = _POOL_INDEXES.setdefault(self._basedir, PoolIndex(self._basedir))
+            if self._basedir not in _PACKAGE_INDEXES:
+                _PACKAGE_INDEXES[self._basedir] = PackageIndex(self._basedir)
+            self.package_index = _PACKAGE_INDEXES[self._basedir]
+            if self._basedir not in _PUBLISHERS:
+                _PUBLISHERS[self._basedir] = DistsPublisher(self._basedir)
+            self.publisher = _PUBLISHERS[self._basedir]
+        self._cmd.append("--distdir={d}".format(d=self.publisher.work_dir))
+
+        if self.package_index.is_new and os.path.exists(os.path.join(self._basedir, "conf", "distributions")):
+            self.package_index.is_new = False
+            self.sync_package_index()
 
     def _call(self, args, show_command=False):
         return "{command}{output}".format(command="Running {command}\n".format(command=" ".join(self._cmd + args)) if show_command else "",
@@ -49,28 +405,113 @@ class Reprepro(object):
         with self._lock:
             return self._call(args, show_command)
 
-    def reindex(self):
+    def _get_codenames(self):
+        return re.findall(r"^Codename: *(\S+)", open(os.path.join(self._basedir, "conf", "distributions")).read(), re.MULTILINE)
+
+    def _sync(self, distribution):
+        self.package_index.replace(distribution, self._list(["list", distribution]))
+
+    def _sync_source(self, distribution, source):
+        self.package_index.replace(distribution,
+                                   [r for r in self._list(["listfilter", distribution, "$Source (== {s})".format(s=source)]) if r["source"] == source],
+                                   source=source)
+
+    def _sync_all(self):
+        self.package_index.clear()
+        for codename in self._get_codenames():
+            self._sync(codename)
+
+    def sync_package_index(self):
+        "Fully re-sync package index from reprepro."
         with self._lock:
-            # Update reprepro dbs, and delete any packages no longer in dists.
-            self._call(["--delete", "clearvanished"])
+            LOG.info("Re-syncing package index: {b}".format(b=self._basedir))
+            self._sync_all()
+
+    @classmethod
+    def _parse_distributions(cls, conf):
+        """
+        Parse reprepro's distributions config into a dict codename -> stanza (comments stripped).
+
+        >>> sorted(Reprepro._parse_distributions("# Generated\\n\\nCodename: a\\nSuite: a\\n\\nCodename: b\\n").items())
+        [(u'a', u'Codename: a\\nSuite: a'), (u'b', u'Codename: b')]
+        """
+        result = {}
+        for stanza in re.split(r"\n\s*\n", "\n".join([l for l in conf.splitlines() if not l.startswith("#")])):
+            codename = re.search(r"^Codename: *(\S+)", stanza, re.MULTILINE)
+            if codename:
+                result[codename.group(1)] = stanza.strip()
+        return result
 
-            # Purge all indices under 'dists/' (clearvanished does not remove indices of vanished distributions)
-            shutil.rmtree(os.path.join(self._basedir, "dists"), ignore_errors=True)
+    @classmethod
+    def _export_state(cls, options, sign_key):
+        """
+        Get state line for the exported conf: A digest over everything outside 'conf/distributions' that changes the exported indices.
 
-            # Finally, rebuild all indices
-            self._call(["export"])
+        >>> Reprepro._export_state("gnupghome /x", "ABCD") == Reprepro._export_state("gnupghome /x", "ABCD")
+        True
+        >>> Reprepro._export_state("gnupghome /x", "ABCD") == Reprepro._export_state("gnupghome /x", "EF01")
+        False
+        """
+        return "# Export state: {d}".format(d=hashlib.sha1("\n".join([options, sign_key or ""]).encode("UTF-8")).hexdigest())
+
+    def reindex(self, sign_key=None, force=False):
+        """
+        Incremental reindex: Compare 'conf/distributions' with the version of the last
+        reindex, export only added or changed distributions, and remove vanished ones.
+
+        A change of 'conf/options' or of the signing key (fingerprint), or
+        ``force``, makes this a full reindex (like the very first one).
+
+        The result is published as one new snapshot.
+        """
+        conf = os.path.join(self._basedir, "conf", "distributions")
+        conf_exported = conf + ".exported"
+        options = os.path.join(self._basedir, "conf", "options")
+        dists_dir = self.publisher.work_dir
+
+        with self._lock:
+            conf_text = mini_buildd.misc.open_utf8(conf).read()
+            state = self._export_state(mini_buildd.misc.open_utf8(options).read() if os.path.exists(options) else "", sign_key)
+            current = self._parse_distributions(conf_text)
+            previous = {}
+            if not force and os.path.exists(conf_exported):
+                exported = mini_buildd.misc.open_utf8(conf_exported).read()
+                if exported.startswith(state + "\n"):
+                    previous = self._parse_distributions(exported)
+                else:
+                    LOG.info("Reindex {b}: Options or signing key changed, full reindex.".format(b=self._basedir))
+
+            existing = os.listdir(dists_dir) if os.path.exists(dists_dir) else []
+            changed = sorted([c for c in current if previous.get(c) != current[c] or c not in existing])
+            vanished = sorted((set(previous) | set(existing)) - set(current))
+            LOG.info("Reindex {b}: {c} changed, {v} vanished, {u} unchanged".format(b=self._basedir, c=len(changed), v=len(vanished), u=len(current) - len(changed)))
+
+            # Update reprepro dbs, and delete any packages no longer in dists
+            if vanished or not previous:
+                self._call(["--delete", "clearvanished"])
+                self.pool_index.rebuild()
+
+            # Remove indices of vanished distributions (clearvanished does not do that)
+            for codename in vanished:
+                shutil.rmtree(os.path.join(dists_dir, codename), ignore_errors=True)
+                self.package_index.replace(codename, [])
+
+            # Export changed distributions
+            if changed:
+                self._call(["export"] + changed)
+                for codename in changed:
+                    self._sync(codename)
+
+            if changed or vanished or not self.publisher.current():
+                self.publisher.publish()
+            mini_buildd.misc.open_utf8(conf_exported, "w").write(state + "\n" + conf_text)
 
     def check(self):
         return self._call_locked(["check"])
 
-    def list(self, pattern, distribution, typ=None, list_max=50):
+    def _list(self, args):
         result = []
-        for item in self._call_locked(["--list-format=${package}|${$type}|${architecture}|${version}|${$source}|${$sourceversion}|${$codename}|${$component};",
-                                       "--list-max={m}".format(m=list_max)] +
-                                      (["--type={t}".format(t=typ)] if typ else []) +
-                                      ["listmatched",
-                                       distribution,
-                                       pattern]).split(";"):
+        for item in self._call(["--list-format=${package}|${$type}|${architecture}|${version}|${$source}|${$sourceversion}|${$codename}|${$component}|${$filekey};"] + args).split(";"):
             if item:
                 item_split = item.split("|")
                 result.append({"package": item_split[0],
@@ -81,32 +522,77 @@ class Reprepro(object):
                                "sourceversion": item_split[5],
                                "distribution": item_split[6],
                                "component": item_split[7],
+                               # Pool path of the dsc, as recorded by reprepro
+                               "dsc": item_split[8] if item_split[1] == "dsc" else None,
                                })
         return result
 
+    def list(self, pattern, distribution, typ=None, list_max=50):
+        "List packages (from package index)."
+        return self.package_index.list(pattern, distribution, typ, list_max)
+
     def show(self, package):
-        result = []
-        # reprepro ls format: "${$source} | ${$sourceversion} |    ${$codename} | source\n"
-        for item in self._call_locked(["--type=dsc",
-                                       "ls",
-                                       package]).split("\n"):
-            LOG.debug("ls: {i}".format(i=item))
-            if item:
-                item_split = item.split("|")
-                result.append({"source": item_split[0].strip(),
-                               "sourceversion": item_split[1].strip(),
-                               "distribution": item_split[2].strip(),
-                               })
-        return result
+        "Show source package versions in all distributions (from package index)."
+        return self.package_index.show(package)
+
+    @contextlib.contextmanager
+    def batch(self, locked=False):
+        """
+        Batch changing calls: Export all touched distributions only once, at the end.
+
+        With ``locked``, the repository lock is held for the whole
+        batch (i.e., other threads can't interleave their calls).
+        """
+        batches = _BATCHES.__dict__.setdefault("batches", {})
+        outermost = self._basedir not in batches
+        if outermost:
+            batches[self._basedir] = set()
+        if locked:
+            self._lock.acquire()
+        try:
+            yield
+        finally:
+            try:
+                if outermost:
+                    self.export(batches.pop(self._basedir))
+            finally:
+                if locked:
+                    self._lock.release()
+
+    def export(self, distributions):
+        if distributions:
+            with self._lock:
+                LOG.info("Exporting: {d}".format(d=" ".join(sorted(distributions))))
+                self._call(["export"] + sorted(distributions))
+                self.publisher.publish()
+
+    def _call_locked_sync(self, args, distribution, source):
+        "Run changing call (w/o export), and re-sync the package index for the changed source package."
+        batch = _BATCHES.__dict__.get("batches", {}).get(self._basedir)
+        with self._lock:
+            try:
+                return self._call(["--export=never"] + args, show_command=True)
+            finally:
+                self._sync_source(distribution, source)
+                if batch is None:
+                    self._call(["export", distribution])
+                    self.publisher.publish()
+                else:
+                    batch.add(distribution)
+
+    @classmethod
+    def _source_of(cls, file_name):
+        "Source package name from a changes or dsc file name (SOURCE_VERSION[_ARCH].{changes,dsc})."
+        return os.path.basename(file_name).split("_")[0]
 
     def migrate(self, package, src_distribution, dst_distribution, version=None):
-        return self._call_locked(["copysrc", dst_distribution, src_distribution, package] + ([version] if version else []), show_command=True)
+        return self._call_locked_sync(["copysrc", dst_distribution, src_distribution, package] + ([version] if version else []), dst_distribution, package)
 
     def remove(self, package, distribution, version=None):
-        return self._call_locked(["removesrc", distribution, package] + ([version] if version else []), show_command=True)
+        return self._call_locked_sync(["removesrc", distribution, package] + ([version] if version else []), distribution, package)
 
     def install(self, changes, distribution):
-        return self._call_locked(["include", distribution, changes], show_command=True)
+        return self._call_locked_sync(["include", distribution, changes], distribution, self._source_of(changes))
 
     def install_dsc(self, dsc, distribution):
-        return self._call_locked(["includedsc", distribution, dsc], show_command=True)
+        return self._call_locked_sync(["includedsc", distribution, dsc], distribution, self._source_of(dsc))
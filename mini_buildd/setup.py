@@ -13,10 +13,12 @@ HTTPD_BIND = None
 HOME_DIR = None
 
 INCOMING_DIR = None
+BLOBS_DIR = None
 REPOSITORIES_DIR = None
 
 SPOOL_DIR = None
 TMP_DIR = None
+CACHE_DIR = None
 LOG_DIR = None
 LOG_FILE = None
 ACCESS_LOG_FILE = None
@@ -20,6 +20,8 @@ urlpatterns = patterns(
     '',
     (r"^$", mini_buildd.views.home),
     (r"^log/(.+)/(.+)/(.+)/$", mini_buildd.views.log),
+    (r"^builds/(.+)/log$", mini_buildd.views.buildlog),
+    (r"^blobs$", mini_buildd.views.blobs),
     (r"^repositories/(?P<pk>.+)/$", django.views.generic.detail.DetailView.as_view(model=mini_buildd.models.repository.Repository)),
     (r"^api$", mini_buildd.views.api),
     (r"^accounts/profile/$", mini_buildd.views.AccountProfileView.as_view(template_name="mini_buildd/account_profile.html")),)
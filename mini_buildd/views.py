@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import os
+import time
 import pickle
+import threading
 import logging
 
 import django.core.exceptions
@@ -100,6 +103,14 @@ def error405_method_not_allowed(request, description="The resource does not allo
                  api_cmd)
 
 
+def error503_service_unavailable(request, description="The service is temporarily unavailable", api_cmd=None):
+    return error(request,
+                 503,
+                 "Service Unavailable",
+                 description,
+                 api_cmd)
+
+
 def error500_internal(request, description="Sorry, something went wrong", api_cmd=None):
     return error(request,
                  500,
@@ -134,6 +145,118 @@ def log(request, repository, package, version):
                                                django.template.RequestContext(request))
 
 
+BUILDLOG_FOLLOW_TIMEOUT = 300
+BUILDLOG_FOLLOWERS = threading.BoundedSemaphore(8)
+
+
+class _BuildLogFollower(object):
+    "Streaming content that frees its follower slot when the response is closed."
+    def __init__(self, stream):
+        self._stream = stream
+        self._closed = False
+
+    def __iter__(self):
+        return self._stream
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._stream.close()
+            BUILDLOG_FOLLOWERS.release()
+
+
+def buildlog(request, key):
+    """
+    Get the build log of a running build, starting at byte offset 'offset'.
+
+    With 'follow=0', just return what is there, at most
+    Build.READ_LOG_MAX bytes (header 'X-Mini-Buildd-Log-Size'
+    tells the current log size, 'X-Mini-Buildd-Build-Finished'
+    if the log is complete); clients poll again with the number
+    of bytes already received as offset.
+
+    Otherwise, stream the growing log (chunked). The response
+    ends when the build is finished, or after
+    BUILDLOG_FOLLOW_TIMEOUT seconds; clients may resume with
+    the number of bytes already received as offset. Only a
+    limited number of followers are served in parallel.
+    """
+    daemon = mini_buildd.daemon.get()
+    build = daemon.builds.get(key)
+    if build is None:
+        return error404_not_found(request, "No such running build: {k}".format(k=key))
+
+    try:
+        offset = int(request.GET.get("offset", 0))
+    except ValueError:
+        return error400_bad_request(request, "Invalid offset: {o}".format(o=request.GET.get("offset")))
+
+    content_type = "text/plain; charset={charset}".format(charset=mini_buildd.setup.CHAR_ENCODING)
+
+    def finished():
+        return not build.logging and not (daemon.builds.get(key) is build and build.get_status() < build.UPLOADING)
+
+    if request.GET.get("follow", "1") == "0":
+        # Check before reading, so a finished log is read completely
+        is_finished = finished()
+        size = build.get_log_size()
+        data = build.read_log(offset)
+        response = django.http.HttpResponse(data, content_type=content_type)
+        response["X-Mini-Buildd-Log-Size"] = size
+        response["X-Mini-Buildd-Build-Finished"] = "1" if is_finished and offset + len(data) >= size else "0"
+        return response
+
+    if not BUILDLOG_FOLLOWERS.acquire(False):
+        return error503_service_unavailable(request, "Too many build log followers, please try again later")
+
+    def stream():
+        deadline = time.time() + BUILDLOG_FOLLOW_TIMEOUT
+
+        # Wait for the log to appear (build might still be waiting in the scheduler)
+        while not os.path.exists(build.buildlog_path):
+            if finished() or time.time() > deadline:
+                return
+            time.sleep(1)
+
+        # Keep the file open: The build dir is purged when the build is done
+        with open(build.buildlog_path, "rb") as f:
+            f.seek(offset)
+            while True:
+                data = f.read(65536)
+                if data:
+                    yield data
+                elif not finished() and time.time() < deadline:
+                    time.sleep(1)
+                else:
+                    break
+
+    return django.http.StreamingHttpResponse(_BuildLogFollower(stream()), content_type=content_type)
+
+
+def _is_remote(request):
+    "Check if request comes from one of our (active or auto-reactivated) remotes."
+    return mini_buildd.daemon.get().is_remote_address(request.META.get("REMOTE_ADDR", ""))
+
+
+def blobs(request):
+    """
+    Blob negotiation: Get the blobs we are missing from the comma-separated list of sha256 checksums given in 'missing'.
+
+    Blobs we have are marked as used (so they are not evicted
+    before the build request using them arrives).
+
+    Only our remotes (or staff users) may ask.
+    """
+    if not (_is_remote(request) or (request.user.is_authenticated() and request.user.is_active and request.user.is_staff)):
+        return error401_unauthorized(request, "Blobs: Only for remotes or staff users")
+
+    try:
+        missing = mini_buildd.daemon.get().blob_store.missing([s for s in request.GET.get("missing", "").split(",") if s])
+    except Exception as e:
+        return error400_bad_request(request, "{e}".format(e=e))
+    return django.http.HttpResponse("\n".join(missing), content_type="text/plain")
+
+
 def api(request):
     api_cmd = None
     try: